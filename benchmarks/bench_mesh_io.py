@@ -0,0 +1,92 @@
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "preprocessing"))
+import mesh_io
+
+# Compares mesh_io against the line by line reader that Laplacian.ipynb
+# used before, on synthetic quad meshes of increasing size.
+
+
+def read_wavefront(path):
+    # copy of the old notebook reader, np.int replaced by int
+    with open( path, 'r') as fp:
+        vertices = []
+        faces = []
+        normals = []
+        for line in fp:
+            if line.startswith('#'):
+                continue
+            parts = line.split()
+            if len(parts) == 0:
+                continue
+            if parts[0] == 'v':
+                vertices.append( np.array([float(x) for x in parts[1:] ]) )
+            elif parts[0] == 'vn':
+                normals.append( np.array([float(x) for x in parts[1:] ]) )
+            elif parts[0] == 'f':
+                stripped = [int(x.split('//')[0]) - 1 for x in parts[1:] ]
+                faces.append(np.array(stripped,dtype=int))
+            elif parts[0] == 'g':
+                continue
+            elif parts[0] == 's':
+                continue
+            else:
+                return None
+        f = np.vstack(faces)
+
+        return np.vstack(vertices), f
+
+
+def quad_grid(n):
+    u, w = np.meshgrid(np.arange(n + 1), np.arange(n + 1), indexing='ij')
+    v = np.stack([u, w, np.sin(u * .1) * np.cos(w * .1)], axis=-1).reshape(-1, 3) / n
+    idx = np.arange((n + 1) * (n + 1)).reshape(n + 1, n + 1)
+    f = np.stack([idx[:-1, :-1], idx[1:, :-1], idx[1:, 1:], idx[:-1, 1:]], axis=-1)
+    return v, f.reshape(-1, 4)
+
+
+def write_obj(path, v, f):
+    with open(path, 'w') as fp:
+        np.savetxt(fp, v, fmt='v %.6f %.6f %.6f')
+        np.savetxt(fp, v, fmt='vn %.6f %.6f %.6f')
+        np.savetxt(fp, f + 1, fmt='f %d %d %d %d')
+
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="50,200,500",
+        help="grid resolutions, a grid of n has n*n quads")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print("%8s %10s %10s %10s %10s" % ("quads", "old obj", "obj", "ply", "speedup"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in [int(x) for x in args.sizes.split(',')]:
+            v, f = quad_grid(n)
+            obj = Path(tmp) / "grid.obj"
+            ply = Path(tmp) / "grid.ply"
+            write_obj(obj, v, f)
+            mesh_io.write_ply(ply, v, f, v)
+
+            old = read_wavefront(obj)
+            new = mesh_io.read_obj(obj)
+            assert np.allclose(old[0], new.vertices) and np.array_equal(old[1], new.faces)
+
+            t_old = best_of(lambda: read_wavefront(obj), args.repeat)
+            t_obj = best_of(lambda: mesh_io.read_obj(obj), args.repeat)
+            t_ply = best_of(lambda: mesh_io.read_ply(ply), args.repeat)
+            print("%8d %9.4fs %9.4fs %9.4fs %9.1fx" % (len(f), t_old, t_obj, t_ply, t_old / t_obj))
@@ -0,0 +1,193 @@
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+from pathlib import Path
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "preprocessing"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import scanio
+import keypoints
+import laplacian
+import sampling
+from bench_mesh_io import quad_grid, best_of
+
+# Timings of the data preparation hot paths at several sizes, on synthetic
+# data and the bundled dataset/scans/hello* and dataset/pose2d samples. The
+# results are written as json and compared against baseline.json, a case
+# that got slower than the baseline by more than --tolerance fails the run.
+#
+#   python bench_preprocessing.py                  # compare to baseline.json
+#   python bench_preprocessing.py --save-baseline  # after an intended change
+#
+# Timings are machine dependent, refresh the baseline on the machine that
+# runs the comparison. On another machine the ratios are only reported.
+
+BASELINE = Path(__file__).resolve().parent / "baseline.json"
+SIZES = {
+    "xyz": [14707, 100000, 1000000],
+    "keypoints": [100, 1000, 8000],
+    "laplacian": [50, 200, 500],
+    "sampling": [20, 60, 200],
+}
+QUICK = {
+    "xyz": [14707, 100000],
+    "keypoints": [100, 1000],
+    "laplacian": [50, 200],
+    "sampling": [20, 60],
+}
+
+
+def sphere(n):
+    # closed quad sphere with n * n faces, like a fitted body mesh
+    u, w = np.meshgrid(np.linspace(0, 2 * np.pi, n, endpoint=False),
+        np.linspace(.05, np.pi - .05, n + 1), indexing='ij')
+    v = np.stack([np.cos(u) * np.sin(w), np.sin(u) * np.sin(w), np.cos(w)], axis=-1)
+    idx = np.arange(n * (n + 1)).reshape(n, n + 1)
+    f = np.stack([idx[:, :-1], np.roll(idx, -1, 0)[:, :-1], np.roll(idx, -1, 0)[:, 1:],
+        idx[:, 1:]], axis=-1)
+    return v.reshape(-1, 3), f.reshape(-1, 4)
+
+
+def bench_xyz(tmp, sizes, repeat):
+    hello = ROOT / "dataset/scans/hello/hello.xyz"
+    cloud = scanio.read_xyz(hello)
+    for n in sizes:
+        if n == len(cloud):
+            path = hello
+        else:
+            rng = np.random.default_rng(0)
+            path = tmp / ("cloud%d.xyz" % n)
+            scanio.write_xyz(path, cloud[rng.integers(0, len(cloud), n)])
+        scan = tmp / ("cloud%d.scan" % n)
+        scanio.write_scan(scan, scanio.read_xyz(path))
+        yield "xyz.read_xyz", n, best_of(lambda: scanio.read_xyz(path), repeat)
+        yield "xyz.load_scan", n, best_of(lambda: np.array(scanio.load_scan(scan)), repeat)
+        lod = tmp / ("cloud%d_lod.scan" % n)
+        scanio.write_scan(lod, scanio.read_xyz(path), lod=True)
+        yield "xyz.load_scan_1000", n, best_of(lambda: np.array(scanio.load_scan(lod,
+            count=1000)), repeat)
+
+
+def bench_keypoints(tmp, sizes, repeat):
+    files = list(keypoints.find_json(ROOT / "dataset/pose2d"))
+    for n in sizes:
+        if n > len(files):
+            continue
+        subset = [path for _, path in files[:n]]
+        yield "keypoints.read_json", n, best_of(lambda: [keypoints.read_json(x)
+            for x in subset], repeat)
+        # a tree with exactly these files
+        root = tmp / ("pose2d%d" % n)
+        for person, path in files[:n]:
+            (root / person).mkdir(parents=True, exist_ok=True)
+            (root / person / path.name).symlink_to(path)
+
+        def ingest():
+            store = tmp / "keypoints.h5"
+            if store.exists():
+                store.unlink()
+            keypoints.ingest(root, store, processes=4)
+        yield "keypoints.ingest", n, best_of(ingest, 1)
+
+
+def bench_laplacian(tmp, sizes, repeat):
+    for n in sizes:
+        v, f = quad_grid(n)
+        yield "laplacian.quad_laplace", n * n, best_of(lambda: laplacian.quad_laplace(v, f),
+            repeat)
+
+
+def bench_sampling(tmp, sizes, repeat):
+    for n in sizes:
+        v, f = sphere(n)
+        yield "sampling.montecarlo", len(f), best_of(lambda: sampling.sample(v, f, 20000,
+            rng=0), repeat)
+        batch = np.stack([v * s for s in np.linspace(.9, 1.1, 8)])
+        yield "sampling.montecarlo_batch8", len(f), best_of(lambda: sampling.sample(batch,
+            f, 20000, rng=0), repeat)
+        yield "sampling.poisson", len(f), best_of(lambda: sampling.sample(v, f, 20000,
+            poisson=True, rng=0), 1)
+
+
+BENCHMARKS = {
+    "xyz": bench_xyz,
+    "keypoints": bench_keypoints,
+    "laplacian": bench_laplacian,
+    "sampling": bench_sampling,
+}
+
+
+def compare(results, baseline, tolerance, noise=5e-3):
+    # the cases that are slower than the baseline by more than tolerance,
+    # differences below noise seconds are ignored
+    old = {(x["name"], x["size"]): x["seconds"] for x in baseline["results"]}
+    slower = []
+    for x in results:
+        key = (x["name"], x["size"])
+        if key in old:
+            ratio = x["seconds"] / old[key]
+            x["baseline"] = old[key]
+            x["ratio"] = ratio
+            if ratio > 1 + tolerance and x["seconds"] - old[key] > noise:
+                slower.append(x)
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", default=",".join(BENCHMARKS),
+        help="comma separated subset of " + ",".join(BENCHMARKS))
+    parser.add_argument("--quick", action="store_true", help="skip the largest sizes")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None, help="json file for the results")
+    parser.add_argument("--baseline", default=str(BASELINE))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=.3,
+        help="allowed slowdown against the baseline, .3 is 30%%")
+    args = parser.parse_args()
+
+    sizes = QUICK if args.quick else SIZES
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.only.split(','):
+            for case, size, seconds in BENCHMARKS[name](Path(tmp), sizes[name], args.repeat):
+                print("%-30s %10d %10.4fs" % (case, size, seconds))
+                results.append({"name": case, "size": size, "seconds": seconds})
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "machine": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "results": results,
+    }
+
+    failed = []
+    baseline = Path(args.baseline)
+    if args.save_baseline:
+        with open(baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+            f.write('\n')
+        print("saved %s" % baseline)
+    elif baseline.is_file():
+        with open(baseline, 'r') as f:
+            saved = json.load(f)
+        slower = compare(results, saved, args.tolerance)
+        failed = slower
+        if saved.get("machine") != report["machine"]:
+            print("baseline is from %s, not failing on slower cases" % saved.get("machine"))
+            failed = []
+        for x in results:
+            if "ratio" in x:
+                print("%-30s %10d %9.2fx %s" % (x["name"], x["size"], x["ratio"],
+                    "SLOWER" if x in slower else ""))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+            f.write('\n')
+    if failed:
+        sys.exit("%d cases slower than the baseline" % len(failed))
@@ -140,13 +140,26 @@ def project_by_object_utils(cam, point):
 #folder="/media/dl/Volume/dfaust_full/scans_raw/"
 #folder="/media/dl/Volume/dfaust_full/scans/"
 
+import sys
 import json
+import time
 Json = None
 with open(environ['CAM'],'r') as f:
     Json = json.load(f)
 folder="/input"
 outfolder = "/output"
 
+# BATCHED=1 keeps one scan object and one camera per view for the whole run
+# and renders the 8 views of a scan in a single multiview pass. With
+# SCAN_LIST=1 the scans to render are read from stdin, otherwise they are
+# split over processes with SHARD and NUM_SHARDS, every process takes each
+# NUM_SHARDS-th file of the sorted glob.
+batched = environ.get('BATCHED', '0') == '1'
+shard = int(environ.get('SHARD', 0))
+num_shards = int(environ.get('NUM_SHARDS', 1))
+# DEBUG=1 validates every mesh loaded in batched mode
+debug = environ.get('DEBUG', '0') == '1'
+
 p = Path(folder)
 cameras = Json['setup']
 #bpy.data.objects.remove(bpy.data.objects["Cube"],do_unlink=True)
@@ -157,107 +170,173 @@ bpy.context.preferences.addons['cycles'].preferences.devices[0].use = True
 bpy.context.scene.cycles.device = 'GPU'
 bpy.context.scene.cycles.samples = 1
 
-for path in p.glob("**/*.ply"): # REVERT TO PLY
-    rel = path.parent.relative_to(folder)
-    #print(str(f))
-    print(rel)
-    impath = folder + "/" + str(path.stem)
-    
-    imagename = Path(f"{str(path.stem)}_{0}.png")
-    outpath = Path(outfolder,rel,imagename)
-    
-    bpy.ops.import_mesh.ply(filepath=str(path))
-    #bpy.ops.import_scene.obj(filepath=str(path))
-
-    obj = bpy.data.objects[str(path.stem)]
-    #obj = bpy.data.objects["m_mosh_cmu88_Mesh"]
-    #obj = bpy.data.objects["f_mosh_cmu05_Mesh"] #75_Mesh.001
-    #print(bpy.data.materials.get("Material"))
-    #obj.data.materials.append( bpy.data.materials.get("Material") )
-    #obj.active_material_index = 0
-    #obj.active_material.name="Material"
-    mat = bpy.data.materials.get("Material")
-    bpy.context.view_layer.objects.active = obj
-    bpy.ops.object.material_slot_add()
-    obj.material_slots[0].material = mat
-    obj.active_material_index = 0
-    obj.rotation_euler = [0,0,0]
-    
-    layer = bpy.context.view_layer
-    #layer.update()
-
-    PI = 3.141592
-    PH = PI/2
-    PQ = PI/4
-    distance = 2.5
-
-    s = 1
-    w = 1600//s
-    h = 1200//s
-    cx = 790.263706/s
-    cy = 578.90334/s
-    fx = 1498.2242623/s
-    fy = 1498.22426253/s
-    
-    
-    cam = bpy.data.cameras["Camera"]
-    scene = bpy.data.scenes["Scene"]
-    scene.render.resolution_x = w
-    scene.render.resolution_y = h
-    cam.shift_x = -(cx/w - .5)
-    cam.shift_y = -(cy - .5*h)/w
-    print(fx/w)
-    cam.lens = fx / w
-    pixel_aspect = fy/fx
-    scene.render.pixel_aspect_x = 1.0
-    scene.render.pixel_aspect_y = pixel_aspect
-    cam.sensor_width = 1
-    
-    camera = bpy.data.objects["Camera"]
-    #blender_to_opencv(camera.data)
-    
-    for i,jsonCam in enumerate(cameras[0:8]): #4:5
-        #print(jsonCam)
-        m = jsonCam['R']
-        p = Matrix([[0,0,0],[0,0,0],[0,0,0]])
-        for j in range(9):
-            p[j//3][j%3] = m[j]
-        print(p)
-        mat = p @ Euler((PI,0,0)).to_matrix()
-        
-        #camera.location = [distance*sin(angle),-.3,distance*cos(angle)]
-        ax,ang=mat.to_quaternion().to_axis_angle() 
-        camera.location = Vector(jsonCam['t'])
-        camera.rotation_mode = 'AXIS_ANGLE'
-        camera.rotation_axis_angle = [ang,ax[0],ax[1],ax[2]]
-        #camera.location = p @ (-Vector(jsonCam['t']))
-        print(camera.location)
-        print(mat)
-        print(mat.to_quaternion().to_axis_angle())
-        
-        layer.update()
-        P, K, RT = get_3x4_P_matrix_from_blender(camera)
-    
-        imagename = Path(f"{str(path.stem)}_{i}.png")
-        outpath = Path(outfolder,rel,imagename)
-        bpy.context.scene.render.filepath=str(outpath)
-        bpy.ops.render.render(write_still=True, use_viewport=False) #True
-    
-    bpy.data.objects.remove(obj,do_unlink=True)
-    
-    for block in bpy.data.meshes:
-        if block.users == 0:
-            bpy.data.meshes.remove(block)
-
-    for block in bpy.data.materials:
-        if block.users == 0:
-            bpy.data.materials.remove(block)
-
-    for block in bpy.data.textures:
-        if block.users == 0:
-            bpy.data.textures.remove(block)
-
-    for block in bpy.data.images:
-        if block.users == 0:
-            bpy.data.images.remove(block)
-    
+PI = 3.141592
+PH = PI/2
+PQ = PI/4
+distance = 2.5
+
+# the intrinsics are the same for all scans and views
+s = 1
+w = 1600//s
+h = 1200//s
+cx = 790.263706/s
+cy = 578.90334/s
+fx = 1498.2242623/s
+fy = 1498.22426253/s
+
+cam = bpy.data.cameras["Camera"]
+scene = bpy.data.scenes["Scene"]
+scene.render.resolution_x = w
+scene.render.resolution_y = h
+cam.shift_x = -(cx/w - .5)
+cam.shift_y = -(cy - .5*h)/w
+print(fx/w)
+cam.lens = fx / w
+pixel_aspect = fy/fx
+scene.render.pixel_aspect_x = 1.0
+scene.render.pixel_aspect_y = pixel_aspect
+cam.sensor_width = 1
+
+camera = bpy.data.objects["Camera"]
+#blender_to_opencv(camera.data)
+
+def camera_matrix(jsonCam):
+    # 'R' is row major, see cameras.load_rig for the same rig as arrays
+    m = jsonCam['R']
+    return Matrix([m[0:3], m[3:6], m[6:9]]) @ Euler((PI,0,0)).to_matrix()
+
+if environ.get('SCAN_LIST', '0') == '1':
+    # the scan names relative to the input folder on stdin, one per line
+    paths = [p / (x.strip() + ".ply") for x in sys.stdin if x.strip()]
+    print("%d scans from stdin" % len(paths))
+else:
+    paths = sorted(p.glob("**/*.ply"))[shard::num_shards]
+    print("shard %d/%d: %d scans" % (shard, num_shards, len(paths)))
+
+def render_each():
+    for path in paths: # REVERT TO PLY
+        rel = path.parent.relative_to(folder)
+        #print(str(f))
+        start = time.time()
+
+        bpy.ops.import_mesh.ply(filepath=str(path))
+        #bpy.ops.import_scene.obj(filepath=str(path))
+
+        obj = bpy.data.objects[str(path.stem)]
+        #obj = bpy.data.objects["m_mosh_cmu88_Mesh"]
+        #obj = bpy.data.objects["f_mosh_cmu05_Mesh"] #75_Mesh.001
+        mat = bpy.data.materials.get("Material")
+        bpy.context.view_layer.objects.active = obj
+        bpy.ops.object.material_slot_add()
+        obj.material_slots[0].material = mat
+        obj.active_material_index = 0
+        obj.rotation_euler = [0,0,0]
+
+        layer = bpy.context.view_layer
+        #layer.update()
+
+        for i,jsonCam in enumerate(cameras[0:8]): #4:5
+            mat = camera_matrix(jsonCam)
+
+            #camera.location = [distance*sin(angle),-.3,distance*cos(angle)]
+            ax,ang=mat.to_quaternion().to_axis_angle()
+            camera.location = Vector(jsonCam['t'])
+            camera.rotation_mode = 'AXIS_ANGLE'
+            camera.rotation_axis_angle = [ang,ax[0],ax[1],ax[2]]
+            #camera.location = p @ (-Vector(jsonCam['t']))
+
+            layer.update()
+
+            imagename = Path(f"{str(path.stem)}_{i}.png")
+            outpath = Path(outfolder,rel,imagename)
+            bpy.context.scene.render.filepath=str(outpath)
+            bpy.ops.render.render(write_still=True, use_viewport=False) #True
+        print("rendered %s in %.2fs" % (rel / path.stem, time.time() - start))
+
+        bpy.data.objects.remove(obj,do_unlink=True)
+
+        for block in bpy.data.meshes:
+            if block.users == 0:
+                bpy.data.meshes.remove(block)
+
+        for block in bpy.data.materials:
+            if block.users == 0:
+                bpy.data.materials.remove(block)
+
+        for block in bpy.data.textures:
+            if block.users == 0:
+                bpy.data.textures.remove(block)
+
+        for block in bpy.data.images:
+            if block.users == 0:
+                bpy.data.images.remove(block)
+
+def setup_views():
+    # one camera object per view, all sharing the camera data above. In
+    # MULTIVIEW mode the view with camera_suffix _i renders through
+    # Camera_i and writes its image with file_suffix _i.
+    render = scene.render
+    render.use_multiview = True
+    render.views_format = 'MULTIVIEW'
+    render.image_settings.views_format = 'INDIVIDUAL'
+    for view in render.views:
+        view.use = False
+    for i,jsonCam in enumerate(cameras[0:8]):
+        view_camera = bpy.data.objects.new("Camera_%d" % i, cam)
+        scene.collection.objects.link(view_camera)
+        view_camera.matrix_world = Matrix.Translation(Vector(jsonCam['t'])) @ \
+            camera_matrix(jsonCam).to_4x4()
+        view = render.views.new("view_%d" % i)
+        view.camera_suffix = "_%d" % i
+        view.file_suffix = "_%d" % i
+        view.use = True
+    scene.camera = bpy.data.objects["Camera_0"]
+
+def load_ply(mesh, path):
+    # replaces the geometry of mesh with the faces of a ply file
+    v, f, n = read_ply(path)
+    if isinstance(f, np.ndarray):
+        loop_total = np.full(len(f), f.shape[1], dtype=np.int32)
+        loops = f.reshape(-1)
+    else:
+        loop_total = np.array([len(x) for x in f], dtype=np.int32)
+        loops = np.concatenate(f)
+    loop_start = np.concatenate([[0], np.cumsum(loop_total)[:-1]]).astype(np.int32)
+    mesh.clear_geometry()
+    mesh.vertices.add(len(v))
+    mesh.vertices.foreach_set("co", np.asarray(v, dtype=np.float32).reshape(-1))
+    mesh.loops.add(len(loops))
+    mesh.loops.foreach_set("vertex_index", loops.astype(np.int32))
+    mesh.polygons.add(len(loop_total))
+    mesh.polygons.foreach_set("loop_start", loop_start)
+    mesh.polygons.foreach_set("loop_total", loop_total)
+    # smooth shaded like the ply importer makes meshes with vertex normals
+    mesh.polygons.foreach_set("use_smooth", np.full(len(loop_total), n is not None))
+    if debug and mesh.validate(verbose=True):
+        print("fixed invalid geometry in %s" % path)
+    mesh.update(calc_edges=True)
+
+def render_batched():
+    setup_views()
+    mesh = bpy.data.meshes.new("Scan")
+    mesh.materials.append(bpy.data.materials.get("Material"))
+    obj = bpy.data.objects.new("Scan", mesh)
+    scene.collection.objects.link(obj)
+    for path in paths:
+        rel = path.parent.relative_to(folder)
+        start = time.time()
+        load_ply(mesh, path)
+        loaded = time.time()
+        # the view suffix _i is added in front of the extension
+        bpy.context.scene.render.filepath = str(Path(outfolder,rel,path.stem + ".png"))
+        bpy.ops.render.render(write_still=True, use_viewport=False)
+        print("rendered %s in %.2fs (load %.2fs)" % (rel / path.stem, time.time() - start,
+            loaded - start))
+
+if batched:
+    import numpy as np
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    from mesh_io import read_ply
+    render_batched()
+else:
+    render_each()
@@ -4,13 +4,63 @@ bl_info = {
     "blender": (2, 80, 0)
 }
 
+import os
+import sys
+import time
+import argparse
+import subprocess
 import bpy
 import fnmatch
 import mathutils
+import numpy as np
 from bpy.app.handlers import persistent
 
 in_g = False
 
+# "vectorized" sets all pose corrective shape keys in one pass per update
+# from a handler, "scripted" keeps one python driver per shape key
+POSE_DRIVERS = os.environ.get("POSE_DRIVERS", "vectorized")
+pose_table = None
+
+jointnames = [
+    "m_root",
+    "m_chest",
+    "m_neck",
+    
+    "m_chest.001",
+    "m_rupperarm",
+    "m_rlowerarm",
+    "m_rhand",
+    "m_rthumb",
+    "m_rthumb-proximal",
+    "m_rhand.001",
+    "m_rfist",
+    "m_rfist.001",
+    "m_rfist.002",
+    "m_rfist.003",
+    
+    "m_chest.002",
+    "m_lupperarm",
+    "m_llowerarm",
+    "m_lhand",
+    "m_lthumb",
+    "m_lthumb-proximal",
+    "m_lhand.001",
+    "m_lfist",
+    "m_lfist.001",
+    "m_lfist.002",
+    "m_lfist.003",
+    
+    
+    "m_chest.003",
+    "m_hip",
+    "m_pelvis",
+    "m_rupperleg",
+    "m_rlowerleg",
+    "m_pelvis.001",
+    "m_lupperleg",
+    "m_llowerleg"]
+
 @persistent
 def handler(scene):
     global in_g
@@ -19,60 +69,140 @@ def handler(scene):
     #if last(bpy.data.objects,"joints*").data.is_updated:
     g()
 
+# last() results by (item type, pattern) -> (collection size, name). An
+# entry is used while the collection has the same size and still holds an
+# item of that name that matches the pattern. The handler drops all of them
+# when a file is loaded, when objects or armatures are added or removed and
+# when the depsgraph updates one whose name is not in the index, which is
+# the case after a rename.
+last_index = {}
+last_counts = None
+
 def last(objects, regex):
+    if len(objects) == 0:
+        raise KeyError("no %s in an empty collection" % regex)
+    key = (type(objects[0]).__name__, regex)
+    entry = last_index.get(key)
+    if entry is not None and entry[0] == len(objects):
+        obj = objects.get(entry[1])
+        if obj is not None and fnmatch.fnmatchcase(obj.name, regex):
+            return obj
     result = [obj for obj in objects if fnmatch.fnmatchcase(obj.name, regex)]
-    return sorted(result,key=lambda x:x.name)[-1]
-def f():
-    import mathutils
-    from math import radians
-    def M(x,y,z,i):
-        R = mathutils.Euler((x,y,z),'XYZ')
-        M = R.to_matrix()
-        v = M[i//3][i%3]
-        #v = M[i%3][i//3]
-        v = v - 1 if i % 4 == 0 else v    
-        return v
+    obj = sorted(result,key=lambda x:x.name)[-1]
+    last_index[key] = (len(objects), obj.name)
+    return obj
+
+@persistent
+def last_handler(scene=None, depsgraph=None):
+    global last_counts
+    counts = (len(bpy.data.objects), len(bpy.data.armatures))
+    if counts != last_counts or depsgraph is None:
+        last_index.clear()
+        last_counts = counts
+        return
+    names = set(entry[1] for entry in last_index.values())
+    for update in depsgraph.updates:
+        if isinstance(update.id, (bpy.types.Object, bpy.types.Armature)) and \
+                update.id.name not in names:
+            last_index.clear()
+            return
+
+def rotation_matrices(bones, order):
+    # (J, 3, 3) local rotations of the pose bones at the indices order, the
+    # same matrix the drivers rebuild from ROT_X/Y/Z in LOCAL_SPACE
+    n = len(bones)
+    q = np.empty(4 * n)
+    e = np.empty(3 * n)
+    bones.foreach_get("rotation_quaternion", q)
+    bones.foreach_get("rotation_euler", e)
+    q = q.reshape(n, 4)[order]
+    e = e.reshape(n, 3)[order]
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+    w, x, y, z = q.T
+    R = np.stack([
+        1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y),
+        2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x),
+        2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)], axis=1).reshape(-1, 3, 3)
+    modes = [bones[i].rotation_mode for i in order]
+    euler = np.array([m == 'XYZ' for m in modes])
+    if euler.any():
+        cx, cy, cz = np.cos(e[euler]).T
+        sx, sy, sz = np.sin(e[euler]).T
+        # Rz @ Ry @ Rx like mathutils.Euler((x,y,z),'XYZ').to_matrix()
+        R[euler] = np.stack([
+            cy*cz, sx*sy*cz - cx*sz, cx*sy*cz + sx*sz,
+            cy*sz, sx*sy*sz + cx*cz, cx*sy*sz - sx*cz,
+            -sy, sx*cy, cx*cy], axis=1).reshape(-1, 3, 3)
+    for j, m in enumerate(modes):
+        if m not in ('QUATERNION', 'XYZ'):
+            R[j] = bones[order[j]].matrix_basis.to_quaternion().to_matrix()
+    return R
+
+def setup_pose_correctives(mesh, skeleton, start, stop):
+    # index table from pose shape keys to (joint, matrix element), M() of
+    # the scripted drivers for pose%05d is joint i//9 and element i%9
+    global pose_table
+    blocks = mesh.data.shape_keys.key_blocks
+    keys = np.array([blocks.find("pose" + format(i+9, '05')) for i in range(start, stop)])
+    joints = np.array([i // 9 for i in range(start, stop)])
+    elements = np.array([i % 9 for i in range(start, stop)])
+    order = np.array([skeleton.pose.bones.find("Skeleton_" + x) for x in jointnames])
+    pose_table = (mesh.name, skeleton.name, keys, joints, elements, order, None)
+    bpy.app.handlers.frame_change_post.append(pose_handler)
+    bpy.app.handlers.depsgraph_update_post.append(pose_handler)
+    update_pose_correctives()
+
+def remove_pose_correctives():
+    # True if the handler was installed
+    global pose_table
+    pose_table = None
+    found = False
+    for handlers in (bpy.app.handlers.frame_change_post, bpy.app.handlers.depsgraph_update_post):
+        for h in [h for h in handlers if h.__name__ == "pose_handler"]:
+            handlers.remove(h)
+            found = True
+    return found
+
+def update_pose_correctives():
+    # all pose corrective weights of the current pose as one foreach_set
+    global pose_table
+    if pose_table is None:
+        return
+    meshname, skeletonname, keys, joints, elements, order, previous = pose_table
+    mesh = bpy.data.objects.get(meshname)
+    skeleton = bpy.data.objects.get(skeletonname)
+    if mesh is None or skeleton is None:
+        return
+    R = rotation_matrices(skeleton.pose.bones, order)
+    weights = (R - np.eye(3)).reshape(-1, 9)[joints, elements]
+    # writing tags the depsgraph again, an unchanged pose ends the cycle
+    if previous is not None and np.array_equal(weights, previous):
+        return
+    blocks = mesh.data.shape_keys.key_blocks
+    values = np.empty(len(blocks), dtype=np.float32)
+    blocks.foreach_get("value", values)
+    values[keys] = weights
+    blocks.foreach_set("value", values)
+    pose_table = pose_table[:-1] + (weights,)
+    mesh.data.shape_keys.update_tag()
+    mesh.data.update_tag()
 
+@persistent
+def pose_handler(scene, depsgraph=None):
+    if in_g:
+        return
+    update_pose_correctives()
+def M(x,y,z,i):
+    R = mathutils.Euler((x,y,z),'XYZ')
+    M = R.to_matrix()
+    v = M[i//3][i%3]
+    #v = M[i%3][i//3]
+    v = v - 1 if i % 4 == 0 else v    
+    return v
+
+def f():
     bpy.app.driver_namespace['M'] = M
     
-    jointnames = [
-        "m_root",
-        "m_chest",
-        "m_neck",
-        
-        "m_chest.001",
-        "m_rupperarm",
-        "m_rlowerarm",
-        "m_rhand",
-        "m_rthumb",
-        "m_rthumb-proximal",
-        "m_rhand.001",
-        "m_rfist",
-        "m_rfist.001",
-        "m_rfist.002",
-        "m_rfist.003",
-        
-        "m_chest.002",
-        "m_lupperarm",
-        "m_llowerarm",
-        "m_lhand",
-        "m_lthumb",
-        "m_lthumb-proximal",
-        "m_lhand.001",
-        "m_lfist",
-        "m_lfist.001",
-        "m_lfist.002",
-        "m_lfist.003",
-        
-        
-        "m_chest.003",
-        "m_hip",
-        "m_pelvis",
-        "m_rupperleg",
-        "m_rlowerleg",
-        "m_pelvis.001",
-        "m_lupperleg",
-        "m_llowerleg"]
         
     #{ "m_pelvis","m_hip",-1 },
 
@@ -103,7 +233,6 @@ def f():
 
     #skeleton = bpy.data.objects["proxy"] #.pose.bones[bonename].rotation_euler
     skeleton = last(bpy.data.objects,"proxy*")
-    mesh = last(bpy.data.objects,"test*")
     
     names = [x.name for x in bpy.data.shape_keys]
     shapekeys = mesh.data.shape_keys
@@ -121,7 +250,8 @@ def f():
             dcount += len(keys.animation_data.drivers)
         shapekey.driver_remove("value", -1)
     #old_drivers = mesh.animation_data.drivers
-    state = dcount > 0
+    # an installed handler of the vectorized mode counts like the drivers
+    state = remove_pose_correctives() or dcount > 0
     #state = True
     if not state:
         for j in range(20):
@@ -150,7 +280,9 @@ def f():
             x.targets[0].data_path = 'shape_keys.key_blocks["' + name + '"].value'
             driver.expression = "x"
         
-    if not state:
+    if not state and POSE_DRIVERS == "vectorized":
+        setup_pose_correctives(mesh, skeleton, start, stop)
+    elif not state:
         for i in range(start,stop): #144
             name = "pose"+format(i+9,'05')
             shapekey = shapekeys.key_blocks[name] #last(shapekeys,"Key*")
@@ -195,47 +327,18 @@ def f():
     #bpy.app.handlers.depsgraph_update_post.append(handler)
      
             
+def joint_positions(obj):
+    # (V, 3) coordinates of the evaluated joints mesh, built once
+    dg = bpy.context.evaluated_depsgraph_get()
+    me = bpy.data.meshes.new_from_object(obj.evaluated_get(dg))
+    co = np.empty(3 * len(me.vertices), dtype=np.float32)
+    me.vertices.foreach_get("co", co)
+    bpy.data.meshes.remove(me)
+    return co.reshape(-1, 3)
+
 def g():
     global in_g
     in_g = True
-    jointnames = [
-        "m_root",
-        "m_chest",
-        "m_neck",
-        
-        "m_chest.001",
-        "m_rupperarm",
-        "m_rlowerarm",
-        "m_rhand",
-        "m_rthumb",
-        "m_rthumb-proximal",
-        "m_rhand.001",
-        "m_rfist",
-        "m_rfist.001",
-        "m_rfist.002",
-        "m_rfist.003",
-        
-        "m_chest.002",
-        "m_lupperarm",
-        "m_llowerarm",
-        "m_lhand",
-        "m_lthumb",
-        "m_lthumb-proximal",
-        "m_lhand.001",
-        "m_lfist",
-        "m_lfist.001",
-        "m_lfist.002",
-        "m_lfist.003",
-        
-        
-        "m_chest.003",
-        "m_hip",
-        "m_pelvis",
-        "m_rupperleg",
-        "m_rlowerleg",
-        "m_pelvis.001",
-        "m_lupperleg",
-        "m_llowerleg"]
         
     #hide = [
     #    "m_root",
@@ -246,63 +349,63 @@ def g():
     #]
     hide=[]
     
-    temp = bpy.context.view_layer.objects.active
-    pos = []
-    obj = last(bpy.data.objects,"joints*")
-    #bpy.context.view_layer.objects.active = obj
-    #bpy.ops.object.mode_set(mode='EDIT')
-    for i in range(len(jointnames)):
-        #v = obj.data.vertices[i]
-        dg = bpy.context.evaluated_depsgraph_get()
-        #me = obj.to_mesh(depsgraph=dg,preserve_all_data_layers=True)
-        active_eval = obj.evaluated_get(dg)
-        me = bpy.data.meshes.new_from_object(active_eval)
-        v = me.vertices[i]
-        p = v.co
-        print(f"{i} {p.xyz}")
-        pos.append(p.xyz)
-        bpy.data.meshes.remove(me)
-    #bpy.ops.object.mode_set(mode='OBJECT')
-    #bpy.context.view_layer.objects.active = temp
+    pos = joint_positions(last(bpy.data.objects,"joints*"))[:len(jointnames)]
     
     temp = bpy.context.view_layer.objects.active
     skeleton = last(bpy.data.objects,"proxy*")
-    #print(dir(skeleton))
+    armature = last(bpy.data.armatures,"proxy*")
     bpy.context.view_layer.objects.active = skeleton
     bpy.ops.object.mode_set(mode='EDIT')
-    for i in range(len(jointnames)):
-        jointname = "Skeleton_" + jointnames[i]
-        armature = last(bpy.data.armatures,"proxy*")
-        if jointnames[i] in hide:
-            armature.bones[jointname].hide = True
-        #skeleton.show_x_ray = True
-        
-        #armature.draw_type = 'STICK'
-        bones = armature.edit_bones
-        joint = bones[jointname]
-        
-        scene = bpy.context.scene
-        
-        dg = bpy.context.evaluated_depsgraph_get()
-        
-        p = pos[i]
-            
-        #print(dir(p))
-        #print(p) 
-        #print(joint.head.xyz) 
-        print(p.xyz)
-        joint.head.xyz = p.xyz 
-        joint.tail.xyz = p.xyz
-        joint.tail.y = p.y + .1#.00002
-        #print(joint.head.xyz) 
-        #obj.to_mesh_clear()
-        #bpy.data.meshes.remove(me)
-    dg = bpy.context.evaluated_depsgraph_get().update()
+    for x in hide:
+        armature.bones["Skeleton_" + x].hide = True
+    
+    # heads on the joints and tails .1 above them, for all bones at once
+    bones = armature.edit_bones
+    index = [bones.find("Skeleton_" + x) for x in jointnames]
+    head = np.empty(3 * len(bones), dtype=np.float32)
+    tail = np.empty(3 * len(bones), dtype=np.float32)
+    bones.foreach_get("head", head)
+    bones.foreach_get("tail", tail)
+    head = head.reshape(-1, 3)
+    tail = tail.reshape(-1, 3)
+    head[index] = pos
+    tail[index] = pos + [0, .1, 0]
+    bones.foreach_set("head", head.ravel())
+    bones.foreach_set("tail", tail.ravel())
+    # foreach_set skips the rna update that moves the tail of the parent of
+    # a connected bone along with its head, so those heads are assigned one
+    # by one like before
+    for k, i in enumerate(index):
+        if bones[i].use_connect:
+            bones[i].head = pos[k]
+    
     bpy.ops.object.mode_set(mode='OBJECT')
     bpy.context.view_layer.objects.active = temp
-        #bpy.
     
     in_g = False
+
+def delete_model():
+    # the imported hierarchy under base*, with its pose correctives
+    remove_pose_correctives()
+    bpy.ops.object.select_all(action='DESELECT')
+    base = last(bpy.data.objects,"base*") 
+    base.select_set(state = True)
+    for c in base.children:
+        c.select_set(state = True)
+    bpy.ops.object.delete()
+
+def process_fbx(paths, output, scale=100):
+    # headless f() and g() for every model, saved as <output>/<name>.blend
+    os.makedirs(output, exist_ok=True)
+    for path in paths:
+        start = time.time()
+        bpy.ops.import_scene.fbx(filepath=path, global_scale=scale)
+        f()
+        g()
+        target = os.path.join(output, os.path.splitext(os.path.basename(path))[0] + ".blend")
+        bpy.ops.wm.save_as_mainfile(filepath=target, copy=True)
+        delete_model()
+        print("%s: %.2fs" % (target, time.time() - start))
     
 class ObjectMoveX(bpy.types.Operator): 
     """My Object Moving Script"""      # blender will use this as a tooltip for menu items and buttons.
@@ -327,79 +430,83 @@ class ChangeJoints(bpy.types.Operator):
 
         return {'FINISHED'}            # this lets blender know the operator finished successfully.
 
+def pose_bones():
+    # the pose bones of the skeleton and the indices of jointnames in them
+    skeleton = last(bpy.data.objects,"proxy*")
+    bones = skeleton.pose.bones
+    return bones, np.array([bones.find("Skeleton_" + x) for x in jointnames])
+
+def dump_poses(paths, output, frames=range(2,51), scale=100):
+    # quaternions (w, x, y, z) of all frames of all models, one after the
+    # other, as an array (frames, joints, 4) in output
+    poses = []
+    for path in paths:
+        start = time.time()
+        bpy.ops.import_scene.fbx(filepath=path, global_scale=scale)
+        bpy.ops.object.move_x()
+        bpy.ops.object.changejoints()
+        bones, index = pose_bones()
+        q = np.empty(4 * len(bones), dtype=np.float32)
+        for t in frames:
+            bpy.context.scene.frame_set(t)
+            bones.foreach_get("rotation_quaternion", q)
+            poses.append(q.reshape(-1, 4)[index])
+        delete_model()
+        print("%s: %d frames in %.2fs" % (path, len(frames), time.time() - start))
+    poses = np.stack(poses) if poses else np.zeros([0, len(jointnames), 4], np.float32)
+    np.save(output, poses)
+    return poses
+
+def replay_poses(path, output, frames=None, shard=0, num_shards=1):
+    # renders frame t of the poses as <output>/<t>.png, this process takes
+    # every num_shards-th frame starting at shard
+    poses = np.load(path)
+    frames = range(len(poses)) if frames is None else frames
+    bpy.app.driver_namespace['M'] = M
+    if POSE_DRIVERS == "vectorized" and pose_table is None:
+        # handlers are not saved with the .blend, same range as f()
+        setup_pose_correctives(last(bpy.data.objects,"test*"),
+            last(bpy.data.objects,"proxy*"), 9, 9*len(jointnames)-9)
+    bones, index = pose_bones()
+    for i in index:
+        bones[i].rotation_mode = "QUATERNION"
+    q = np.empty(4 * len(bones), dtype=np.float32)
+    bones.foreach_get("rotation_quaternion", q)
+    q = q.reshape(-1, 4)
+    scene = bpy.context.scene
+    for t in list(frames)[shard::num_shards]:
+        start = time.time()
+        q[index] = poses[t]
+        bones.foreach_set("rotation_quaternion", q.ravel())
+        update_pose_correctives()
+        bpy.context.view_layer.update()
+        scene.render.filepath = os.path.join(output, '%06d' % t)
+        bpy.ops.render.render(write_still=True)
+        print("frame %d: %.2fs" % (t, time.time() - start))
+
+def replay_parallel(path, output, processes, threads=0):
+    # replay_poses in separate blender processes on the current .blend
+    if not bpy.data.filepath:
+        raise RuntimeError("replay_parallel needs a saved .blend, the processes load it from disk")
+    if bpy.data.is_dirty:
+        print("unsaved changes of %s are not replayed" % bpy.data.filepath)
+    commands = [[bpy.app.binary_path, "-b", bpy.data.filepath, "-t", str(threads),
+        "-P", os.path.abspath(__file__), "--", "replay", path, "--output", output,
+        "--shard", str(k), "--num-shards", str(processes)] for k in range(processes)]
+    running = [subprocess.Popen(command) for command in commands]
+    failed = [p.args for p in running if p.wait() != 0]
+    for command in failed:
+        print("failed: %s" % " ".join(command))
+    return not failed
+
 class Dump(bpy.types.Operator):
     bl_idname = "object.dump"        # unique identifier for buttons and menu items to reference.
     bl_label = "Dump"         # display name in the interface.
     bl_options = {'REGISTER', 'UNDO'}  # enable undo for the operator.
 
     def execute(self, context):        # execute() is called by blender when running the operator.
-        jointnames = [
-        "m_root",
-        "m_chest",
-        "m_neck",
-        
-        "m_chest.001",
-        "m_rupperarm",
-        "m_rlowerarm",
-        "m_rhand",
-        "m_rthumb",
-        "m_rthumb-proximal",
-        "m_rhand.001",
-        "m_rfist",
-        "m_rfist.001",
-        "m_rfist.002",
-        "m_rfist.003",
-        
-        "m_chest.002",
-        "m_lupperarm",
-        "m_llowerarm",
-        "m_lhand",
-        "m_lthumb",
-        "m_lthumb-proximal",
-        "m_lhand.001",
-        "m_lfist",
-        "m_lfist.001",
-        "m_lfist.002",
-        "m_lfist.003",
-        
-        
-        "m_chest.003",
-        "m_hip",
-        "m_pelvis",
-        "m_rupperleg",
-        "m_rlowerleg",
-        "m_pelvis.001",
-        "m_lupperleg",
-        "m_llowerleg"]
-        f = open('pose.csv','w+')
-        #g= open('shape.csv','w+')
-        
-        for i in range(10):
-            bpy.ops.import_scene.fbx(filepath="/media/dl/Volume/out_scaled_comp/p%d_261binZYX.fbx" % i,
-                global_scale = 100)            
-            bpy.ops.object.move_x()
-            bpy.ops.object.changejoints()
-            
-            for t in range(2,51):
-                bpy.context.scene.frame_set(t)
-                for x in jointnames:
-                    jointname = "Skeleton_%s" % x
-                    skeleton = last(bpy.data.objects,"proxy*")
-                    rot = skeleton.pose.bones[jointname].rotation_quaternion
-                    loc = skeleton.pose.bones[jointname].location
-                    if x == "Skeleton_m_root":
-                        f.write("%f,%f,%f," % (loc.x, loc.y, loc.z))
-                    f.write("%f,%f,%f,%f," % (rot.w, rot.x, rot.y, rot.z))
-                    print(rot)
-                f.write('\n')
-            
-            base = last(bpy.data.objects,"base*") 
-            base.select_set(state = True)
-            for c in base.children:
-                c.select_set(state = True)
-            bpy.ops.object.delete()
-            
-        f.close()
+        dump_poses(["/media/dl/Volume/out_scaled_comp/p%d_261binZYX.fbx" % i for i in range(10)],
+            'pose.npy')
         return {'FINISHED'}            # this lets blender know the operator finished successfully.
 
 class Sample(bpy.types.Operator):
@@ -408,83 +515,9 @@ class Sample(bpy.types.Operator):
     bl_options = {'REGISTER', 'UNDO'}  # enable undo for the operator.
 
     def execute(self, context):        # execute() is called by blender when running the operator.
-        jointnames = [
-        "m_root",
-        "m_chest",
-        "m_neck",
-        
-        "m_chest.001",
-        "m_rupperarm",
-        "m_rlowerarm",
-        "m_rhand",
-        "m_rthumb",
-        "m_rthumb-proximal",
-        "m_rhand.001",
-        "m_rfist",
-        "m_rfist.001",
-        "m_rfist.002",
-        "m_rfist.003",
-        
-        "m_chest.002",
-        "m_lupperarm",
-        "m_llowerarm",
-        "m_lhand",
-        "m_lthumb",
-        "m_lthumb-proximal",
-        "m_lhand.001",
-        "m_lfist",
-        "m_lfist.001",
-        "m_lfist.002",
-        "m_lfist.003",
-        
-        
-        "m_chest.003",
-        "m_hip",
-        "m_pelvis",
-        "m_rupperleg",
-        "m_rlowerleg",
-        "m_pelvis.001",
-        "m_lupperleg",
-        "m_llowerleg"]
-        f = open('pose.csv','r')
-        #g= open('shape.csv','w+')
-        
-        for i in range(1):
-            #bpy.ops.import_scene.fbx(filepath="/media/dl/Volume/out_scaled_comp/p%d_261binZYX.fbx" % i,
-            #    global_scale = 100)            
-            #bpy.ops.object.move_x()
-            #bpy.ops.object.changejoints()
-            
-            for t in range(500):
-                frame = [float(x) for x in f.readline()[:-2].split(',')]
-                print (t)
-                print (frame)
-                #bpy.context.scene.frame_set(t)
-                #bpy.ops.object.mode_set(mode='POSE')
-                for j,x in enumerate(jointnames):
-                    jointname = "Skeleton_%s" % x
-                    skeleton = last(bpy.data.objects,"proxy*")
-                    print([x.name for x in bpy.data.objects])
-                    skeleton.pose.bones[jointname].rotation_mode = "QUATERNION"
-                    skeleton.pose.bones[jointname].rotation_quaternion = mathutils.Quaternion(
-                        (frame[4*j+0],frame[4*j+1],frame[4*j+2],frame[4*j+3])
-                    )
-                    #print(skeleton.pose.bones[jointname].rotation_quaternion)
-                    #skeleton.pose.bones[jointname].rotation_quaternion = mathutils.Quaternion(
-                    #    (1,0,0,0)
-                    #)
-                #skeleton.pose.update()
-                bpy.context.scene.update()
-                bpy.data.scenes['Scene'].render.filepath = '/media/dl/DATA/renders/%06d' % t
-                bpy.ops.render.render(write_still=True)
-        
-        f.close()
-        return {'FINISHED'}   
-        base = last(bpy.data.objects,"base*") 
-        base.select_set(state = True)
-        for c in base.children:
-            c.select_set(state = True)
-        bpy.ops.object.delete()
+        scene = context.scene
+        replay_poses('pose.npy', '/media/dl/DATA/renders',
+            range(scene.frame_start, scene.frame_end + 1))
         return {'FINISHED'}            # this lets blender know the operator finished successfully.
 
 
@@ -493,18 +526,58 @@ def register():
     bpy.utils.register_class(ChangeJoints)
     bpy.utils.register_class(Dump)
     bpy.utils.register_class(Sample)
+    bpy.app.handlers.depsgraph_update_post.append(last_handler)
+    bpy.app.handlers.load_post.append(last_handler)
 
 
 def unregister():
     bpy.utils.unregister_class(ObjectMoveX)
     bpy.utils.unregister_class(ChangeJoints)
     bpy.utils.unregister_class(Dump)
-    bpy.utils.register_class(Sample)
+    bpy.utils.unregister_class(Sample)
+    bpy.app.handlers.depsgraph_update_post.remove(last_handler)
+    bpy.app.handlers.load_post.remove(last_handler)
+    last_index.clear()
 
 
 # This allows you to run the script directly from blenders text editor
 # to test the addon without having to install it.
+#
+#   blender -b scene.blend -P blender_script_deform.py -- process models/*.fbx --output out
+#   blender -b scene.blend -P blender_script_deform.py -- dump models/*.fbx --output poses.npy
+#   blender -b out/model.blend -P blender_script_deform.py -- replay poses.npy \
+#       --output renders --processes 4
 if __name__ == "__main__":
     register()
-
- 
+    if "--" in sys.argv:
+        parser = argparse.ArgumentParser(prog="blender_script_deform.py")
+        commands = parser.add_subparsers(dest="command", required=True)
+        process = commands.add_parser("process", help="apply f() and g() to every model")
+        process.add_argument("fbx", nargs="+", help="models to import one after another")
+        process.add_argument("--output", required=True, help="folder for the .blend files")
+        process.add_argument("--scale", type=float, default=100)
+        dump = commands.add_parser("dump", help="export the animated poses of the models")
+        dump.add_argument("fbx", nargs="+")
+        dump.add_argument("--output", required=True, help=".npy file (frames, joints, 4)")
+        dump.add_argument("--first", type=int, default=2, help="first frame of every model")
+        dump.add_argument("--last", type=int, default=50, help="last frame of every model")
+        dump.add_argument("--scale", type=float, default=100)
+        replay = commands.add_parser("replay", help="render the poses on the opened model")
+        replay.add_argument("poses", help=".npy file written by dump")
+        replay.add_argument("--output", required=True, help="folder for the rendered frames")
+        replay.add_argument("--processes", type=int, default=1,
+            help="blender processes that render in parallel")
+        replay.add_argument("--threads", type=int, default=0,
+            help="render threads per process, 0 for all cores")
+        replay.add_argument("--shard", type=int, default=0)
+        replay.add_argument("--num-shards", type=int, default=1)
+        args = parser.parse_args(sys.argv[sys.argv.index("--") + 1:])
+        if args.command == "process":
+            process_fbx(args.fbx, args.output, args.scale)
+        elif args.command == "dump":
+            dump_poses(args.fbx, args.output, range(args.first, args.last + 1), args.scale)
+        elif args.processes > 1:
+            if not replay_parallel(args.poses, args.output, args.processes, args.threads):
+                sys.exit(1)
+        else:
+            replay_poses(args.poses, args.output, shard=args.shard, num_shards=args.num_shards)
@@ -0,0 +1,156 @@
+import os
+import shutil
+import sqlite3
+import hashlib
+import threading
+import time
+from pathlib import Path
+
+# Content addressed store for stage outputs. A key is the hash of the
+# stage name, the contents of all input files (scans, filter scripts,
+# camera files, ...) and extra parameters such as the docker image tag.
+# The outputs of a finished job are copied into objects/<key>/ and put
+# back when a later job asks for the same key. Outputs that were written
+# for the current key and did not change since are not copied at all.
+# The store is bounded by max_bytes and evicts the least recently used
+# entries. File hashes are memoized by (size, mtime), so unchanged inputs
+# are only hashed once.
+
+CACHE_VERSION = 1
+
+
+class Cache:
+    def __init__(self, root, max_bytes=50 << 30):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.root / "index.sqlite"), check_same_thread=False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT);
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, stage TEXT, files INTEGER, size INTEGER,
+                last_used REAL);
+            CREATE TABLE IF NOT EXISTS current (
+                path TEXT PRIMARY KEY, key TEXT, size INTEGER, mtime INTEGER);''')
+        self.db.commit()
+        self.hits = {}
+        self.misses = {}
+
+    def digest(self, path):
+        path = Path(path)
+        st = path.stat()
+        name = str(path.resolve())
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime, digest FROM hashes WHERE path=?",
+                (name,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?,?,?,?)",
+                (name, st.st_size, st.st_mtime_ns, h.hexdigest()))
+            self.db.commit()
+        return h.hexdigest()
+
+    def key(self, stage, inputs=(), params=()):
+        h = hashlib.sha1()
+        h.update(b"%d\0%s\0" % (CACHE_VERSION, stage.encode()))
+        for path in inputs:
+            h.update(self.digest(path).encode() + b"\0")
+        for param in params:
+            h.update(str(param).encode() + b"\0")
+        return h.hexdigest()
+
+    def _objects(self, key, outputs):
+        folder = self.root / "objects" / key[:2] / key
+        return [folder / ("%d%s" % (i, path.suffix)) for i, path in enumerate(outputs)]
+
+    def _touch(self, key):
+        self.db.execute("UPDATE entries SET last_used=? WHERE key=?", (time.time(), key))
+
+    def _record(self, key, outputs):
+        for path in outputs:
+            st = path.stat()
+            self.db.execute("INSERT OR REPLACE INTO current VALUES (?,?,?,?)",
+                (str(path.resolve()), key, st.st_size, st.st_mtime_ns))
+
+    def _count(self, counter, stage):
+        counter[stage] = counter.get(stage, 0) + 1
+
+    def fetch(self, stage, key, outputs):
+        # True if the outputs now hold the artifact of key
+        outputs = [Path(x) for x in outputs]
+        with self.lock:
+            current = True
+            for path in outputs:
+                row = self.db.execute("SELECT key, size, mtime FROM current WHERE path=?",
+                    (str(path.resolve()),)).fetchone()
+                if not path.exists() or row is None or row[0] != key or \
+                        row[1:] != (path.stat().st_size, path.stat().st_mtime_ns):
+                    current = False
+                    break
+            if not current:
+                row = self.db.execute("SELECT files FROM entries WHERE key=?",
+                    (key,)).fetchone()
+                objects = self._objects(key, outputs)
+                if row is None or row[0] != len(outputs) or \
+                        not all(x.is_file() for x in objects):
+                    self._count(self.misses, stage)
+                    return False
+                for source, path in zip(objects, outputs):
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copyfile(source, path)
+                self._record(key, outputs)
+            self._touch(key)
+            self.db.commit()
+            self._count(self.hits, stage)
+        return True
+
+    def store(self, stage, key, outputs):
+        outputs = [Path(x) for x in outputs]
+        objects = self._objects(key, outputs)
+        objects[0].parent.mkdir(parents=True, exist_ok=True)
+        for path, target in zip(outputs, objects):
+            tmp = target.with_name(target.name + ".tmp")
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, target)
+        size = sum(x.stat().st_size for x in objects)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?)",
+                (key, stage, len(outputs), size, time.time()))
+            self._record(key, outputs)
+            self.db.commit()
+            self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.db.execute(
+                "SELECT key, size FROM entries ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.root / "objects" / key[:2] / key, ignore_errors=True)
+            self.db.execute("DELETE FROM entries WHERE key=?", (key,))
+            total -= size
+        self.db.commit()
+
+    def size(self):
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def report(self):
+        # (stage, hits, misses) of this session
+        stages = sorted(set(self.hits) | set(self.misses))
+        return [(stage, self.hits.get(stage, 0), self.misses.get(stage, 0))
+            for stage in stages]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,86 @@
+import json
+import numpy as np
+
+# The camera rig of blender_render.py as plain arrays. Every entry of the
+# 'setup' list in cameras.json / caesar_cameras.json has the row major
+# rotation 'R' from OpenCV camera axes (x right, y down, z forward) to world
+# axes and the camera centre 't'. The intrinsics are fixed in
+# blender_render.py and the same for every camera.
+
+WIDTH = 1600
+HEIGHT = 1200
+FX = 1498.2242623
+FY = 1498.22426253
+CX = 790.263706
+CY = 578.90334
+VIEWS = 8
+
+
+def intrinsics():
+    # K of the rendered images. blender_render.py sets shift_y from CY
+    # measured from the bottom of the image, so rows counted from the top
+    # have their principal point at HEIGHT - CY.
+    return np.array([[FX, 0, CX],
+                     [0, FY, HEIGHT - CY],
+                     [0, 0, 1]])
+
+
+def load_rig(path, views=VIEWS):
+    # returns K (C, 3, 3), R (C, 3, 3) camera to world and t (C, 3)
+    with open(path, 'r') as f:
+        setup = json.load(f)['setup'][:views]
+    R = np.array([c['R'] for c in setup], dtype=np.float64).reshape(-1, 3, 3)
+    t = np.array([c['t'] for c in setup], dtype=np.float64).reshape(-1, 3)
+    K = np.repeat(intrinsics()[None], len(setup), axis=0)
+    return K, R, t
+
+
+def extrinsics(R, t):
+    # world to camera [R^T | -R^T t] of shape (C, 3, 4)
+    Rt = np.transpose(R, (0, 2, 1))
+    return np.concatenate([Rt, -np.einsum('cij,cj->ci', Rt, t)[:, :, None]], axis=2)
+
+
+def projection_matrices(K, R, t):
+    # P = K [R^T | -R^T t] of shape (C, 3, 4), the same as K @ RT from
+    # get_3x4_P_matrix_from_blender
+    return np.einsum('cij,cjk->cik', K, extrinsics(R, t))
+
+
+def to_camera(points, R, t):
+    # world points (N, 3) to camera coordinates (C, N, 3)
+    return np.einsum('nj,cji->cni', points, R) - np.einsum('cj,cji->ci', t, R)[:, None]
+
+
+def project(points, K, R, t):
+    # pixel coordinates (C, N, 2) and depths (C, N) of world points (N, 3)
+    # in every camera, x to the right and y down from the top left corner
+    cam = to_camera(np.asarray(points, dtype=np.float64).reshape(-1, 3), R, t)
+    z = cam[:, :, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        uv = np.einsum('cij,cnj->cni', K[:, :2, :2], cam[:, :, :2] / z[:, :, None]) + \
+            K[:, None, :2, 2]
+    return uv, z
+
+
+def visible(uv, z, width=WIDTH, height=HEIGHT, depth=None, tol=1e-2):
+    # (C, N) mask of the points in front of the camera and inside the image.
+    # With depth maps (C, height, width), like the ones of raster.rasterize,
+    # points more than tol behind the rendered surface count as occluded.
+    mask = (z > 0) & (uv[..., 0] >= 0) & (uv[..., 0] < width) & \
+        (uv[..., 1] >= 0) & (uv[..., 1] < height)
+    if depth is not None:
+        c, n = np.nonzero(mask)
+        x = uv[c, n, 0].astype(np.int64)
+        y = uv[c, n, 1].astype(np.int64)
+        mask[c, n] = z[c, n] <= depth[c, y, x] + tol
+    return mask
+
+
+def reprojection_error(points, uv, K, R, t, mask=None):
+    # pixel distances (C, N) between the projections of points (N, 3) and
+    # observations uv (C, N, 2), nan where mask is False
+    projected, z = project(points, K, R, t)
+    error = np.linalg.norm(projected - uv, axis=2)
+    valid = z > 0 if mask is None else mask & (z > 0)
+    return np.where(valid, error, np.nan)
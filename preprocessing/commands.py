@@ -0,0 +1,29 @@
+# Docker images and command templates shared by preprocess.py and
+# stream.py. The image tags are part of the cache keys. Both run from the
+# repository root, the scripts are mounted from $(pwd)/preprocessing.
+
+MESHLAB_IMAGE = "hamzamerzic/meshlab"
+BLENDER_IMAGE = "nytimes/blender:2.82-gpu-ubuntu18.04"
+OPENPOSE_IMAGE = "joms/openpose:latest"
+
+# The renderers get the scans to render, one name per line without .ply,
+# on stdin, so that they render exactly the scans the job declares.
+
+# input, output, camera file, batched, gpu, image, scan names
+blenderCommandTemplate = '''docker run --rm -i \
+-v %s:/input \
+-v %s:/output \
+-v $(pwd)/JOMS/template_human/:/template \
+-e CAM=/template/%s \
+-e BATCHED=%d -e SCAN_LIST=1 \
+-v $(pwd)/preprocessing:/blendfiles \
+--gpus '"device=%s"' %s \
+bash -c "/blendfiles/run_in_blender.sh" <<'EOF'
+%s
+EOF'''
+
+# input, output, camera file, scan names
+rasterCommandTemplate = '''python preprocessing/raster.py %s %s \
+--cameras JOMS/template_human/%s --scans - <<'EOF'
+%s
+EOF'''
@@ -0,0 +1,239 @@
+import os
+import json
+import pickle
+import argparse
+from pathlib import Path
+from multiprocessing import Pool
+import numpy as np
+from scipy.spatial import cKDTree
+
+import scanio
+import sampling
+from mesh_io import read_mesh
+
+# Fit quality of meshes evaluated from weights/*_model against the scans in
+# dataset/scans/<person>/<scan>.xyz (or .scan). The k-d tree of every scan
+# is built once and pickled next to it as <scan>.kdtree together with the
+# size and mtime of the scan, a changed scan rebuilds it.
+#
+# Meshes are read from <meshes>/<person>/<scan>.npy with the (V, 3)
+# vertices, e.g. saved from model.Model.pose, with the faces of --faces,
+# or from <scan>.ply / .obj. Per scan the metrics are, in scan units:
+#
+#   model_to_scan      mean point to plane distance of points on the mesh
+#                      to the scan surface (nearest scan point and normal)
+#   scan_to_model      mean distance of the scan points to the mesh surface,
+#                      exact point to triangle distances
+#   *_p95              95th percentiles of the above
+#   normal             mean dot product of mesh and nearest scan normals
+#
+# Without faces the mesh points are its vertices, scan_to_model is the
+# distance to the nearest vertex and normal is null.
+#
+#   python fitquality.py dataset/scans fits --faces template.obj --output fit.json
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".kdtree"
+SAMPLES = 20000
+
+_indices = {}
+
+
+def load_index(path):
+    # (tree, normals) of a scan, from memory, from <scan>.kdtree or built
+    path = Path(path)
+    st = path.stat()
+    stamp = (INDEX_VERSION, st.st_size, st.st_mtime_ns)
+    cached = _indices.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1:]
+    target = path.with_name(path.name + INDEX_SUFFIX)
+    if target.is_file():
+        with open(target, 'rb') as f:
+            saved = pickle.load(f)
+        if saved["stamp"] == stamp:
+            _indices[path] = (stamp, saved["tree"], saved["normals"])
+            return _indices[path][1:]
+    cloud = scanio.load_scan(path)
+    tree = cKDTree(np.asarray(cloud[:, :3], dtype=np.float64))
+    # the scan normals are not always unit length
+    normals = np.array(cloud[:, 3:6], dtype=np.float32)
+    length = np.linalg.norm(normals, axis=1, keepdims=True)
+    normals = np.divide(normals, length, out=np.zeros_like(normals), where=length > 0)
+    tmp = target.with_name(target.name + ".tmp")
+    with open(tmp, 'wb') as f:
+        pickle.dump({"stamp": stamp, "tree": tree, "normals": normals}, f,
+            protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, target)
+    _indices[path] = (stamp, tree, normals)
+    return tree, normals
+
+
+def surface(vertices, faces=None, count=SAMPLES, rng=0):
+    # points and normals (B, N, 3) on meshes (B, V, 3) with shared faces
+    if faces is None:
+        return vertices, None
+    cloud = sampling.sample(vertices, faces, count, rng=rng)
+    return cloud[..., :3], cloud[..., 3:]
+
+
+def closest_on_triangles(p, a, b, c):
+    # closest points (..., 3) to p on the triangles abc, the region tests
+    # of Ericson, Real-Time Collision Detection 5.1.5
+    dot = lambda x, y: np.einsum('...i,...i->...', x, y)[..., None]
+    ab, ac, ap, bp, cp = b - a, c - a, p - a, p - b, p - c
+    d1, d2, d3, d4, d5, d6 = dot(ab, ap), dot(ac, ap), dot(ab, bp), dot(ac, bp), \
+        dot(ab, cp), dot(ac, cp)
+    va, vb, vc = d3 * d6 - d5 * d4, d5 * d2 - d1 * d6, d1 * d4 - d3 * d2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denom = va + vb + vc
+        x = a + ab * (vb / denom) + ac * (vc / denom)
+        # the earlier regions win, so they are applied last
+        x = np.where((va <= 0) & (d4 >= d3) & (d5 >= d6),
+            b + (c - b) * ((d4 - d3) / ((d4 - d3) + (d5 - d6))), x)
+        x = np.where((vb <= 0) & (d2 >= 0) & (d6 <= 0), a + ac * (d2 / (d2 - d6)), x)
+        x = np.where((d6 >= 0) & (d5 <= d6), c, x)
+        x = np.where((vc <= 0) & (d1 >= 0) & (d3 <= 0), a + ab * (d1 / (d1 - d3)), x)
+        x = np.where((d3 >= 0) & (d4 <= d3), b, x)
+        x = np.where((d1 <= 0) & (d2 <= 0), a, x)
+    return x
+
+
+def surface_distance(queries, vertices, faces, k=8):
+    # distances of queries (N, 3) to the surface of a triangle mesh. The k
+    # triangles with the nearest centroids are tested first, a point whose
+    # k-th centroid is not farther than its distance plus the largest
+    # centroid to corner distance tests every triangle in that ball.
+    triangles = np.asarray(vertices, dtype=np.float64)[faces]
+    centroids = triangles.mean(axis=1)
+    radius = np.linalg.norm(triangles - centroids[:, None], axis=2).max()
+    tree = cKDTree(centroids)
+    k = min(k, len(faces))
+    near_distance, near = tree.query(queries, k)
+    near_distance = near_distance.reshape(len(queries), k)
+    near = near.reshape(len(queries), k)
+
+    def distance(points, candidates):
+        t = triangles[candidates]
+        x = closest_on_triangles(points[..., None, :], t[..., 0, :], t[..., 1, :], t[..., 2, :])
+        d = np.linalg.norm(x - points[..., None, :], axis=-1)
+        # degenerate triangles give nan
+        return np.where(np.isnan(d), np.inf, d).min(axis=-1)
+
+    d = distance(queries, near)
+    if k < len(faces):
+        for i in np.flatnonzero(near_distance[:, -1] <= d + radius):
+            d[i] = distance(queries[i], tree.query_ball_point(queries[i], d[i] + radius))
+    return d
+
+
+def metrics(scan, points, normals=None, vertices=None, faces=None):
+    # metrics of mesh points (N, 3) and their normals against one scan, the
+    # scan to model distance is taken to the faces if there are any
+    tree, scan_normals = load_index(scan)
+    _, nearest = tree.query(points)
+    plane = np.abs(np.einsum('ij,ij->i', points - tree.data[nearest], scan_normals[nearest]))
+    if faces is None:
+        back, _ = cKDTree(points).query(tree.data)
+    else:
+        back = surface_distance(tree.data, vertices, faces)
+    result = {
+        "model_to_scan": float(plane.mean()),
+        "model_to_scan_p95": float(np.percentile(plane, 95)),
+        "scan_to_model": float(back.mean()),
+        "scan_to_model_p95": float(np.percentile(back, 95)),
+        "normal": None,
+    }
+    if normals is not None:
+        result["normal"] = float(np.einsum('ij,ij->i', normals, scan_normals[nearest]).mean())
+    return result
+
+
+def load_meshes(folder, names, faces=None):
+    # (vertices, faces) of the meshes of names, None if missing. Meshes
+    # from .ply / .obj keep their own faces, .npy meshes get faces.
+    meshes = []
+    for name in names:
+        path = next((folder / (name + x) for x in (".npy", ".ply", ".obj")
+            if (folder / (name + x)).is_file()), None)
+        if path is None:
+            meshes.append(None)
+        elif path.suffix == ".npy":
+            meshes.append((np.load(path), faces))
+        else:
+            mesh = read_mesh(path)
+            meshes.append((mesh.vertices, sampling.triangulate(mesh.faces)))
+    return meshes
+
+
+def evaluate_person(params):
+    # the metrics of all scans of a person folder, meshes with identical
+    # faces are sampled as one batch
+    scans, meshes, faces, count = params
+    paths = sorted([x for x in scans.iterdir() if x.suffix in (".xyz", scanio.SUFFIX)])
+    loaded = load_meshes(meshes, [x.stem for x in paths], faces)
+    groups = {}
+    for i, mesh in enumerate(loaded):
+        if mesh is not None:
+            v, f = mesh
+            topology = (v.shape, None if f is None else (f.shape, f.tobytes()))
+            groups.setdefault(topology, []).append(i)
+    results = {}
+    for members in groups.values():
+        f = loaded[members[0]][1]
+        points, normals = surface(np.stack([loaded[i][0] for i in members]), f, count)
+        for k, i in enumerate(members):
+            results[paths[i].stem] = metrics(paths[i], points[k],
+                None if normals is None else normals[k], loaded[i][0], f)
+    return scans.name, dict(sorted(results.items()))
+
+
+def evaluate_tree(scans, meshes, faces=None, persons=None, count=SAMPLES, processes=None):
+    # {person: {scan: metrics}} over the person folders, in parallel
+    scans = Path(scans)
+    meshes = Path(meshes)
+    folders = [x for x in sorted(scans.iterdir()) if x.is_dir()]
+    if persons:
+        folders = [x for x in folders if x.name in persons]
+    params = [(x, meshes / x.name, faces, count) for x in folders]
+    results = {}
+    with Pool(processes=processes or os.cpu_count()) as p:
+        for person, values in p.imap_unordered(evaluate_person, params):
+            results[person] = values
+            if values:
+                normal = [x["normal"] for x in values.values() if x["normal"] is not None]
+                print("%s: %d scans, model to scan %.4f, scan to model %.4f, normal %.3f" % (
+                    person, len(values),
+                    np.mean([x["model_to_scan"] for x in values.values()]),
+                    np.mean([x["scan_to_model"] for x in values.values()]),
+                    np.mean(normal) if normal else np.nan))
+    return results
+
+
+def read_faces(path):
+    if path is None:
+        return None
+    if Path(path).suffix == ".npy":
+        return sampling.triangulate(np.load(path))
+    return sampling.triangulate(read_mesh(path).faces)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scans", help="folder with <person>/<scan>.xyz or .scan files")
+    parser.add_argument("meshes", help="folder with <person>/<scan>.npy, .ply or .obj meshes")
+    parser.add_argument("--faces", default=None,
+        help=".npy, .obj or .ply with the faces of the .npy meshes")
+    parser.add_argument("--persons", default="", help="comma separated, all by default")
+    parser.add_argument("--count", type=int, default=SAMPLES,
+        help="points sampled on every mesh")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--output", default=None, help="json file for the metrics")
+    args = parser.parse_args()
+    persons = [x.strip() for x in args.persons.split(',') if x.strip()]
+    results = evaluate_tree(args.scans, args.meshes, read_faces(args.faces), persons,
+        args.count, args.processes)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+            f.write('\n')
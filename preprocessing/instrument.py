@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import argparse
+import threading
+import subprocess
+from pathlib import Path
+
+# Per item measurements of the preprocessing stages as JSON lines. Every
+# command runs through run_command, which waits for it with wait4 to get
+# the cpu time and peak RSS of the command and everything it waited for.
+# Containers run under the docker daemon, so for docker stages these cover
+# the client only, while wall time and the file sizes still hold. Bytes
+# read and written are the sizes of the declared inputs and outputs, GPU
+# time is the wall time of jobs that held a gpu, times the gpus they held.
+#
+#   python instrument.py dataset/metrics.jsonl --top 5
+
+# what one output of a stage is, for the throughput
+UNITS = {"render": "images", "openpose": "images", "stream": "images"}
+
+
+def run_command(command):
+    # like subprocess.call(command, shell=True), returns (exit code, usage)
+    process = subprocess.Popen(command, shell=True)
+    start = time.time()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, {
+        "wall": time.time() - start,
+        "cpu_user": usage.ru_utime,
+        "cpu_system": usage.ru_stime,
+        # kilobytes on linux
+        "max_rss_kb": usage.ru_maxrss,
+    }
+
+
+def file_bytes(paths):
+    total = 0
+    for path in paths:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+
+class Metrics:
+    def __init__(self, path, run=None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.run = run or "%s-%d" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+        self.lock = threading.Lock()
+        self.file = open(self.path, "a")
+
+    def record(self, job, status, started, usage=None, device=None, batch=1):
+        # usage of a batch command is shared evenly by its items
+        usage = usage or {"wall": 0.0}
+        item = {
+            "run": self.run,
+            "stage": job.stage,
+            "key": job.key,
+            "status": status,
+            "device": None if device is None else str(device),
+            "started": started,
+            "finished": time.time(),
+            "batch": batch,
+            "outputs": len(job.outputs),
+            "bytes_read": file_bytes(getattr(job, "inputs", [])),
+            "bytes_written": file_bytes(job.outputs),
+        }
+        for name, value in usage.items():
+            item[name] = value / batch if name != "max_rss_kb" else value
+        # a device list like "0,1" (the stream stage) occupies every gpu in it
+        item["gpu_seconds"] = None if device is None else \
+            item["wall"] * len(str(device).split(","))
+        with self.lock:
+            self.file.write(json.dumps(item) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def load(path, run=None):
+    # the records of one run, the last run in the file by default
+    with open(path, "r") as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    if run is None and items:
+        run = items[-1]["run"]
+    return [x for x in items if x["run"] == run]
+
+
+def report(items, top=3):
+    lines = []
+    stages = []
+    for item in items:
+        if item["stage"] not in stages:
+            stages.append(item["stage"])
+    for stage in stages:
+        rows = [x for x in items if x["stage"] == stage]
+        done = [x for x in rows if x["status"] == "done"]
+        cached = sum(1 for x in rows if x["status"] == "cached")
+        failed = sum(1 for x in rows if x["status"] == "failed")
+        unit = UNITS.get(stage, "scans")
+        lines.append("%s: %d done, %d cached, %d failed" % (stage, len(done), cached, failed))
+        if not done:
+            continue
+        # throughput over the time the stage was busy, concurrency included
+        span = max(x["finished"] for x in done) - min(x["started"] for x in done)
+        count = sum(max(x["outputs"], 1) for x in done)
+        cpu = sum(x.get("cpu_user", 0) + x.get("cpu_system", 0) for x in done)
+        gpu = sum(x["gpu_seconds"] or 0 for x in done)
+        lines.append("  %.2f %s/s over %.1fs, total %.1fs wall, %.1fs cpu, %.1fs gpu" % (
+            count / max(span, 1e-9), unit, span, sum(x["wall"] for x in done), cpu, gpu))
+        lines.append("  peak rss %.1f MB, read %.1f MB, written %.1f MB" % (
+            max(x.get("max_rss_kb", 0) for x in done) / 1024,
+            sum(x["bytes_read"] for x in done) / 2**20,
+            sum(x["bytes_written"] for x in done) / 2**20))
+        for x in sorted(done, key=lambda x: -x["wall"])[:top]:
+            lines.append("  slow %s %.2fs" % (x["key"], x["wall"]))
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("metrics", help="jsonl file written by preprocess.py --metrics")
+    parser.add_argument("--run", default=None, help="run id, the last run by default")
+    parser.add_argument("--top", type=int, default=5, help="slowest items per stage")
+    args = parser.parse_args()
+    items = load(args.metrics, args.run)
+    if items:
+        print("run %s" % items[0]["run"])
+    for line in report(items, args.top):
+        print(line)
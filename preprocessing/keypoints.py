@@ -0,0 +1,232 @@
+import os
+import json
+import argparse
+from pathlib import Path
+from multiprocessing import Pool
+import numpy as np
+import h5py
+
+# Packs the OpenPose output in dataset/pose2d/<person>/<scan>_<camera>_keypoints.json
+# into one HDF5 file. Every detection is one row of the chunked part arrays
+# (pose, face, hand_left, hand_right) with (x, y, confidence) per keypoint and
+# a mask that is False for keypoints OpenPose did not find. The index group
+# maps (person, scan, camera) to the rows [start, start+count) of its view,
+# views without any detection have count 0. The index also keeps the size
+# and mtime of the json file of every view, a view whose file changed gets
+# its detections appended again and its index entry pointed at them.
+
+PARTS = {
+    "pose": 25,
+    "face": 70,
+    "hand_left": 21,
+    "hand_right": 21,
+}
+CHUNK = 1024
+SUFFIX = "_keypoints.json"
+
+
+def parse_name(path):
+    # hips.000059_3_keypoints.json -> ("hips.000059", 3)
+    scan, camera = Path(path).name[:-len(SUFFIX)].rsplit("_", 1)
+    return scan, int(camera)
+
+
+def read_json(path):
+    with open(path, "r") as f:
+        people = json.load(f)["people"]
+    parts = {}
+    for part, size in PARTS.items():
+        values = np.zeros([len(people), size, 3], dtype=np.float32)
+        for i, person in enumerate(people):
+            flat = person.get(part + "_keypoints_2d", [])
+            if len(flat):
+                values[i] = np.asarray(flat, dtype=np.float32).reshape(size, 3)
+        parts[part] = values
+    return parts
+
+
+def _read(params):
+    person, path = params
+    scan, camera = parse_name(path)
+    return person, scan, camera, read_json(path)
+
+
+def _create(f):
+    for part, size in PARTS.items():
+        f.create_dataset(part, shape=(0, size, 3), maxshape=(None, size, 3),
+            dtype=np.float32, chunks=(CHUNK, size, 3), compression="lzf")
+        f.create_dataset(part + "_mask", shape=(0, size), maxshape=(None, size),
+            dtype=bool, chunks=(CHUNK, size), compression="lzf")
+    index = f.create_group("index")
+    for name, dtype in [("person", h5py.string_dtype()), ("scan", h5py.string_dtype()),
+            ("camera", np.uint8), ("start", np.int64), ("count", np.int32)]:
+        index.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype,
+            chunks=(CHUNK,))
+    _create_stamps(index)
+
+
+def _create_stamps(index):
+    # stores from before the stamps get -1, their views are taken as they
+    # are and stamped on the next ingest
+    n = index["person"].shape[0]
+    for name in ("size", "mtime"):
+        index.create_dataset(name, shape=(n,), maxshape=(None,), dtype=np.int64,
+            chunks=(CHUNK,), fillvalue=-1)
+
+
+def _append(dataset, values):
+    n = dataset.shape[0]
+    dataset.resize(n + len(values), axis=0)
+    dataset[n:] = values
+
+
+def find_json(root, persons=None):
+    root = Path(root)
+    folders = [root / x for x in persons] if persons else sorted(root.iterdir())
+    for folder in folders:
+        if not folder.is_dir():
+            continue
+        for path in sorted(folder.glob("*" + SUFFIX)):
+            yield folder.name, path
+
+
+def ingest(root, store, persons=None, processes=None):
+    # adds every view below root that is not in the store yet and replaces
+    # the views whose json file changed, returns the number of views read
+    store = Path(store)
+    with h5py.File(store, "a") as f:
+        if "index" not in f:
+            _create(f)
+        index = f["index"]
+        if "size" not in index:
+            _create_stamps(index)
+        known = {key: i for i, key in enumerate(zip(index["person"].asstr()[:],
+            index["scan"].asstr()[:], index["camera"][:].tolist()))}
+        stamps = np.stack([index["size"][:], index["mtime"][:]], axis=1)
+        todo, positions, stamped = [], [], {}
+        for person, path in find_json(root, persons):
+            scan, camera = parse_name(path)
+            st = path.stat()
+            stamp = (st.st_size, st.st_mtime_ns)
+            i = known.get((person, scan, camera))
+            if i is not None and stamps[i, 0] < 0:
+                stamped[i] = stamp
+            elif i is None or tuple(stamps[i]) != stamp:
+                todo.append((person, path))
+                positions.append((i, stamp))
+        for i, stamp in stamped.items():
+            stamps[i] = stamp
+        if not todo:
+            if stamped:
+                index["size"][:] = stamps[:, 0]
+                index["mtime"][:] = stamps[:, 1]
+            return 0
+
+        with Pool(processes=processes or os.cpu_count()) as p:
+            views = p.map(_read, todo, chunksize=64)
+
+        # the detections are appended, changed views leave their old rows behind
+        start = f["pose"].shape[0]
+        starts, counts = [], []
+        for person, scan, camera, parts in views:
+            count = parts["pose"].shape[0]
+            starts.append(start)
+            counts.append(count)
+            start += count
+        for part in PARTS:
+            values = np.concatenate([v[3][part] for v in views])
+            _append(f[part], values)
+            _append(f[part + "_mask"], values[:, :, 2] > 0)
+        new = [k for k, (i, _) in enumerate(positions) if i is None]
+        changed = [k for k, (i, _) in enumerate(positions) if i is not None]
+        if changed:
+            rows = [positions[k][0] for k in changed]
+            start_values = index["start"][:]
+            count_values = index["count"][:]
+            start_values[rows] = [starts[k] for k in changed]
+            count_values[rows] = [counts[k] for k in changed]
+            stamps[rows] = [positions[k][1] for k in changed]
+            index["start"][:] = start_values
+            index["count"][:] = count_values
+        index["size"][:] = stamps[:, 0]
+        index["mtime"][:] = stamps[:, 1]
+        _append(index["person"], [views[k][0] for k in new])
+        _append(index["scan"], [views[k][1] for k in new])
+        _append(index["camera"], np.array([views[k][2] for k in new], dtype=np.uint8))
+        _append(index["start"], np.array([starts[k] for k in new], dtype=np.int64))
+        _append(index["count"], np.array([counts[k] for k in new], dtype=np.int32))
+        _append(index["size"], np.array([positions[k][1][0] for k in new], dtype=np.int64))
+        _append(index["mtime"], np.array([positions[k][1][1] for k in new], dtype=np.int64))
+    return len(views)
+
+
+class KeypointStore:
+    def __init__(self, path):
+        self.file = h5py.File(path, "r")
+        index = self.file["index"]
+        persons = index["person"].asstr()[:]
+        scans = index["scan"].asstr()[:]
+        cameras = index["camera"][:]
+        self.start = index["start"][:]
+        self.count = index["count"][:]
+        self.keys = list(zip(persons, scans, cameras.tolist()))
+        self._lookup = {key: i for i, key in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._lookup
+
+    def persons(self):
+        return sorted(set(key[0] for key in self.keys))
+
+    def scans(self, person):
+        return sorted(set(key[1] for key in self.keys if key[0] == person))
+
+    def rows(self, person, scan, camera):
+        i = self._lookup[(person, scan, camera)]
+        return slice(int(self.start[i]), int(self.start[i] + self.count[i]))
+
+    def view(self, person, scan, camera, part="pose"):
+        # all detections of one image, shape (detections, keypoints, 3)
+        rows = self.rows(person, scan, camera)
+        return self.file[part][rows], self.file[part + "_mask"][rows]
+
+    def scan(self, person, scan, cameras=range(8), part="pose", detection=0):
+        # one detection per camera stacked to (cameras, keypoints, 3), views
+        # without that detection come back fully masked
+        size = PARTS[part]
+        values = np.zeros([len(cameras), size, 3], dtype=np.float32)
+        mask = np.zeros([len(cameras), size], dtype=bool)
+        for c, camera in enumerate(cameras):
+            key = (person, scan, camera)
+            if key not in self._lookup:
+                continue
+            rows = self.rows(*key)
+            if rows.stop - rows.start > detection:
+                values[c] = self.file[part][rows.start + detection]
+                mask[c] = self.file[part + "_mask"][rows.start + detection]
+        return values, mask
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", help="folder with <person>/*_keypoints.json")
+    parser.add_argument("store", help="hdf5 file, created if missing")
+    parser.add_argument("--persons", default="",
+        help="comma separated person folders, all folders by default")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+    persons = [x.strip() for x in args.persons.split(',') if x.strip()]
+    n = ingest(args.root, args.store, persons, args.processes)
+    print("added %d views to %s" % (n, args.store))
@@ -0,0 +1,95 @@
+import argparse
+from pathlib import Path
+import numpy as np
+import scipy.sparse as sparse
+
+from mesh_io import read_obj
+
+# Vectorized version of quadLaplace from Laplacian.ipynb. All per face
+# quantities are computed as (F, ...) batches and the operators are kept
+# sparse, so memory grows linearly with the number of quads.
+# See http://ddg.math.uni-goettingen.de/pub/Polygonal_Laplace.pdf, (5).
+
+
+def face_matrices(v, f, tol=1e-13):
+    # returns the 4x4 matrices M_f of shape (F, 4, 4) and the face areas
+    corners = v[f]
+    following = np.roll(corners, -1, axis=1)
+    E = following - corners
+    B = .5 * (following + corners)
+    A = np.einsum('fki,fkj->fij', E, B)
+    faceArea = np.linalg.norm(A, axis=(1, 2)) / np.sqrt(2)
+
+    Mcurl = np.einsum('fik,fjk->fij', B, B) / faceArea[:, None, None]
+    nv = np.stack([-A[:, 1, 2], A[:, 0, 2], -A[:, 0, 1]], axis=1)
+    n = nv / np.linalg.norm(nv, axis=1, keepdims=True)
+    xbar = corners - np.einsum('fki,fi->fk', corners, n)[:, :, None] * n[:, None, :]
+    Ebar = np.roll(xbar, -1, axis=1) - xbar
+
+    # the rows of VT beyond the numerical rank span the kernel of Ebar^T
+    _, sigma, VT = np.linalg.svd(np.transpose(Ebar, (0, 2, 1)), full_matrices=True)
+    ns = (sigma >= tol).sum(axis=1)
+    weight = 2.0 * (np.arange(4)[None, :] >= ns[:, None])
+    M1 = Mcurl + np.einsum('fki,fk,fkj->fij', VT, weight, VT)
+    return M1, faceArea
+
+
+def difference_operator(f, nv):
+    # d of shape (4F, V), row 4f+i is the edge from corner i to corner i+1
+    F = f.shape[0]
+    rows = np.repeat(np.arange(4 * F), 2)
+    cols = np.stack([f, np.roll(f, -1, axis=1)], axis=2).reshape(-1)
+    data = np.tile([-1.0, 1.0], 4 * F)
+    return sparse.csr_matrix((data, (rows, cols)), shape=(4 * F, nv))
+
+
+def block_diagonal(blocks):
+    F = blocks.shape[0]
+    return sparse.bsr_matrix((blocks, np.arange(F), np.arange(F + 1)),
+        shape=(4 * F, 4 * F))
+
+
+def quad_laplace(v, f):
+    v = np.asarray(v, dtype=np.float64)
+    f = np.asarray(f, dtype=np.int64)
+    M1, faceArea = face_matrices(v, f)
+    # upper cholesky factors A_f^T with M_f = A_f A_f^T
+    M1_factored = np.transpose(np.linalg.cholesky(M1), (0, 2, 1))
+
+    valence = np.bincount(f.reshape(-1), minlength=v.shape[0])
+    share = np.repeat(faceArea, 4) / valence[f.reshape(-1)]
+    M0 = np.bincount(f.reshape(-1), weights=share, minlength=v.shape[0])
+    D = np.zeros_like(M0)
+    np.reciprocal(M0, out=D, where=M0 != 0)
+
+    d = difference_operator(f, v.shape[0])
+    L_weak = (d.T @ block_diagonal(M1) @ d).tocsr()
+    L_strong = (sparse.diags(D) @ L_weak).tocsr()
+    L_graph = (d.T @ d).tocsr()
+    L_sqrt = (block_diagonal(M1_factored) @ d).tocsr()
+    return L_weak, L_strong, L_graph, L_sqrt, M1_factored
+
+
+def write_laplacian(path, M1_factored):
+    # laplacian.txt holds the row major factors, one value per line. A .npy
+    # path stores the same (F, 4, 4) array in binary form instead.
+    path = Path(path)
+    if path.suffix == '.npy':
+        np.save(path, np.ascontiguousarray(M1_factored))
+        return
+    values = np.asarray(M1_factored, dtype=np.float64).reshape(-1).tolist()
+    with open(path, 'w') as File:
+        File.write('\n'.join(map(repr, values)))
+        File.write('\n')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mesh", help="quad-only template mesh (.obj)")
+    parser.add_argument("output", nargs="?", default="laplacian.txt")
+    args = parser.parse_args()
+    v, f, _ = read_obj(args.mesh)
+    if not isinstance(f, np.ndarray) or f.shape[1] != 4:
+        raise SystemExit("%s is not a quad mesh" % args.mesh)
+    L_weak, L_strong, L_graph, L_sqrt, M1_sqrt = quad_laplace(v, f)
+    write_laplacian(args.output, M1_sqrt)
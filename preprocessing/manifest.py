@@ -0,0 +1,325 @@
+import os
+import time
+import sqlite3
+import hashlib
+import argparse
+from pathlib import Path
+
+import scanio
+
+# Embedded sqlite manifest of the dataset: every person and scan of the
+# experiment, every file the stages produce for them with size, mtime and
+# optionally a sha1, and the per scan status of the stages from the ledger.
+# sync() only lists the person folders whose mtime changed since the last
+# sync, in the others it stats the known files, which catches outputs that
+# were rewritten in place. full=True lists every folder. Selections like
+# all scans of a person without view 5 are then indexed queries instead of
+# directory walks. Packed dataset/scans/<person>.scan files get one row per
+# scan with the path <file>#<scan>.
+#
+#   python manifest.py sync experiment.txt
+#   python manifest.py missing view --view 5 --person 50002
+#   python manifest.py summary
+
+PERSON_CONFIGS = Path("JOMS/person_configs")
+CAMERA_PATHS = ["cameras.json", "caesar_cameras.json"]
+
+# kind -> (folder with <person>/ subfolders, file suffixes)
+KINDS = {
+    "scan": ("dataset/scans", (".xyz", scanio.SUFFIX)),
+    "poisson": ("dataset/poisson", (".ply",)),
+    "view": ("dataset/flat_images", (".png",)),
+    "keypoints": ("dataset/pose2d", ("_keypoints.json",)),
+    "joints": ("dataset/joints3d", (".npy",)),
+}
+VIEW_KINDS = ("view", "keypoints")
+
+
+def read_experiment(path):
+    # (persons, camera ids, person config suffixes) of an experiment file
+    persons, camera_ids, suffixes = [], [], []
+    with open(path, 'r') as f:
+        for line in f.readlines():
+            if line.startswith("person_ids"):
+                persons = [x.strip() for x in line[line.index('=')+1:].split(',')]
+            elif line.startswith("person_fist"):
+                camera_ids = [int(x.strip()) for x in line[line.index('=')+1:].split(',')]
+            elif line.startswith("person_config_suffixes"):
+                suffixes = [x.strip() for x in line[line.index('=')+1:].split(',')]
+    return persons, camera_ids, suffixes
+
+
+def scan_names(person, suffix, configs=PERSON_CONFIGS):
+    with open(Path(configs) / ("%s_%s.txt" % (person, suffix)), 'r') as f:
+        return [x.strip() for x in f.readlines()[2:] if x.strip()]
+
+
+def shard_scans(names, shard, count):
+    # the scans of render shard k of n, preprocess.py hands them to the
+    # renderer and sync_ledger maps the shard's ledger row back to them
+    return sorted(names, key=lambda x: x + ".ply")[shard::count]
+
+
+def parse_name(kind, name):
+    # (scan, view) of a file name, None if it does not belong to kind
+    suffix = next((x for x in KINDS[kind][1] if name.endswith(x)), None)
+    if suffix is None:
+        return None
+    stem = name[:-len(suffix)]
+    if kind not in VIEW_KINDS:
+        return stem, None
+    scan, _, view = stem.rpartition('_')
+    if not scan or not view.isdigit():
+        return None
+    return scan, int(view)
+
+
+def sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest:
+    def __init__(self, path, root="."):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.root = Path(root)
+        self.db = sqlite3.connect(str(path))
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS persons (
+                person TEXT PRIMARY KEY, suffix TEXT, camera TEXT);
+            CREATE TABLE IF NOT EXISTS scans (
+                person TEXT, scan TEXT, PRIMARY KEY (person, scan));
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, kind TEXT, person TEXT, scan TEXT, view INTEGER,
+                size INTEGER, mtime INTEGER, digest TEXT);
+            CREATE INDEX IF NOT EXISTS files_scan ON files (kind, person, scan, view);
+            CREATE TABLE IF NOT EXISTS folders (
+                path TEXT PRIMARY KEY, mtime INTEGER);
+            CREATE TABLE IF NOT EXISTS status (
+                stage TEXT, person TEXT, scan TEXT, status TEXT, updated REAL,
+                PRIMARY KEY (stage, person, scan));
+            CREATE INDEX IF NOT EXISTS status_scan ON status (person, scan);''')
+        self.db.commit()
+
+    def add_experiment(self, path, configs=PERSON_CONFIGS):
+        persons, camera_ids, suffixes = read_experiment(path)
+        for i, (person, suffix) in enumerate(zip(persons, suffixes)):
+            camera = CAMERA_PATHS[camera_ids[i]] if i < len(camera_ids) else None
+            self.add_person(person, suffix, camera, scan_names(person, suffix, configs))
+        return persons
+
+    def add_person(self, person, suffix=None, camera=None, scans=()):
+        self.db.execute("INSERT OR REPLACE INTO persons VALUES (?,?,?)",
+            (person, suffix, camera))
+        self.db.executemany("INSERT OR IGNORE INTO scans VALUES (?,?)",
+            [(person, scan) for scan in scans])
+        self.db.commit()
+
+    def persons(self):
+        return [x[0] for x in self.db.execute("SELECT person FROM persons ORDER BY person")]
+
+    def scans(self, person):
+        return [x[0] for x in self.db.execute(
+            "SELECT scan FROM scans WHERE person=? ORDER BY scan", (person,))]
+
+    def configured_scans(self, person, configs=PERSON_CONFIGS):
+        # the scans of the person config, None without one
+        row = self.db.execute("SELECT suffix FROM persons WHERE person=?", (person,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        try:
+            return scan_names(person, row[0], configs)
+        except FileNotFoundError:
+            return None
+
+    def _sync_folder(self, kind, person, folder, full, digest):
+        # returns the number of added or changed files
+        try:
+            mtime = folder.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        row = self.db.execute("SELECT mtime FROM folders WHERE path=?",
+            (str(folder),)).fetchone()
+        known = {path: (size, mtime_) for path, size, mtime_ in self.db.execute(
+            "SELECT path, size, mtime FROM files WHERE kind=? AND person=? AND path LIKE ?",
+            (kind, person, str(folder / "%")))}
+        changed = []
+        gone = []
+        if not full and row is not None and row[0] == mtime:
+            # nothing was added or removed, but files rewritten in place
+            # (cache restores, openpose reruns) keep the folder mtime
+            for path, stamp in known.items():
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    gone.append(path)
+                    continue
+                if stamp != (st.st_size, st.st_mtime_ns):
+                    scan, view = parse_name(kind, os.path.basename(path))
+                    changed.append((path, kind, person, scan, view, st.st_size,
+                        st.st_mtime_ns, sha1(path) if digest else None))
+        else:
+            seen = set()
+            if mtime is not None:
+                for entry in os.scandir(folder):
+                    parsed = parse_name(kind, entry.name) if entry.is_file() else None
+                    if parsed is None:
+                        continue
+                    path = str(folder / entry.name)
+                    seen.add(path)
+                    st = entry.stat()
+                    if known.get(path) == (st.st_size, st.st_mtime_ns):
+                        continue
+                    changed.append((path, kind, person, parsed[0], parsed[1], st.st_size,
+                        st.st_mtime_ns, sha1(path) if digest else None))
+            gone = [path for path in known if path not in seen]
+        self.db.executemany("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?)", changed)
+        self.db.executemany("DELETE FROM files WHERE path=?", [(path,) for path in gone])
+        if kind == "scan":
+            self.db.executemany("INSERT OR IGNORE INTO scans VALUES (?,?)",
+                [(person, x[3]) for x in changed])
+        self.db.execute("INSERT OR REPLACE INTO folders VALUES (?,?)", (str(folder), mtime))
+        return len(changed)
+
+    def _sync_packed(self, person, path, digest):
+        # the scans of a packed <person>.scan, one row per scan
+        rows = self.db.execute("SELECT size, mtime FROM files WHERE kind='scan' AND "
+            "person=? AND path LIKE ?", (person, str(path) + "#%")).fetchall()
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            st = None
+        if st is not None and rows and set(rows) == {(st.st_size, st.st_mtime_ns)}:
+            return 0
+        self.db.execute("DELETE FROM files WHERE kind='scan' AND person=? AND path LIKE ?",
+            (person, str(path) + "#%"))
+        if st is None:
+            return 0
+        names = scanio.ScanFile(path).names
+        h = sha1(path) if digest else None
+        self.db.executemany("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?)",
+            [("%s#%s" % (path, name), "scan", person, name, None, st.st_size,
+                st.st_mtime_ns, h) for name in names])
+        self.db.executemany("INSERT OR IGNORE INTO scans VALUES (?,?)",
+            [(person, name) for name in names])
+        return len(names)
+
+    def sync(self, persons=None, kinds=None, full=False, digest=False):
+        # brings the files of the persons up to date, all persons by default
+        persons = self.persons() if persons is None else persons
+        changed = 0
+        for kind in kinds or KINDS:
+            base = self.root / KINDS[kind][0]
+            for person in persons:
+                changed += self._sync_folder(kind, person, base / person, full, digest)
+                if kind == "scan":
+                    changed += self._sync_packed(person, base / (person + scanio.SUFFIX),
+                        digest)
+        self.db.commit()
+        return changed
+
+    def sync_ledger(self, path, configs=PERSON_CONFIGS):
+        # per scan status of the stages in a scheduler ledger, keys are
+        # "person/scan" for scan jobs and "person" or "person#shard" else.
+        # Shard k of n covers shard_scans of the person config's scans, the
+        # list the render job got, shards of persons without a config are
+        # left out.
+        if not Path(path).is_file():
+            return
+        ledger = sqlite3.connect(str(path))
+        rows = ledger.execute("SELECT stage, key, status, finished FROM jobs").fetchall()
+        ledger.close()
+        shards = {}
+        for stage, key, _, _ in rows:
+            if '#' in key:
+                person, shard = key.split('#', 1)
+                shards[stage, person] = max(shards.get((stage, person), 0), int(shard) + 1)
+        values = []
+        for stage, key, status, finished in rows:
+            if '/' in key:
+                person, scan = key.split('/', 1)
+                values.append((stage, person, scan, status, finished))
+                continue
+            person = key.split('#')[0]
+            scans = self.scans(person)
+            if '#' in key:
+                scans = self.configured_scans(person, configs)
+                if scans is None:
+                    continue
+                scans = shard_scans(scans, int(key.split('#')[1]), shards[stage, person])
+            values += [(stage, person, scan, status, finished) for scan in scans]
+        self.db.executemany("INSERT OR REPLACE INTO status VALUES (?,?,?,?,?)", values)
+        self.db.commit()
+
+    def missing(self, kind, view=None, person=None):
+        # (person, scan) of the scans without a file of kind (and view)
+        query = '''SELECT s.person, s.scan FROM scans s WHERE NOT EXISTS (
+            SELECT 1 FROM files f WHERE f.kind=? AND f.person=s.person AND f.scan=s.scan'''
+        params = [kind]
+        if view is not None:
+            query += " AND f.view=?"
+            params.append(view)
+        query += ")"
+        if person is not None:
+            query += " AND s.person=?"
+            params.append(person)
+        return self.db.execute(query + " ORDER BY s.person, s.scan", params).fetchall()
+
+    def status(self, stage, person=None):
+        # (person, scan, status) of a stage
+        query = "SELECT person, scan, status FROM status WHERE stage=?"
+        params = [stage]
+        if person is not None:
+            query += " AND person=?"
+            params.append(person)
+        return self.db.execute(query + " ORDER BY person, scan", params).fetchall()
+
+    def summary(self):
+        # (person, scans, files per kind) rows
+        rows = []
+        for person in self.persons():
+            counts = dict(self.db.execute(
+                "SELECT kind, COUNT(*) FROM files WHERE person=? GROUP BY kind", (person,)))
+            rows.append((person, len(self.scans(person)), [counts.get(k, 0) for k in KINDS]))
+        return rows
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manifest", default="dataset/manifest.sqlite")
+    commands = parser.add_subparsers(dest="command", required=True)
+    sync = commands.add_parser("sync", help="add the experiment and update the files")
+    sync.add_argument("experiment", nargs="?", default=None)
+    sync.add_argument("--ledger", default="dataset/ledger.sqlite")
+    sync.add_argument("--full", action="store_true", help="stat every file")
+    sync.add_argument("--hash", action="store_true", help="sha1 of new and changed files")
+    missing = commands.add_parser("missing", help="scans without a file of a kind")
+    missing.add_argument("kind", choices=list(KINDS))
+    missing.add_argument("--view", type=int, default=None)
+    missing.add_argument("--person", default=None)
+    commands.add_parser("summary", help="files per person and kind")
+    args = parser.parse_args()
+
+    manifest = Manifest(args.manifest)
+    if args.command == "sync":
+        if args.experiment:
+            manifest.add_experiment(args.experiment)
+        start = time.time()
+        changed = manifest.sync(full=args.full, digest=args.hash)
+        manifest.sync_ledger(args.ledger)
+        print("%d files added or changed in %.2fs" % (changed, time.time() - start))
+    elif args.command == "missing":
+        for person, scan in manifest.missing(args.kind, args.view, args.person):
+            print("%s/%s" % (person, scan))
+    else:
+        print("person scans " + " ".join(KINDS))
+        for person, scans, counts in manifest.summary():
+            print("%s %d %s" % (person, scans, " ".join(str(x) for x in counts)))
+    manifest.close()
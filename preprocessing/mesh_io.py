@@ -0,0 +1,278 @@
+import sys
+from collections import namedtuple
+from pathlib import Path
+import numpy as np
+
+# Bulk readers for OBJ and PLY (ascii and binary) meshes. Instead of
+# parsing line by line, runs of equally tagged lines are handed to numpy
+# in one piece, so no python object is created per vertex or face. Files
+# are read in blocks of CHUNK bytes to keep memory bounded.
+
+Mesh = namedtuple("Mesh", ["vertices", "faces", "normals"])
+
+CHUNK = 1 << 26
+
+
+def _blocks(path, chunk=None):
+    # yields pieces of the file that always end at a line break
+    chunk = chunk or CHUNK
+    with open(path, "rb") as fp:
+        rest = b""
+        while True:
+            data = fp.read(chunk)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b"\n") + 1
+            rest = data[cut:]
+            if cut:
+                yield data[:cut]
+        if rest:
+            yield rest + b"\n"
+
+
+def _parse(text, dtype, width):
+    values = np.fromstring(text, dtype=dtype, sep=" ")
+    return values.reshape(-1, width)
+
+
+def _obj_runs(block):
+    # classifies every line by its tag with array operations and returns
+    # (tag, first line, byte range) for each run of equally tagged lines.
+    # The tags are blanked out in the returned buffer so that a run can be
+    # handed to np.fromstring as it is.
+    buf = np.frombuffer(block, dtype=np.uint8).copy()
+    starts = np.concatenate([[0], np.flatnonzero(buf[:-1] == 10) + 1])
+    last = len(buf) - 1
+    b0 = buf[starts]
+    b1 = buf[np.minimum(starts + 1, last)]
+    b2 = buf[np.minimum(starts + 2, last)]
+    space1 = (b1 == 32) | (b1 == 9)
+    space2 = (b2 == 32) | (b2 == 9)
+    tags = np.zeros(len(starts), dtype=np.int8)
+    tags[(b0 == ord("v")) & space1] = 1
+    tags[(b0 == ord("v")) & (b1 == ord("n")) & space2] = 2
+    tags[(b0 == ord("f")) & space1] = 3
+    for tag in (1, 2, 3):
+        lines = starts[tags == tag]
+        buf[lines] = 32
+        if tag == 2:
+            buf[lines + 1] = 32
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(tags)) + 1, [len(starts)]])
+    runs = []
+    for i, j in zip(bounds[:-1], bounds[1:]):
+        if tags[i] == 0:
+            continue
+        a = int(starts[i])
+        b = int(starts[j]) if j < len(starts) else len(buf)
+        first = block[a:block.index(b"\n", a)].split()[1:]
+        runs.append((int(tags[i]), first, a, b, j - i))
+    return buf, runs
+
+
+def _obj_faces(block, buf, first, a, b, lines):
+    corners = len(first)
+    parts = len([x for x in first[0].split(b"/") if x])
+    run = buf[a:b]
+    run[run == ord("/")] = 32
+    values = np.fromstring(run.tobytes(), dtype=np.int64, sep=" ")
+    if values.size != lines * corners * parts:
+        # polygons of mixed size, split them line by line
+        return [np.array([int(c.split(b"/")[0]) for c in line.split()[1:]], dtype=np.int64)
+            for line in block[a:b].splitlines() if line.strip()]
+    return [values.reshape(lines, corners, parts)[:, :, 0]]
+
+
+def read_obj(path):
+    # faces are zero based; polygon meshes of mixed size come back as a
+    # list of index arrays instead of one (F, k) array
+    vertices, normals, faces = [], [], []
+    for block in _blocks(path):
+        buf, runs = _obj_runs(block)
+        for tag, first, a, b, lines in runs:
+            if tag == 1:
+                vertices.append(_parse(buf[a:b].tobytes(), np.float64, len(first))[:, :3])
+            elif tag == 2:
+                normals.append(_parse(buf[a:b].tobytes(), np.float64, 3))
+            else:
+                faces.extend(_obj_faces(block, buf, first, a, b, lines))
+    v = np.concatenate(vertices) if vertices else np.zeros([0, 3])
+    n = np.concatenate(normals) if normals else None
+    if faces and all(x.ndim == 2 for x in faces) and len(set(x.shape[1] for x in faces)) == 1:
+        f = np.concatenate(faces)
+    elif faces:
+        f = [row for x in faces for row in (x if x.ndim == 2 else [x])]
+    else:
+        f = np.zeros([0, 3], dtype=np.int64)
+    if isinstance(f, np.ndarray):
+        # negative indices are relative to the end of the vertex list
+        f = np.where(f < 0, f + v.shape[0], f - 1)
+    else:
+        f = [np.where(x < 0, x + v.shape[0], x - 1) for x in f]
+    return Mesh(v, f, n)
+
+
+_PLY_TYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4", "double": "f8", "float64": "f8",
+}
+
+
+def _ply_header(fp):
+    if fp.readline().strip() != b"ply":
+        raise ValueError("not a ply file")
+    fmt = None
+    elements = []
+    while True:
+        line = fp.readline()
+        if not line:
+            raise ValueError("ply header is not terminated")
+        parts = line.decode("ascii").split()
+        if not parts or parts[0] in ("comment", "obj_info"):
+            continue
+        if parts[0] == "format":
+            fmt = parts[1]
+        elif parts[0] == "element":
+            elements.append((parts[1], int(parts[2]), []))
+        elif parts[0] == "property":
+            if parts[1] == "list":
+                elements[-1][2].append((parts[4], _PLY_TYPES[parts[2]], _PLY_TYPES[parts[3]]))
+            else:
+                elements[-1][2].append((parts[2], _PLY_TYPES[parts[1]], None))
+        elif parts[0] == "end_header":
+            return fmt, elements
+
+
+def _vertex_arrays(table, names):
+    v = np.stack([table[x] for x in ("x", "y", "z")], axis=1).astype(np.float64)
+    n = None
+    if all(x in names for x in ("nx", "ny", "nz")):
+        n = np.stack([table[x] for x in ("nx", "ny", "nz")], axis=1).astype(np.float64)
+    return v, n
+
+
+def _read_ply_binary(fp, elements, order):
+    v = n = f = None
+    for name, count, props in elements:
+        if all(p[2] is None for p in props):
+            dtype = np.dtype([(p[0], order + p[1]) for p in props])
+            table = np.fromfile(fp, dtype=dtype, count=count)
+            if name == "vertex":
+                v, n = _vertex_arrays(table, dtype.names)
+            continue
+        if name != "face" or len(props) != 1:
+            raise ValueError("unsupported ply element %s" % name)
+        _, count_type, index_type = props[0]
+        count_type = np.dtype(order + count_type)
+        index_type = np.dtype(order + index_type)
+        start = fp.tell()
+        k = int(np.fromfile(fp, dtype=count_type, count=1)[0]) if count else 3
+        fp.seek(start)
+        # try the common case of a single polygon size first
+        dtype = np.dtype([("n", count_type), ("i", index_type, k)])
+        table = np.fromfile(fp, dtype=dtype, count=count)
+        if len(table) == count and np.all(table["n"] == k):
+            f = table["i"].astype(np.int64)
+            continue
+        fp.seek(start)
+        raw = fp.read()
+        f = []
+        offset = 0
+        for _ in range(count):
+            k = int(np.frombuffer(raw, dtype=count_type, count=1, offset=offset)[0])
+            offset += count_type.itemsize
+            f.append(np.frombuffer(raw, dtype=index_type, count=k, offset=offset).astype(np.int64))
+            offset += k * index_type.itemsize
+    return v, f, n
+
+
+def _read_ply_ascii(fp, elements):
+    v = n = f = None
+    data = fp.read()
+    if not data.endswith(b"\n"):
+        data += b"\n"
+    # line ends of the whole body at once, every element is one slice of it
+    ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10) + 1
+    line = 0
+    start = 0
+    for name, count, props in elements:
+        stop = int(ends[line + count - 1]) if count else start
+        lines = data[start:stop]
+        line += count
+        start = stop
+        if all(p[2] is None for p in props):
+            values = _parse(lines, np.float64, len(props)) if count else np.zeros([0, len(props)])
+            if name == "vertex":
+                table = {p[0]: values[:, i] for i, p in enumerate(props)}
+                v, n = _vertex_arrays(table, table.keys())
+            continue
+        if name != "face" or len(props) != 1:
+            raise ValueError("unsupported ply element %s" % name)
+        values = np.fromstring(lines, dtype=np.int64, sep=" ")
+        k = int(values[0]) if values.size else 3
+        if values.size == count * (k + 1) and np.all(values[::k + 1] == k):
+            f = values.reshape(count, k + 1)[:, 1:]
+        else:
+            f = [np.array(x.split()[1:], dtype=np.int64) for x in lines.splitlines()]
+    return v, f, n
+
+
+def read_ply(path):
+    with open(path, "rb") as fp:
+        fmt, elements = _ply_header(fp)
+        if fmt == "ascii":
+            v, f, n = _read_ply_ascii(fp, elements)
+        elif fmt == "binary_little_endian":
+            v, f, n = _read_ply_binary(fp, elements, "<")
+        elif fmt == "binary_big_endian":
+            v, f, n = _read_ply_binary(fp, elements, ">")
+        else:
+            raise ValueError("unknown ply format %s" % fmt)
+    if f is None:
+        f = np.zeros([0, 3], dtype=np.int64)
+    return Mesh(v, f, n)
+
+
+def write_ply(path, vertices, faces, normals=None):
+    # binary little endian ply with float32 vertices and int32 faces
+    vertices = np.asarray(vertices, dtype=np.float32)
+    faces = np.asarray(faces, dtype=np.int32)
+    props = [("x", "<f4"), ("y", "<f4"), ("z", "<f4")]
+    header = ["ply", "format binary_little_endian 1.0",
+        "element vertex %d" % len(vertices),
+        "property float x", "property float y", "property float z"]
+    if normals is not None:
+        props += [("nx", "<f4"), ("ny", "<f4"), ("nz", "<f4")]
+        header += ["property float nx", "property float ny", "property float nz"]
+    header += ["element face %d" % len(faces), "property list uchar int vertex_indices",
+        "end_header"]
+    table = np.empty(len(vertices), dtype=props)
+    table["x"], table["y"], table["z"] = vertices.T
+    if normals is not None:
+        table["nx"], table["ny"], table["nz"] = np.asarray(normals, dtype=np.float32).T
+    face_table = np.empty(len(faces), dtype=[("n", "u1"), ("i", "<i4", faces.shape[1])])
+    face_table["n"] = faces.shape[1]
+    face_table["i"] = faces
+    with open(path, "wb") as fp:
+        fp.write(("\n".join(header) + "\n").encode("ascii"))
+        fp.write(table.tobytes())
+        fp.write(face_table.tobytes())
+
+
+def read_mesh(path):
+    suffix = Path(path).suffix.lower()
+    if suffix == ".obj":
+        return read_obj(path)
+    if suffix == ".ply":
+        return read_ply(path)
+    raise ValueError("unsupported mesh format %s" % suffix)
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        mesh = read_mesh(path)
+        faces = mesh.faces.shape if isinstance(mesh.faces, np.ndarray) else len(mesh.faces)
+        print(path, mesh.vertices.shape, faces,
+            None if mesh.normals is None else mesh.normals.shape)
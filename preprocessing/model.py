@@ -0,0 +1,205 @@
+import re
+import argparse
+import numpy as np
+import h5py
+
+# Lazy access to the trained models in weights/{male,female,unisex}_model.
+# The datasets of these files are stored contiguous and uncompressed, so
+# they are memory mapped at their file offset and only the pages that are
+# touched are read. Chunked or compressed datasets fall back to h5py
+# slicing. Arrays keep the layout of the file:
+#
+#   mean, pc<k>, deform<k>   (3, V)    template and blend shapes
+#   joints, jointpc<k>       (3, J)    rest joints and their shape basis
+#   weights                  (J, V)    skinning weights
+#   meanPose                 (3, J-1)  mean axis-angle of the non-root joints
+#   Rs, ts                   (3J, S), (3, S)  axis-angle pose and translation
+#   betas                    (P, 10)   shape coefficients of the training persons
+#
+# The kinematic tree is not part of the files, posing takes the parent of
+# every joint as an argument. Pose corrective blend shapes are the deform
+# components driven by R - I of the rotations of the non-root joints, 9 per
+# joint. The bundled models have 18 deform components, too few for all
+# joints, so they pose without correctives unless the two driving joints
+# are passed as corrective_joints.
+
+
+class Model:
+    def __init__(self, path):
+        self.path = str(path)
+        self.file = h5py.File(self.path, 'r')
+        self._arrays = {}
+        self.shape_count = self._count('pc')
+        self.deform_count = self._count('deform')
+
+    def _count(self, prefix):
+        pattern = re.compile(prefix + r'(\d+)$')
+        return sum(1 for name in self.file if pattern.match(name))
+
+    def __contains__(self, name):
+        return name in self.file
+
+    def __getitem__(self, name):
+        # np.memmap for contiguous datasets, the h5py dataset otherwise
+        if name not in self._arrays:
+            d = self.file[name]
+            offset = d.id.get_offset()
+            if d.chunks is None and d.compression is None and offset is not None:
+                self._arrays[name] = np.memmap(self.path, dtype=d.dtype, mode='r',
+                    offset=offset, shape=d.shape)
+            else:
+                self._arrays[name] = d
+        return self._arrays[name]
+
+    def _stack(self, prefix, count, indices=None):
+        indices = range(count) if indices is None else indices
+        return np.stack([self['%s%d' % (prefix, i)] for i in indices])
+
+    @property
+    def vertex_count(self):
+        return self.file['mean'].shape[1]
+
+    @property
+    def joint_count(self):
+        return self.file['joints'].shape[1]
+
+    @property
+    def template(self):
+        return self['mean']
+
+    @property
+    def weights(self):
+        return self['weights']
+
+    def shape_basis(self, indices=None):
+        # (K, 3, V), only the requested components are read
+        return self._stack('pc', self.shape_count, indices)
+
+    def deform_basis(self, indices=None):
+        return self._stack('deform', self.deform_count, indices)
+
+    def joint_basis(self, indices=None):
+        return self._stack('jointpc', self.shape_count, indices)
+
+    def betas(self, persons=slice(None)):
+        return np.asarray(self['betas'][persons])
+
+    def scan_pose(self, scans):
+        # axis-angle (S, J, 3) and translation (S, 3) of fitted scans
+        scans = np.atleast_1d(np.arange(self.file['ts'].shape[1])[scans])
+        Rs = np.asarray(self['Rs'][:, scans]).T.reshape(len(scans), self.joint_count, 3)
+        return Rs, np.asarray(self['ts'][:, scans]).T
+
+    def shape(self, betas, deform=None):
+        # vertices (B, V, 3) for shape coefficients (B, K), deform are
+        # optional coefficients (B, D) of the deform blend shapes
+        betas = np.atleast_2d(betas)
+        k = betas.shape[1]
+        v = self.template[None] + np.einsum('bk,kiv->biv', betas, self.shape_basis(range(k)))
+        if deform is not None:
+            deform = np.atleast_2d(deform)
+            v = v + np.einsum('bk,kiv->biv', deform, self.deform_basis(range(deform.shape[1])))
+        return v.transpose(0, 2, 1)
+
+    def shape_joints(self, betas):
+        betas = np.atleast_2d(betas)
+        k = betas.shape[1]
+        j = self['joints'][None] + np.einsum('bk,kij->bij', betas, self.joint_basis(range(k)))
+        return j.transpose(0, 2, 1)
+
+    @property
+    def has_correctives(self):
+        return self.deform_count >= 9 * (self.joint_count - 1)
+
+    def pose_correctives(self, rotations, joints=None):
+        # vertex offsets (B, V, 3) of the pose corrective blend shapes for
+        # rotation matrices (B, J, 3, 3), driven by the non-root joints or
+        # the given joints
+        rotations = np.asarray(rotations)
+        joints = range(1, rotations.shape[1]) if joints is None else list(joints)
+        features = (rotations[:, joints] - np.eye(3)).reshape(len(rotations), -1)
+        if features.shape[1] > self.deform_count:
+            raise ValueError("%s has %d deform components, %d pose features" % (
+                self.path, self.deform_count, features.shape[1]))
+        basis = self.deform_basis(range(features.shape[1]))
+        return np.einsum('bk,kiv->bvi', features, basis)
+
+    def pose(self, betas, rotations, parents, translation=None, deform=None,
+            corrective_joints=None):
+        # posed vertices (B, V, 3) for axis-angle rotations (B, J, 3) that are
+        # relative to the parent joint, parents[0] is -1 for the root. The
+        # pose correctives are added in the rest pose unless deform gives
+        # the deform coefficients explicitly.
+        R = rodrigues(rotations)
+        v = self.shape(betas, deform)
+        if deform is None and (corrective_joints is not None or self.has_correctives):
+            v = v + self.pose_correctives(R, corrective_joints)
+        transforms = forward_kinematics(R, self.shape_joints(betas), parents)
+        posed = skin(v, np.asarray(self.weights), transforms)
+        if translation is not None:
+            posed = posed + np.asarray(translation)[:, None, :]
+        return posed
+
+    def close(self):
+        self._arrays.clear()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def rodrigues(r):
+    # axis-angle (..., 3) to rotation matrices (..., 3, 3)
+    r = np.asarray(r, dtype=np.float64)
+    theta = np.linalg.norm(r, axis=-1, keepdims=True)
+    axis = np.divide(r, theta, out=np.zeros_like(r), where=theta > 0)
+    x, y, z = axis[..., 0], axis[..., 1], axis[..., 2]
+    zero = np.zeros_like(x)
+    K = np.stack([zero, -z, y, z, zero, -x, -y, x, zero], axis=-1).reshape(r.shape + (3,))
+    s = np.sin(theta)[..., None]
+    c = np.cos(theta)[..., None]
+    return np.eye(3) + s * K + (1 - c) * (K @ K)
+
+
+def forward_kinematics(rotations, joints, parents):
+    # rotations (B, J, 3, 3) relative to the parents, rest joints (B, J, 3).
+    # Returns the skinning transforms (B, J, 3, 4) that take rest positions
+    # to posed positions. Parents have to come before their children.
+    B, J = rotations.shape[:2]
+    R = np.empty((B, J, 3, 3))
+    t = np.empty((B, J, 3))
+    for j in range(J):
+        p = parents[j]
+        if p < 0:
+            R[:, j] = rotations[:, j]
+            t[:, j] = joints[:, j]
+        else:
+            R[:, j] = R[:, p] @ rotations[:, j]
+            t[:, j] = t[:, p] + np.einsum('bik,bk->bi', R[:, p], joints[:, j] - joints[:, p])
+    # G_j x = R_j (x - rest_j) + t_j
+    offset = t - np.einsum('bjik,bjk->bji', R, joints)
+    return np.concatenate([R, offset[..., None]], axis=-1)
+
+
+def skin(vertices, weights, transforms):
+    # linear blend skinning, vertices (B, V, 3), weights (J, V) and
+    # transforms (B, J, 3, 4)
+    blended = np.einsum('jv,bjik->bvik', weights, transforms)
+    return np.einsum('bvik,bvk->bvi', blended[..., :3], vertices) + blended[..., 3]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", help="weights/male_model, female_model or unisex_model")
+    args = parser.parse_args()
+    with Model(args.model) as model:
+        print("%d vertices, %d joints, %d shape and %d deform components%s" % (
+            model.vertex_count, model.joint_count, model.shape_count, model.deform_count,
+            "" if model.has_correctives else ", no pose correctives"))
+        for name in sorted(model.file):
+            array = model[name]
+            print("%-10s %-12s %s" % (name, array.shape,
+                "memmap" if isinstance(array, np.memmap) else "h5py"))
@@ -1,31 +1,35 @@
 import sys
-experiment_path = sys.argv[1]
+import argparse
+from pathlib import Path
 
+from scheduler import Job, Stage, Ledger, Scheduler
+from cache import Cache
+from instrument import Metrics, load, report
+from manifest import Manifest, read_experiment, scan_names, shard_scans, CAMERA_PATHS
+from commands import (MESHLAB_IMAGE, BLENDER_IMAGE, OPENPOSE_IMAGE,
+	blenderCommandTemplate, rasterCommandTemplate)
 
-from pathlib import Path
-import subprocess
-basePath = "dataset/scans"
 meshlabCommandTemplate = '''docker run --rm \
 -v $(pwd)/dataset/poisson:/output \
 -v $(pwd)/preprocessing:/root/scripts \
 -v $(pwd)/dataset/scans:/scans \
--e IN_DATA=%s  hamzamerzic/meshlab /root/scripts/run_in_meshlab.sh'''
+-e IN_DATA=%s -e OUT_DATA=%s ''' + MESHLAB_IMAGE + ''' /root/scripts/run_in_meshlab.sh'''
 
 meshlabCommand2Template = '''docker run --rm \
 -v $(pwd)/dataset/poisson:/poisson \
 -v $(pwd)/preprocessing:/root/scripts \
 -v $(pwd)/dataset/scans:/scans \
--e IN_DATA=%s hamzamerzic/meshlab /root/scripts/run_in_meshlab2.sh'''
-
+-e IN_DATA=%s -e OUT_DATA=%s ''' + MESHLAB_IMAGE + ''' /root/scripts/run_in_meshlab2.sh'''
 
-blenderCommandTemplate = '''docker run --rm -it \
--v %s:/input \
--v %s:/output \
--v $(pwd)/JOMS/template_human/:/template \
--e CAM=/template/%s \
--v %spreprocessing:/blendfiles \
---gpus '"device=1"' nytimes/blender:2.82-gpu-ubuntu18.04 \
-bash -c "/blendfiles/run_in_blender.sh"'''
+# one container for a whole batch, the "input output" pairs go to stdin
+meshlabBatchTemplate = '''docker run --rm -i \
+-v $(pwd)/dataset/poisson:/poisson \
+-v $(pwd)/preprocessing:/root/scripts \
+-v $(pwd)/dataset/scans:/scans \
+-e SCRIPT=/root/scripts/%s -e MESHLAB_ARGS="%s" \
+''' + MESHLAB_IMAGE + ''' /root/scripts/run_in_meshlab_batch.sh <<'EOF'
+%s
+EOF'''
 
 #blenderCommandTemplate = docker run --rm -it \
 #-v %sdataset/poisson:/input \
@@ -34,88 +38,248 @@ bash -c "/blendfiles/run_in_blender.sh"'''
 #-v %spreprocessing:/blendfiles \
 #-v /tmp/.X11-unix:/tmp/.X11-unix -e DISPLAY=:0.0 -e XAUTHORITY=~/.Xauthority -e NVIDIA_DRIVER_CAPABILITIES=all \
 #--gpus all nytimes/blender:2.82-gpu-ubuntu18.04 \
-#bash 
+#bash
 
-openposeCommandTemplate = '''docker run -it \
+openposeCommandTemplate = '''docker run --rm \
 -v %s:/images \
--v %s:/output --net=host --gpus '"device=1"' \
-joms/openpose:latest ./build/examples/openpose/openpose.bin --display 0 --image_dir=/images/ \
+-v %s:/output --net=host --gpus '"device=%s"' \
+''' + OPENPOSE_IMAGE + ''' ./build/examples/openpose/openpose.bin --display 0 --image_dir=/images/ \
 --face --hand --write_json=/output/
 '''
 #--write_json=/output/
 #--write_images=/output/ --face --hand --face_render 1 --hand_render 1 --face_render_threshold 0.001 \
 #--write_json=/output/ --face_detector 0
 
-persons = []
-suffixes = []
-camera_ids = []
-camera_paths = ["cameras.json",
-	"caesar_cameras.json"]
-
-with open(experiment_path,'r') as f:
-	for line in f.readlines():
-		if line.startswith("person_ids"):
-			persons = [x.strip() for x in line[line.index('=')+1:].split(',')]
-		elif line.startswith("person_config_suffixes"):
-			suffixes = [x.strip() for x in line[line.index('=')+1:].split(',')]
-		elif line.startswith("person_fist"):
-			camera_ids = [int(x.strip()) for x in line[line.index('=')+1:].split(',')]
+samplingCommandTemplate = '''python preprocessing/sampling.py %s %s'''
+
+keypointsCommandTemplate = '''python preprocessing/keypoints.py dataset/pose2d %s --persons %s'''
+
+# render and openpose overlapped in one job per person, see stream.py
+# the scan names go to stdin like for the renderers
+streamCommandTemplate = '''python preprocessing/stream.py %s %s --cameras %s --gpus %s \
+--chunk %d --queue %d --staging %s --blender-image %s --openpose-image %s%s --scans - <<'EOF'
+%s
+EOF'''
+
+triangulateCommandTemplate = '''python preprocessing/triangulate.py %s JOMS/template_human/%s \
+%s --persons %s'''
+
+STAGES = ["poisson", "render", "openpose", "keypoints", "triangulate", "sampling"]
+
+parser = argparse.ArgumentParser()
+parser.add_argument("experiment_path")
+parser.add_argument("--stages", default="poisson,render,openpose",
+	help="comma separated subset of " + ",".join(STAGES))
+parser.add_argument("--cpu-workers", type=int, default=4,
+	help="concurrent meshlab jobs per cpu stage")
+parser.add_argument("--batch-size", type=int, default=32,
+	help="scans per meshlab container, 1 starts a container per scan")
+parser.add_argument("--gpus", default="0",
+	help="comma separated list of gpu devices for blender and openpose")
+parser.add_argument("--batched-render", action="store_true",
+	help="render the 8 views of a scan in one multiview pass")
+parser.add_argument("--cpu-render", action="store_true",
+	help="rasterize the views with preprocessing/raster.py instead of blender")
+parser.add_argument("--render-shards", type=int, default=1,
+	help="blender processes per person, each renders a slice of the scans")
+parser.add_argument("--stream", action="store_true",
+	help="overlap render and openpose per person through a bounded queue of chunks")
+parser.add_argument("--stream-chunk", type=int, default=4,
+	help="scans per streamed chunk")
+parser.add_argument("--stream-queue", type=int, default=2,
+	help="rendered chunks that may wait for openpose")
+parser.add_argument("--staging", default="/dev/shm/joms",
+	help="folder for the streamed images in flight, tmpfs keeps them off the disk")
+parser.add_argument("--native-sampling", action="store_true",
+	help="sample with preprocessing/sampling.py instead of the meshlab container")
+parser.add_argument("--keypoint-store", default="dataset/keypoints.h5",
+	help="hdf5 file the keypoints stage appends new openpose output to")
+parser.add_argument("--joints", default="dataset/joints3d",
+	help="folder the triangulate stage writes <person>/<scan>.npy to")
+parser.add_argument("--ledger", default="dataset/ledger.sqlite")
+parser.add_argument("--cache", default="dataset/cache",
+	help="content addressed store of the stage outputs, empty to disable")
+parser.add_argument("--cache-size", type=float, default=50,
+	help="size limit of the cache in GB, least recently used entries go first")
+parser.add_argument("--metrics", default="dataset/metrics.jsonl",
+	help="per item timings are appended here as json lines, empty to disable")
+parser.add_argument("--redo", default="",
+	help="comma separated stages to run again even if the ledger or cache has them done")
+parser.add_argument("--manifest", default="dataset/manifest.sqlite",
+	help="sqlite manifest of persons, scans and files updated after the run, empty to disable")
+parser.add_argument("--dry-run", action="store_true")
+args = parser.parse_args()
+
+stages = [x.strip() for x in args.stages.split(',') if x.strip()]
+redo = [x.strip() for x in args.redo.split(',') if x.strip()]
+for stage in stages:
+	if stage not in STAGES:
+		sys.exit("unknown stage %s" % stage)
+gpus = [x.strip() for x in args.gpus.split(',') if x.strip()]
+streaming = args.stream and "render" in stages and "openpose" in stages
+
+camera_paths = CAMERA_PATHS
+
+persons, camera_ids, suffixes = read_experiment(args.experiment_path)
 print(persons)
 print(suffixes)
 
-#human-model-trainer/person_configs/50002_cluster50f.txt
-person_configs_base = Path("JOMS/person_configs")
-if False:
-	for person,suffix in zip(persons,suffixes):
-		person_path = "JOMS/person_configs/%s_%s.txt" % (person,suffix)
-		with open(person_path,'r') as f:
-			scan_names = ["dataset/scans/"+person+'/'+x.strip()+".xyz" for x in f.readlines()[2:]]
-			print(scan_names)
-			for scan in scan_names:
-				path = Path(scan)
-				realPath = path.relative_to(basePath)
-				print(realPath)
-				input=str(Path("/scans") / path.relative_to(basePath))
-				meshlabCommand = meshlabCommandTemplate % input
-				process = subprocess.check_call(meshlabCommand, shell=True)
-				target = Path("dataset/poisson")/realPath.with_suffix(".ply")
-				target.parent.mkdir(parents=True, exist_ok=True)
-				Path("dataset/poisson/test.ply").rename(target)
-
-if False:
-	for i,person in enumerate(persons):
-		s = str(Path.cwd()) + "/"
-		s_poisson = str(Path.cwd()/"dataset/poisson"/person)
-		print(s_poisson)
-		s_output = str(Path.cwd()/"dataset/flat_images"/person)
-		(Path.cwd()/"dataset/flat_images"/person).mkdir(parents=True, exist_ok=True)
-		blenderCommand = blenderCommandTemplate % (s_poisson,s_output,camera_paths[camera_ids[i]],s)
-		print(blenderCommand)
-		process = subprocess.check_call(blenderCommand, shell=True)
-if True:
-	for person in persons:
+def mkdir(path):
+	return lambda: Path(path).mkdir(parents=True, exist_ok=True)
+
+scripts = Path("preprocessing")
+template_human = Path("JOMS/template_human")
+
+jobs = []
+for i,(person,suffix) in enumerate(zip(persons,suffixes)):
+	poisson_ids = []
+	names = scan_names(person, suffix)
+	for name in names:
+		key = person + '/' + name
+		if "poisson" in stages:
+			target = Path("dataset/poisson")/person/(name+".ply")
+			meshlabCommand = meshlabCommandTemplate % (
+				"/scans/%s.xyz" % key, "/output/%s.ply" % key)
+			jobs.append(Job("poisson", key, meshlabCommand,
+				outputs=[target], before=mkdir(target.parent),
+				args=("/scans/%s.xyz" % key, "/poisson/%s.ply" % key),
+				inputs=[Path("dataset/scans")/(key+".xyz"), scripts/"poisson.mlx"],
+				params=[MESHLAB_IMAGE]))
+			poisson_ids.append(("poisson", key))
+		if "sampling" in stages:
+			target = Path("dataset/scans")/person/(name+".xyz")
+			source = Path("dataset/poisson")/(key+".obj")
+			if args.native_sampling:
+				meshlabCommand = samplingCommandTemplate % (source, target)
+				tool, params = scripts/"sampling.py", ["native"]
+			else:
+				meshlabCommand = meshlabCommand2Template % (
+					"/poisson/%s.obj" % key, "/scans/%s.xyz" % key)
+				tool, params = scripts/"sampling.mlx", [MESHLAB_IMAGE]
+			jobs.append(Job("sampling", key, meshlabCommand,
+				deps=[("poisson", key)], outputs=[target], before=mkdir(target.parent),
+				args=("/poisson/%s.obj" % key, "/scans/%s.xyz" % key),
+				inputs=[source, tool], params=params))
+
+	s_poisson = str(Path.cwd()/"dataset/poisson"/person)
+	s_output = str(Path.cwd()/"dataset/flat_images"/person)
+	render_ids = []
+	if streaming:
+		camera = camera_paths[camera_ids[i]]
+		openOut = Path("dataset/pose2d")/person
+		views = ["%s_%d" % (name,c) for name in sorted(names) for c in range(8)]
+		if args.cpu_render:
+			tools, flags = [scripts/"raster.py", scripts/"generator.png"], " --cpu-render"
+		else:
+			tools = [scripts/"blender_render.py", scripts/"matcap_cycles.blend"]
+			flags = " --batched" if args.batched_render else ""
+		jobs.append(Job("stream", person,
+			lambda device, s_poisson=s_poisson, openOut=openOut, camera=camera, flags=flags, names=names:
+				streamCommandTemplate % (s_poisson, str(openOut.absolute()), camera,
+					device, args.stream_chunk, args.stream_queue, args.staging,
+					BLENDER_IMAGE, OPENPOSE_IMAGE, flags, "\n".join(sorted(names))),
+			deps=poisson_ids, before=mkdir(openOut),
+			outputs=[openOut/(x+"_keypoints.json") for x in views],
+			inputs=[Path("dataset/poisson")/person/(name+".ply") for name in sorted(names)] +
+				[template_human/camera] + tools + [scripts/"stream.py", scripts/"commands.py"],
+			params=[BLENDER_IMAGE, OPENPOSE_IMAGE, flags]))
+	if "render" in stages and not streaming:
+		camera = camera_paths[camera_ids[i]]
+		for shard in range(args.render_shards):
+			key = person if args.render_shards == 1 else "%s#%d" % (person, shard)
+			# the renderer gets exactly these scans on stdin
+			shard_names = shard_scans(names, shard, args.render_shards)
+			scan_list = "\n".join(shard_names)
+			if args.cpu_render:
+				command = rasterCommandTemplate % (s_poisson,s_output,camera,scan_list)
+				tools, params = [scripts/"raster.py", scripts/"generator.png"], []
+			else:
+				command = lambda device, s_poisson=s_poisson, s_output=s_output, camera=camera, scan_list=scan_list: \
+					blenderCommandTemplate % (s_poisson,s_output,camera,
+						args.batched_render,device,BLENDER_IMAGE,scan_list)
+				tools = [scripts/"blender_render.py", scripts/"matcap_cycles.blend"]
+				params = [BLENDER_IMAGE, args.batched_render]
+			jobs.append(Job("render", key, command,
+				deps=poisson_ids, before=mkdir(s_output),
+				outputs=[Path("dataset/flat_images")/person/("%s_%d.png" % (name,c))
+					for name in shard_names for c in range(8)],
+				inputs=[Path("dataset/poisson")/person/(name+".ply") for name in shard_names] +
+					[template_human/camera] + tools,
+				params=params))
+			render_ids.append(("render", key))
+	if "openpose" in stages and not streaming:
 		openIn = str((Path("dataset/flat_images")/person).absolute())
 		openOut = (Path("dataset/pose2d")/person).absolute()
-		openOut.mkdir(parents=True, exist_ok=True)
-		openposeCommand = openposeCommandTemplate % (openIn,str(openOut))
-		print(openposeCommand)
-		process = subprocess.check_call(openposeCommand, shell=True)
-
-if False:
-    basePath = "dataset/poisson"
-    for person,suffix in zip(persons,suffixes):
-        person_path = "JOMS/person_configs/%s_%s.txt" % (person,suffix)
-        with open(person_path,'r') as f:
-            scan_names = ["dataset/poisson/"+person+'/'+x.strip()+".obj" for x in f.readlines()[2:]]
-            print(scan_names)
-            for scan in scan_names:
-                path = Path(scan)
-                realPath = path.relative_to(basePath)
-                print(realPath)
-                input=str(Path("/poisson") / path.relative_to(basePath))
-                meshlabCommand = meshlabCommand2Template % input
-                print(meshlabCommand)
-                process = subprocess.check_call(meshlabCommand, shell=True)
-                target = Path("dataset/scans")/realPath.with_suffix(".xyz")
-                target.parent.mkdir(parents=True, exist_ok=True)
-                Path("dataset/scans/test.xyz").rename(target)
+		views = ["%s_%d" % (name,c) for name in sorted(names) for c in range(8)]
+		jobs.append(Job("openpose", person,
+			lambda device, openIn=openIn, openOut=openOut:
+				openposeCommandTemplate % (openIn,str(openOut),device),
+			deps=render_ids, before=mkdir(openOut),
+			outputs=[Path("dataset/pose2d")/person/(x+"_keypoints.json") for x in views],
+			inputs=[Path("dataset/flat_images")/person/(x+".png") for x in views],
+			params=[OPENPOSE_IMAGE, openposeCommandTemplate.split("--image_dir")[1]]))
+	if "keypoints" in stages:
+		jobs.append(Job("keypoints", person,
+			keypointsCommandTemplate % (args.keypoint_store, person),
+			deps=[("openpose", person), ("stream", person)]))
+	if "triangulate" in stages:
+		jobs.append(Job("triangulate", person,
+			triangulateCommandTemplate % (args.keypoint_store,
+				camera_paths[camera_ids[i]], args.joints, person)))
+
+# the store is read while keypoints appends to it, so triangulation waits
+# for every keypoints job of the run
+keypoint_ids = [job.id for job in jobs if job.stage == "keypoints"]
+for job in jobs:
+	if job.stage == "triangulate":
+		job.deps = keypoint_ids
+
+def meshlab_batch(script, meshlab_args):
+	def command(batch, device):
+		pairs = "\n".join("%s %s" % job.args for job in batch)
+		return meshlabBatchTemplate % (script, meshlab_args, pairs)
+	if args.batch_size <= 1:
+		return None
+	return command
+
+ledger = Ledger(args.ledger)
+for stage in redo:
+	ledger.reset(stage)
+cache = Cache(args.cache, int(args.cache_size * (1 << 30))) if args.cache and not args.dry_run else None
+metrics = Metrics(args.metrics) if args.metrics and not args.dry_run else None
+scheduler = Scheduler([
+	Stage("poisson", workers=args.cpu_workers,
+		batch=meshlab_batch("poisson.mlx", ""), batch_size=args.batch_size),
+	Stage("sampling", workers=args.cpu_workers,
+		batch=None if args.native_sampling else meshlab_batch("sampling.mlx", "-m vn"),
+		batch_size=args.batch_size),
+	Stage("render", workers=args.cpu_workers) if args.cpu_render else
+		Stage("render", devices=gpus),
+	Stage("openpose", devices=gpus),
+	# stream.py spreads over all gpus itself, its single device is the list
+	Stage("stream", devices=[",".join(gpus)]),
+	# the store has a single writer
+	Stage("keypoints", workers=1),
+	Stage("triangulate", workers=args.cpu_workers)],
+	ledger, dry_run=args.dry_run, cache=cache, redo=redo, metrics=metrics)
+finished, failed = scheduler.run(jobs)
+for row in ledger.summary():
+	print("%s %s %d" % row)
+ledger.close()
+if cache is not None:
+	for row in cache.report():
+		print("cache %s: %d hits, %d misses" % row)
+	print("cache size %.2f GB" % (cache.size() / (1 << 30)))
+	cache.close()
+if args.manifest and not args.dry_run:
+	manifest = Manifest(args.manifest)
+	manifest.add_experiment(args.experiment_path)
+	manifest.sync(persons)
+	manifest.sync_ledger(args.ledger)
+	manifest.close()
+if metrics is not None:
+	metrics.close()
+	for line in report(load(args.metrics, metrics.run)):
+		print(line)
+if failed:
+	sys.exit(1)
@@ -0,0 +1,221 @@
+import sys
+import zlib
+import struct
+import argparse
+from pathlib import Path
+from multiprocessing import Pool
+import numpy as np
+
+import cameras
+from mesh_io import read_mesh
+from sampling import triangulate
+
+# CPU replacement for blender_render.py: a z-buffer rasterizer in NumPy
+# that shades the mesh with a matcap the way matcap_cycles.blend does.
+# All views of a mesh are rasterized together, one z-buffer of shape
+# (C, HEIGHT, WIDTH) holds every view. Faces are flat shaded like the
+# imported PLYs in Blender. Images are written as <scan>_<i>.png.
+#
+#   python raster.py dataset/poisson/50002 dataset/flat_images/50002 \
+#       --cameras JOMS/template_human/cameras.json
+
+MATCAP = Path(__file__).resolve().parent / "generator.png"
+# fragments per rasterization chunk, bounds the memory of one call
+CHUNK = 1 << 16
+
+
+def read_png(path):
+    # 8 bit, non interlaced PNGs, enough for the matcap images
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    assert data[:8] == b'\x89PNG\r\n\x1a\n', "%s is not a png" % path
+    pos, idat = 8, []
+    while pos < len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        if kind == b'IHDR':
+            w, h, depth, color, _, _, interlace = struct.unpack('>IIBBBBB', chunk)
+        elif kind == b'IDAT':
+            idat.append(chunk)
+        pos += 12 + length
+    assert depth == 8 and interlace == 0, "unsupported png %s" % path
+    channels = {0: 1, 2: 3, 4: 2, 6: 4}[color]
+    raw = np.frombuffer(zlib.decompress(b''.join(idat)), dtype=np.uint8)
+    raw = raw.reshape(h, 1 + w * channels)
+    image = np.zeros((h, w * channels), dtype=np.int32)
+    prev = np.zeros(w * channels, dtype=np.int32)
+    for y in range(h):
+        kind, line = raw[y, 0], raw[y, 1:].astype(np.int32)
+        if kind == 1 or kind == 3 or kind == 4:
+            # these depend on the pixel to the left, decoded per pixel
+            row = np.zeros_like(line)
+            for x in range(0, len(line), channels):
+                left = row[x - channels:x] if x else np.zeros(channels, dtype=np.int32)
+                up = prev[x:x + channels]
+                if kind == 1:
+                    p = left
+                elif kind == 3:
+                    p = (left + up) // 2
+                else:
+                    ul = prev[x - channels:x] if x else np.zeros(channels, dtype=np.int32)
+                    pa, pb, pc = np.abs(up - ul), np.abs(left - ul), np.abs(left + up - 2 * ul)
+                    p = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, ul))
+                row[x:x + channels] = (line[x:x + channels] + p) & 255
+            line = row
+        elif kind == 2:
+            line = (line + prev) & 255
+        image[y] = prev = line
+    image = image.reshape(h, w, channels).astype(np.uint8)
+    if channels < 3:
+        image = np.repeat(image[:, :, :1], 3, axis=2)
+    return image[:, :, :3]
+
+
+def write_png(path, image):
+    # image of shape (H, W, 3) and dtype uint8, rows stored unfiltered
+    h, w, _ = image.shape
+    raw = np.zeros((h, 1 + 3 * w), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(h, -1)
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    with open(path, 'wb') as fp:
+        fp.write(b'\x89PNG\r\n\x1a\n')
+        fp.write(chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0)))
+        fp.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        fp.write(chunk(b'IEND', b''))
+
+
+def rasterize(v, f, K, R, t, width=cameras.WIDTH, height=cameras.HEIGHT):
+    # returns the visible face per pixel (C, height, width), -1 for background,
+    # the depth maps (C, height, width), inf for background, and the camera
+    # space vertices (C, V, 3)
+    f = triangulate(f)
+    C = len(K)
+    cam = cameras.to_camera(np.asarray(v, dtype=np.float64), R, t)
+    uv, z = cameras.project(v, K, R, t)
+
+    # pixel bounding boxes of all (view, face) pairs in front of the camera
+    tri = uv[:, f]
+    lo = np.floor(tri.min(axis=2) - .5).astype(np.int64) + 1
+    hi = np.floor(tri.max(axis=2) - .5).astype(np.int64)
+    lo = np.maximum(lo, 0)
+    hi = np.minimum(hi, [width - 1, height - 1])
+    front = (z[:, f] > 1e-6).all(axis=2)
+    size = np.where(front, (hi - lo + 1).clip(0).prod(axis=2), 0)
+    views, faces = np.nonzero(size)
+
+    # per face the barycentric coordinates and the inverse depth are affine
+    # in the pixel position, w = a * x + b * y + c, so every fragment only
+    # needs these 12 coefficients
+    p = tri[views, faces]
+    zc = z[views[:, None], f[faces]]
+    q = np.roll(p, -1, axis=1)
+    r = np.roll(p, -2, axis=1)
+    area = ((p[:, 1, 0] - p[:, 0, 0]) * (p[:, 2, 1] - p[:, 0, 1]) -
+        (p[:, 1, 1] - p[:, 0, 1]) * (p[:, 2, 0] - p[:, 0, 0]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        edge = np.stack([q[:, :, 1] - r[:, :, 1], r[:, :, 0] - q[:, :, 0],
+            q[:, :, 0] * r[:, :, 1] - q[:, :, 1] * r[:, :, 0]], axis=2) / area[:, None, None]
+        coef = np.concatenate([edge, (edge / zc[:, :, None]).sum(axis=1, keepdims=True)], axis=1)
+    coef[area == 0] = np.nan
+    coef = coef.reshape(-1, 12)
+
+    depth = np.full(C * height * width, np.inf, dtype=np.float32)
+    owner = np.full(C * height * width, -1, dtype=np.int64)
+    count = size[views, faces]
+    x0, y0 = lo[views, faces, 0], lo[views, faces, 1]
+    bw = hi[views, faces, 0] - x0 + 1
+    bounds = np.concatenate([[0], np.cumsum(count)])
+    starts = np.searchsorted(bounds, np.arange(0, bounds[-1], CHUNK), side='right') - 1
+    for a, b in zip(starts, list(starts[1:]) + [len(views)]):
+        # one fragment per pixel of every bounding box
+        pair = np.repeat(np.arange(a, b), count[a:b])
+        offset = np.arange(len(pair)) - (bounds[pair] - bounds[a])
+        px = x0[pair] + offset % bw[pair]
+        py = y0[pair] + offset // bw[pair]
+        e = coef[pair]
+        sx, sy = (px + .5)[:, None], (py + .5)[:, None]
+        w = e[:, 0::3] * sx + e[:, 1::3] * sy + e[:, 2::3]
+        inside = (w[:, :3] >= 0).all(axis=1)
+        pix = ((views[pair] * height + py) * width + px)[inside]
+        fz = (1 / w[inside, 3]).astype(np.float32)
+        face = faces[pair[inside]]
+        np.minimum.at(depth, pix, fz)
+        win = fz <= depth[pix]
+        owner[pix[win]] = face[win]
+    return owner.reshape(C, height, width), depth.reshape(C, height, width), cam
+
+
+def shade(owner, cam, f, matcap, background=(0, 0, 0)):
+    # looks up the view space face normals in the matcap image
+    f = triangulate(f)
+    C, height, width = owner.shape
+    images = np.empty((C, height, width, 3), dtype=np.uint8)
+    images[:] = background
+    size = matcap.shape[0]
+    for c in range(C):
+        hit = owner[c] >= 0
+        face = f[owner[c][hit]]
+        p = cam[c][face]
+        n = np.cross(p[:, 1] - p[:, 0], p[:, 2] - p[:, 0])
+        n /= np.linalg.norm(n, axis=1, keepdims=True).clip(1e-12)
+        # the side facing the camera, which looks down +z
+        n *= -np.sign(n[:, 2:3] + (n[:, 2:3] == 0))
+        # the camera frame is opencv's with x right and y down, so a normal
+        # pointing up in the image (blender view space y up) has y = -1 and
+        # reads the top row of the matcap
+        col = ((n[:, 0] * .5 + .5) * (size - 1)).round().astype(np.int64)
+        row = ((n[:, 1] * .5 + .5) * (size - 1)).round().astype(np.int64)
+        images[c][hit] = matcap[row, col]
+    return images
+
+
+def render(v, f, K, R, t, matcap, background=(0, 0, 0)):
+    owner, _, cam = rasterize(v, f, K, R, t)
+    return shade(owner, cam, f, matcap, background)
+
+
+_rig = {}
+
+
+def _init(camera_path, matcap_path):
+    K, R, t = cameras.load_rig(camera_path)
+    _rig.update(K=K, R=R, t=t, matcap=read_png(matcap_path))
+
+
+def render_file(params):
+    path, outfolder = params
+    mesh = read_mesh(path)
+    images = render(mesh.vertices, mesh.faces, _rig['K'], _rig['R'], _rig['t'],
+        _rig['matcap'])
+    outfolder.mkdir(parents=True, exist_ok=True)
+    for i, image in enumerate(images):
+        write_png(outfolder / ("%s_%d.png" % (path.stem, i)), image)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="folder searched for **/*.ply like blender_render.py")
+    parser.add_argument("output")
+    parser.add_argument("--cameras", required=True, help="cameras.json or caesar_cameras.json")
+    parser.add_argument("--matcap", default=str(MATCAP))
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--shard", type=int, default=0)
+    parser.add_argument("--num-shards", type=int, default=1)
+    parser.add_argument("--scans", default=None,
+        help="file with the scan names to render instead of the shard, - for stdin")
+    args = parser.parse_args()
+    folder, outfolder = Path(args.input), Path(args.output)
+    if args.scans is not None:
+        with (sys.stdin if args.scans == "-" else open(args.scans, 'r')) as f:
+            paths = [folder / (x.strip() + ".ply") for x in f if x.strip()]
+    else:
+        paths = sorted(folder.glob("**/*.ply"))[args.shard::args.num_shards]
+    tasks = [(path, outfolder / path.parent.relative_to(folder)) for path in paths]
+    with Pool(args.processes, _init, (args.cameras, args.matcap)) as p:
+        for path in p.imap_unordered(render_file, tasks):
+            print(path)
@@ -1 +1 @@
-meshlabserver -i $IN_DATA -o /output/test.ply -l x -s /root/scripts/poisson.mlx
+meshlabserver -i $IN_DATA -o ${OUT_DATA:-/output/test.ply} -l x -s /root/scripts/poisson.mlx
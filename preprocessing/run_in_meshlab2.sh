@@ -1 +1 @@
-meshlabserver -i $IN_DATA -o /scans/test.xyz -l x -m vn -s /root/scripts/sampling.mlx
+meshlabserver -i $IN_DATA -o ${OUT_DATA:-/scans/test.xyz} -l x -m vn -s /root/scripts/sampling.mlx
@@ -0,0 +1,7 @@
+# reads "input output" pairs from stdin and runs $SCRIPT on each of them,
+# so the container is started once per batch instead of once per scan
+status=0
+while read IN OUT; do
+	meshlabserver -i $IN -o $OUT -l x $MESHLAB_ARGS -s $SCRIPT < /dev/null || status=1
+done
+exit $status
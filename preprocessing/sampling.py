@@ -0,0 +1,213 @@
+import argparse
+from pathlib import Path
+import numpy as np
+from scipy import sparse
+
+# In-process replacement for the meshlab sampling.mlx / samplingDisk.mlx
+# filters and open3d sample_points_poisson_disk. Points are drawn area
+# weighted over the triangles with normals interpolated from the vertex
+# normals (Montecarlo Sampling with PerFaceNormal=false). poisson=True
+# oversamples and thins the result with a spatial hash grid to a blue noise
+# distribution (Poisson-disk Sampling). All functions accept a single mesh
+# (V, 3) or a batch (B, V, 3) of meshes that share the faces.
+
+SAMPLES = 20000
+MONTECARLO_RATE = 20
+
+
+def triangulate(f):
+    # quads and other fans are split into triangles around their first corner,
+    # f is a (F, k) array or the list of polygons read_mesh returns for
+    # mixed sizes
+    if isinstance(f, list):
+        sizes = sorted(set(len(x) for x in f if len(x) >= 3))
+        if not sizes:
+            return np.zeros([0, 3], dtype=np.int64)
+        return np.concatenate([triangulate(np.stack([x for x in f if len(x) == k]))
+            for k in sizes])
+    f = np.asarray(f, dtype=np.int64)
+    if f.shape[1] == 3:
+        return f
+    return np.concatenate([f[:, [0, k, k + 1]] for k in range(1, f.shape[1] - 1)])
+
+
+def vertex_normals(v, f):
+    # average of the normalized adjacent face normals, like open3d
+    # compute_vertex_normals and meshlab's default per vertex normals
+    v = np.asarray(v, dtype=np.float64)
+    f = triangulate(f)
+    batch = v.ndim == 3
+    if not batch:
+        v = v[None]
+    B, V, _ = v.shape
+    fn = np.cross(v[:, f[:, 1]] - v[:, f[:, 0]], v[:, f[:, 2]] - v[:, f[:, 0]])
+    length = np.linalg.norm(fn, axis=2, keepdims=True)
+    fn = np.divide(fn, length, out=np.zeros_like(fn), where=length > 0)
+    F = f.shape[0]
+    incidence = sparse.csr_matrix((np.ones(3 * F), (f.reshape(-1), np.repeat(np.arange(F), 3))),
+        shape=(V, F))
+    n = (incidence @ fn.transpose(1, 0, 2).reshape(F, B * 3)).reshape(V, B, 3).transpose(1, 0, 2)
+    length = np.linalg.norm(n, axis=2, keepdims=True)
+    n = np.divide(n, length, out=np.zeros_like(n), where=length > 0)
+    return n if batch else n[0]
+
+
+def _areas(v, f):
+    return .5 * np.linalg.norm(np.cross(v[:, f[:, 1]] - v[:, f[:, 0]],
+        v[:, f[:, 2]] - v[:, f[:, 0]]), axis=2)
+
+
+def montecarlo(v, f, count=SAMPLES, normals=None, rng=None):
+    # returns (B, count, 6) or (count, 6) arrays of points and normals
+    rng = np.random.default_rng(rng)
+    v = np.asarray(v, dtype=np.float64)
+    f = triangulate(f)
+    batch = v.ndim == 3
+    if not batch:
+        v = v[None]
+        if normals is not None:
+            normals = np.asarray(normals)[None]
+    if normals is None:
+        normals = vertex_normals(v, f)
+    B = v.shape[0]
+
+    # one searchsorted for the whole batch: row b of the cdf lives in [b, b+1]
+    area = _areas(v, f)
+    cdf = np.cumsum(area, axis=1)
+    cdf = cdf / cdf[:, -1:] + np.arange(B)[:, None]
+    u = rng.random((B, count)) + np.arange(B)[:, None]
+    face = np.searchsorted(cdf.reshape(-1), u.reshape(-1), side='right').reshape(B, count)
+    face = np.minimum(face - np.arange(B)[:, None] * f.shape[0], f.shape[0] - 1)
+
+    r1 = np.sqrt(rng.random((B, count)))
+    r2 = rng.random((B, count))
+    bary = np.stack([1 - r1, r1 * (1 - r2), r1 * r2], axis=2)
+    corners = f[face]
+    rows = np.arange(B)[:, None, None]
+    points = np.einsum('bnk,bnki->bni', bary, v[rows, corners])
+    n = np.einsum('bnk,bnki->bni', bary, normals[rows, corners])
+    length = np.linalg.norm(n, axis=2, keepdims=True)
+    n = np.divide(n, length, out=np.zeros_like(n), where=length > 0)
+    cloud = np.concatenate([points, n], axis=2).astype(np.float32)
+    return cloud if batch else cloud[0]
+
+
+def disk_radius(area, count):
+    # same estimate as meshlab's Poisson-disk filter
+    return np.sqrt(area / (0.7 * np.pi * count))
+
+
+_OFFSETS = np.stack(np.meshgrid(*[np.arange(-1, 2)] * 3, indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+def poisson_thin(points, radius, rng=None):
+    # Dart throwing over the candidates in random order, done in parallel
+    # rounds. Cells of the hash grid are radius wide and colored by the
+    # parity of their coordinates, so the next candidate of every cell of
+    # one color can be tested at once without conflicts between them.
+    # Returns the indices of the accepted points.
+    rng = np.random.default_rng(rng)
+    points = np.asarray(points, dtype=np.float64)
+    cells = np.floor((points - points.min(axis=0)) / radius).astype(np.int64) + 1
+    dims = cells.max(axis=0) + 2
+
+    def key(c):
+        return (c[..., 0] * dims[1] + c[..., 1]) * dims[2] + c[..., 2]
+
+    keys = key(cells)
+    # candidates grouped by cell, in random order within every cell
+    order = rng.permutation(len(points))
+    order = order[np.argsort(keys[order], kind='stable')]
+    _, start, count = np.unique(keys[order], return_index=True, return_counts=True)
+    first = order[start]
+    color = (cells[first, 0] % 2) * 4 + (cells[first, 1] % 2) * 2 + cells[first, 2] % 2
+    groups = [np.flatnonzero(color == c) for c in range(8)]
+
+    accepted = np.zeros(0, dtype=np.int64)
+    accepted_keys = np.zeros(0, dtype=np.int64)
+    occupancy = 1
+    r2 = radius * radius
+    for t in range(count.max()):
+        for c in range(8):
+            groups[c] = groups[c][count[groups[c]] > t]
+            if not len(groups[c]):
+                continue
+            chosen = order[start[groups[c]] + t]
+            neighbors = key(cells[chosen][:, None, :] + _OFFSETS[None])
+            lo = np.searchsorted(accepted_keys, neighbors, side='left')
+            hi = np.searchsorted(accepted_keys, neighbors, side='right')
+            ok = np.ones(len(chosen), dtype=bool)
+            for k in range(occupancy):
+                idx = lo + k
+                valid = idx < hi
+                if not valid.any():
+                    break
+                other = accepted[np.minimum(idx, len(accepted) - 1)]
+                d = ((points[other] - points[chosen][:, None, :]) ** 2).sum(axis=2)
+                ok &= ~(valid & (d < r2)).any(axis=1)
+            new = chosen[ok]
+            if len(new):
+                accepted = np.concatenate([accepted, new])
+                accepted_keys = np.concatenate([accepted_keys, keys[new]])
+                resort = np.argsort(accepted_keys, kind='stable')
+                accepted, accepted_keys = accepted[resort], accepted_keys[resort]
+                occupancy = max(occupancy, int(np.unique(accepted_keys,
+                    return_counts=True)[1].max()))
+    return np.sort(accepted)
+
+
+def sample(v, f, count=SAMPLES, normals=None, poisson=False, rate=MONTECARLO_RATE,
+        rng=None):
+    # the batch entry point, v is (V, 3) or (B, V, 3) with shared faces f
+    rng = np.random.default_rng(rng)
+    if not poisson:
+        return montecarlo(v, f, count, normals, rng)
+    v = np.asarray(v, dtype=np.float64)
+    f = triangulate(f)
+    batch = v.ndim == 3
+    if not batch:
+        v = v[None]
+        if normals is not None:
+            normals = np.asarray(normals)[None]
+    if normals is None:
+        normals = vertex_normals(v, f)
+    candidates = montecarlo(v, f, rate * count, normals, rng)
+    area = _areas(v, f).sum(axis=1)
+    clouds = []
+    for b in range(v.shape[0]):
+        radius = disk_radius(area[b], count)
+        keep = poisson_thin(candidates[b, :, :3], radius, rng)
+        while len(keep) < count:
+            radius *= .9
+            keep = poisson_thin(candidates[b, :, :3], radius, rng)
+        # drop the surplus at random to return exactly count points
+        keep = np.sort(rng.choice(keep, count, replace=False))
+        clouds.append(candidates[b, keep])
+    clouds = np.stack(clouds)
+    return clouds if batch else clouds[0]
+
+
+if __name__ == "__main__":
+    import scanio
+    from mesh_io import read_mesh
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mesh")
+    parser.add_argument("output", help=".xyz or .scan")
+    parser.add_argument("--count", type=int, default=SAMPLES)
+    parser.add_argument("--poisson", action="store_true",
+        help="blue noise thinning like samplingDisk.mlx")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    mesh = read_mesh(args.mesh)
+    # ply normals are per vertex. The vn of an obj belong to the face
+    # corners through the f v//vn indices, which read_mesh drops, so obj
+    # meshes get vertex normals computed from their faces.
+    normals = mesh.normals if Path(args.mesh).suffix.lower() == ".ply" else None
+    cloud = sample(mesh.vertices, triangulate(mesh.faces), args.count, normals, args.poisson,
+        rng=args.seed)
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    if output.suffix == scanio.SUFFIX:
+        scanio.write_scan(output, cloud)
+    else:
+        scanio.write_xyz(output, cloud)
@@ -0,0 +1,244 @@
+import os
+import argparse
+from pathlib import Path
+from multiprocessing import Pool
+import numpy as np
+
+# Binary container for point cloud scans. A file holds one or more scans,
+# every scan is a float32 array of shape (N, 6) with the point in the first
+# and the normal in the last three columns, the same layout as the .xyz
+# files written by meshlab and convert_caesar.ipynb.
+#
+# layout (little endian):
+#   header   magic "JOMSSCAN", version, number of scans, columns, flags, padding
+#   index    one INDEX_DTYPE record per scan
+#   data     scan arrays, each starting at a 64 byte aligned offset
+#
+# With the FLAG_LOD flag the points of every scan are in level of detail
+# order: the first LOD_POINTS are a farthest point sequence and the rest
+# follows in random order, so every prefix is an evenly spread subset and
+# the LEVELS are nested. A level is read as a prefix, e.g. load_scan(path,
+# count=1000), which only touches the pages of the first 1000 points.
+
+MAGIC = b"JOMSSCAN"
+VERSION = 1
+COLUMNS = 6
+ALIGN = 64
+SUFFIX = ".scan"
+FLAG_LOD = 1
+LEVELS = (1000, 5000, 20000)
+LOD_POINTS = 5000
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("version", "<u4"),
+    ("count", "<u4"),
+    ("columns", "<u4"),
+    ("flags", "<u4"),
+    ("reserved", "<u4", 2)])
+
+INDEX_DTYPE = np.dtype([
+    ("name", "S48"),
+    ("offset", "<u8"),
+    ("points", "<u8")])
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def read_xyz(path, count=None):
+    # count reads only the first lines
+    return np.loadtxt(str(path), dtype=np.float32, ndmin=2, max_rows=count)
+
+
+def write_xyz(path, cloud):
+    np.savetxt(str(path), cloud, delimiter=' ', fmt='%f')
+
+
+def _as_cloud(points, normals=None):
+    points = np.asarray(points, dtype=np.float32)
+    if normals is None:
+        assert points.ndim == 2 and points.shape[1] == COLUMNS
+        return np.ascontiguousarray(points)
+    normals = np.asarray(normals, dtype=np.float32)
+    return np.ascontiguousarray(np.hstack([points, normals]))
+
+
+def lod_order(points, count=LOD_POINTS, rng=0):
+    # permutation of the points, farthest point sampling for the first
+    # count, starting at the point farthest from the centroid
+    p = np.asarray(points, dtype=np.float32)[:, :3]
+    n = len(p)
+    count = min(count, n)
+    order = np.empty(n, dtype=np.int64)
+    distance = np.full(n, np.inf, dtype=np.float32)
+    # squared distances as |p|^2 - 2 p.q + |q|^2 without temporaries
+    sq = (p * p).sum(axis=1)
+    d = np.empty(n, dtype=np.float32)
+    i = int(np.argmax(((p - p.mean(axis=0)) ** 2).sum(axis=1)))
+    for k in range(count):
+        order[k] = i
+        np.dot(p, -2 * p[i], out=d)
+        d += sq
+        d += sq[i]
+        np.minimum(distance, d, out=distance)
+        i = int(np.argmax(distance))
+    rest = np.ones(n, dtype=bool)
+    rest[order[:count]] = False
+    order[count:] = np.random.default_rng(rng).permutation(np.flatnonzero(rest))
+    return order
+
+
+def write_scans(path, scans, lod=False):
+    # scans is a list of (name, cloud) with cloud of shape (N, 6), lod
+    # reorders the points of every scan with lod_order
+    scans = [(name, _as_cloud(cloud)) for name, cloud in scans]
+    if lod:
+        scans = [(name, cloud[lod_order(cloud)]) for name, cloud in scans]
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header["magic"] = MAGIC
+    header["version"] = VERSION
+    header["count"] = len(scans)
+    header["columns"] = COLUMNS
+    header["flags"] = FLAG_LOD if lod else 0
+    index = np.zeros(len(scans), dtype=INDEX_DTYPE)
+    offset = _align(HEADER_DTYPE.itemsize + INDEX_DTYPE.itemsize * len(scans))
+    for i, (name, cloud) in enumerate(scans):
+        encoded = name.encode("utf8")
+        if len(encoded) > INDEX_DTYPE["name"].itemsize:
+            raise ValueError("scan name too long: %s" % name)
+        index[i] = (encoded, offset, cloud.shape[0])
+        offset = _align(offset + cloud.nbytes)
+
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(header.tobytes())
+        f.write(index.tobytes())
+        for entry, (name, cloud) in zip(index, scans):
+            f.seek(int(entry["offset"]))
+            f.write(cloud.tobytes())
+        f.truncate(offset)
+    os.replace(tmp, path)
+
+
+def write_scan(path, points, normals=None, name=None, lod=False):
+    if name is None:
+        name = Path(path).stem
+    write_scans(path, [(name, _as_cloud(points, normals))], lod)
+
+
+class ScanFile:
+    def __init__(self, path):
+        self.path = Path(path)
+        self._raw = np.memmap(str(self.path), dtype=np.uint8, mode="r")
+        header = self._raw[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        if header["magic"] != MAGIC:
+            raise ValueError("%s is not a scan file" % self.path)
+        if header["version"] > VERSION:
+            raise ValueError("%s has unsupported version %d" % (self.path, header["version"]))
+        self.columns = int(header["columns"])
+        self.lod = bool(header["flags"] & FLAG_LOD)
+        start = HEADER_DTYPE.itemsize
+        stop = start + INDEX_DTYPE.itemsize * int(header["count"])
+        self.index = self._raw[start:stop].view(INDEX_DTYPE)
+        self.names = [x.decode("utf8") for x in self.index["name"]]
+        self._lookup = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._lookup
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __getitem__(self, key):
+        # returns a read only view into the mapped file, nothing is copied
+        i = self._lookup[key] if isinstance(key, str) else key
+        entry = self.index[i]
+        offset = int(entry["offset"])
+        n = int(entry["points"])
+        nbytes = n * self.columns * 4
+        return self._raw[offset:offset + nbytes].view("<f4").reshape(n, self.columns)
+
+    def level(self, key, count):
+        # count points of the scan, a prefix of a lod file. Other files
+        # have no useful order and are subsampled with a stride.
+        cloud = self[key]
+        if self.lod or count >= len(cloud):
+            return cloud[:count]
+        return cloud[np.linspace(0, len(cloud), count, endpoint=False).astype(np.int64)]
+
+    def points(self, key):
+        return self[key][:, :3]
+
+    def normals(self, key):
+        return self[key][:, 3:6]
+
+    def items(self):
+        for i, name in enumerate(self.names):
+            yield name, self[i]
+
+
+def load_scan(path, name=None, count=None):
+    # shared entry point for scripts and notebooks, works on .xyz and .scan.
+    # count gives a level of detail, the first count points of a lod file
+    # or of an .xyz written with write_xyz(path, cloud[lod_order(cloud)])
+    path = Path(path)
+    if path.suffix == SUFFIX:
+        scans = ScanFile(path)
+        key = 0 if name is None else name
+        return scans[key] if count is None else scans.level(key, count)
+    return read_xyz(path, count)
+
+
+def _convert_one(params):
+    source, target, lod = params
+    target.parent.mkdir(parents=True, exist_ok=True)
+    write_scan(target, read_xyz(source), name=source.stem, lod=lod)
+    return target
+
+
+def _pack_one(params):
+    folder, target, lod = params
+    sources = sorted(folder.glob("*.xyz"))
+    write_scans(target, [(x.stem, read_xyz(x)) for x in sources], lod)
+    return target
+
+
+def convert_tree(source, target, pack=False, processes=None, lod=False):
+    # mirrors source/<person>/<scan>.xyz into target/<person>/<scan>.scan,
+    # or into one target/<person>.scan per person folder with pack=True.
+    # lod stores the points in level of detail order.
+    source = Path(source)
+    target = Path(target)
+    if pack:
+        params = []
+        for folder in sorted(source.iterdir()):
+            if folder.is_dir() and any(folder.glob("*.xyz")):
+                params.append((folder, target / (folder.name + SUFFIX), lod))
+        target.mkdir(parents=True, exist_ok=True)
+        worker = _pack_one
+    else:
+        params = [(x, target / x.relative_to(source).with_suffix(SUFFIX), lod)
+            for x in sorted(source.glob("**/*.xyz"))]
+        worker = _convert_one
+    with Pool(processes=processes or os.cpu_count()) as p:
+        for result in p.imap_unordered(worker, params):
+            print(result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="folder with <person>/<scan>.xyz files")
+    parser.add_argument("target")
+    parser.add_argument("--pack", action="store_true",
+        help="write one file per person instead of one file per scan")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--lod", action="store_true",
+        help="store the points in level of detail order, see LEVELS")
+    args = parser.parse_args()
+    convert_tree(args.source, args.target, args.pack, args.processes, args.lod)
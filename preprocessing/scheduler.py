@@ -0,0 +1,381 @@
+import sqlite3
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from queue import Queue
+
+from instrument import run_command
+
+# Runs preprocessing jobs on per-stage worker pools. Every job has a stage
+# name and a key (usually the scan or person), a shell command and the jobs
+# it depends on. Finished jobs are recorded in a sqlite ledger so that an
+# interrupted run picks up where it stopped. Jobs that declare their inputs
+# are instead looked up in a content addressed cache (cache.py) when they
+# become ready, so that changed scans, scripts or cameras are recomputed.
+# A done job still runs again when one of its dependencies finished after it
+# or executes in this run, which covers the stages without outputs (the
+# keypoint store, the joints) that only depend on their upstream jobs.
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+CACHED = "cached"
+
+# seconds a batch output may appear older than the start of its batch
+MTIME_SLACK = 0.05
+
+
+class Job:
+    def __init__(self, stage, key, command=None, deps=(), outputs=(), before=None,
+            args=(), inputs=(), params=()):
+        self.stage = stage
+        self.key = key
+        # command is either a shell string or a callable that receives the
+        # device assigned by the stage (None for cpu stages). Jobs of batched
+        # stages carry their per item arguments in args instead.
+        self.command = command
+        self.args = args
+        self.deps = list(deps)
+        self.outputs = [Path(x) for x in outputs]
+        self.before = before
+        # files and values the outputs depend on, the cache key of the job
+        self.inputs = [Path(x) for x in inputs]
+        self.params = list(params)
+
+    @property
+    def id(self):
+        return (self.stage, self.key)
+
+    def shell(self, device):
+        if callable(self.command):
+            return self.command(device)
+        return self.command
+
+
+class Stage:
+    # batch is a callable (jobs, device) -> shell command that processes
+    # up to batch_size jobs in one go, e.g. with a single container launch
+    def __init__(self, name, workers=1, devices=None, batch=None, batch_size=1):
+        self.name = name
+        self.batch = batch
+        self.batch_size = batch_size if batch is not None else 1
+        if devices:
+            devices = list(devices)
+            workers = max(workers, len(devices))
+            # every worker slot owns one device, devices are shared round robin
+            self.devices = [devices[i % len(devices)] for i in range(workers)]
+        else:
+            self.devices = [None] * workers
+        self.workers = workers
+
+
+class Ledger:
+    def __init__(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(str(path))
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            stage TEXT NOT NULL,
+            key TEXT NOT NULL,
+            status TEXT NOT NULL,
+            command TEXT,
+            device TEXT,
+            started REAL,
+            finished REAL,
+            message TEXT,
+            PRIMARY KEY (stage, key))''')
+        self.db.commit()
+
+    def status(self, stage, key):
+        row = self.db.execute("SELECT status FROM jobs WHERE stage=? AND key=?",
+            (stage, key)).fetchone()
+        return row[0] if row else PENDING
+
+    def mark(self, stage, key, status, command=None, device=None, message=None):
+        now = time.time()
+        if status == RUNNING:
+            self.db.execute('''INSERT OR REPLACE INTO jobs
+                (stage, key, status, command, device, started, finished, message)
+                VALUES (?,?,?,?,?,?,NULL,NULL)''',
+                (stage, key, status, command, None if device is None else str(device), now))
+        else:
+            cur = self.db.execute('''UPDATE jobs SET status=?, finished=?, message=?
+                WHERE stage=? AND key=?''', (status, now, message, stage, key))
+            if cur.rowcount == 0:
+                self.db.execute('''INSERT INTO jobs (stage, key, status, finished, message)
+                    VALUES (?,?,?,?,?)''', (stage, key, status, now, message))
+        self.db.commit()
+
+    def finished(self, stage, key):
+        row = self.db.execute("SELECT finished FROM jobs WHERE stage=? AND key=?",
+            (stage, key)).fetchone()
+        return row[0] if row and row[0] is not None else 0.0
+
+    def reset(self, stage):
+        self.db.execute("DELETE FROM jobs WHERE stage=?", (stage,))
+        self.db.commit()
+
+    def summary(self):
+        return self.db.execute('''SELECT stage, status, COUNT(*) FROM jobs
+            GROUP BY stage, status ORDER BY stage, status''').fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+class Scheduler:
+    def __init__(self, stages, ledger, dry_run=False, cache=None, redo=(), metrics=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.ledger = ledger
+        self.dry_run = dry_run
+        self.cache = None if dry_run else cache
+        # stages that run again without looking into the cache
+        self.redo = set(redo)
+        # instrument.Metrics that gets one record per finished item
+        self.metrics = None if dry_run else metrics
+
+    def _record(self, job, status, started, usage=None, device=None, batch=1):
+        if self.metrics is not None:
+            self.metrics.record(job, status, started, usage, device, batch)
+
+    def cached(self, job):
+        return self.cache is not None and job.outputs and job.inputs
+
+    def is_done(self, job):
+        if self.cached(job):
+            # decided by the cache once the inputs are there
+            return False
+        if self.ledger.status(job.stage, job.key) != DONE:
+            return False
+        return all(path.exists() for path in job.outputs)
+
+    def _lookup(self, job):
+        # the cache key of the job, None if its outputs were restored from the
+        # cache and False if the cache does not apply
+        if not self.cached(job):
+            return False
+        try:
+            key = self.cache.key(job.stage, job.inputs, job.params)
+        except OSError:
+            # missing inputs, the command itself will report them
+            return False
+        if job.stage not in self.redo and self.cache.fetch(job.stage, key, job.outputs):
+            return None
+        return key
+
+    def _execute(self, job, devices, results):
+        started = time.time()
+        key = self._lookup(job)
+        if key is None:
+            self._record(job, CACHED, started)
+            results.put((job, CACHED, None, None))
+            return
+        device = devices.get()
+        command = None
+        usage = None
+        try:
+            command = job.shell(device)
+            results.put((job, RUNNING, command, device))
+            if not self.dry_run:
+                if job.before is not None:
+                    job.before()
+                started = time.time()
+                code, usage = run_command(command)
+                if code != 0:
+                    raise subprocess.CalledProcessError(code, command)
+                missing = [str(path) for path in job.outputs if not path.exists()]
+                if missing:
+                    raise RuntimeError("missing outputs: " + ", ".join(missing))
+                if key:
+                    self.cache.store(job.stage, key, job.outputs)
+            self._record(job, DONE, started, usage, device)
+            results.put((job, DONE, None, device))
+        except Exception as e:
+            self._record(job, FAILED, started, usage, device)
+            results.put((job, FAILED, str(e), device))
+        finally:
+            devices.put(device)
+
+    def _execute_batch(self, jobs, stage, devices, results):
+        keys = {}
+        for job in jobs:
+            started = time.time()
+            keys[job.id] = self._lookup(job)
+            if keys[job.id] is None:
+                self._record(job, CACHED, started)
+                results.put((job, CACHED, None, None))
+        jobs = [job for job in jobs if keys[job.id] is not None]
+        if not jobs:
+            return
+        device = devices.get()
+        started = time.time()
+        reported = set()
+        try:
+            command = stage.batch(jobs, device)
+            for job in jobs:
+                results.put((job, RUNNING, command, device))
+            if self.dry_run:
+                for job in jobs:
+                    results.put((job, DONE, None, device))
+                return
+            started = time.time()
+            for job in jobs:
+                if job.before is not None:
+                    job.before()
+            code, usage = run_command(command)
+            # a failing item must not fail the whole batch, so every job is
+            # judged by the outputs it wrote during this run. File times come
+            # from the coarse kernel clock and can trail time.time() a little.
+            for job in jobs:
+                missing = [str(path) for path in job.outputs
+                    if not path.exists() or path.stat().st_mtime < started - MTIME_SLACK]
+                try:
+                    if missing:
+                        raise RuntimeError("exit code %d, missing outputs: %s"
+                            % (code, ", ".join(missing)))
+                    if keys[job.id]:
+                        self.cache.store(job.stage, keys[job.id], job.outputs)
+                    self._record(job, DONE, started, usage, device, len(jobs))
+                except Exception as e:
+                    self._record(job, FAILED, started, usage, device, len(jobs))
+                    results.put((job, FAILED, str(e), device))
+                else:
+                    results.put((job, DONE, None, device))
+                reported.add(job.id)
+        except Exception as e:
+            # every job gets exactly one result
+            for job in jobs:
+                if job.id not in reported:
+                    self._record(job, FAILED, started, None, device, len(jobs))
+                    results.put((job, FAILED, str(e), device))
+        finally:
+            devices.put(device)
+
+    def _submit(self, executors, devices, ready, results):
+        for name, batch in ready.items():
+            stage = self.stages[name]
+            if stage.batch is None:
+                for job in batch:
+                    executors[name].submit(self._execute, job, devices[name], results)
+                continue
+            # split evenly so that all workers of the stage get a share
+            size = -(-len(batch) // stage.workers)
+            size = max(1, min(stage.batch_size, size))
+            for i in range(0, len(batch), size):
+                executors[name].submit(self._execute_batch, batch[i:i+size],
+                    stage, devices[name], results)
+
+    def run(self, jobs):
+        jobs = [job for job in jobs if job.stage in self.stages]
+        ids = set(job.id for job in jobs)
+        finished = set()
+        failed = set()
+        pending = {}
+        for job in jobs:
+            if self.is_done(job):
+                finished.add(job.id)
+            else:
+                pending[job.id] = job
+        # done jobs behind a pending dependency only run again if that
+        # dependency executes, a cache hit leaves them alone
+        conditional = set()
+        changed = True
+        while changed:
+            changed = False
+            for job in jobs:
+                if job.id not in finished:
+                    continue
+                deps = [d for d in job.deps if d in ids]
+                stamp = self.ledger.finished(job.stage, job.key)
+                if any(self.ledger.finished(*d) > stamp for d in deps):
+                    # an upstream job ran again after this one
+                    finished.discard(job.id)
+                    pending[job.id] = job
+                    changed = True
+                elif any(d not in finished for d in deps):
+                    finished.discard(job.id)
+                    pending[job.id] = job
+                    conditional.add(job.id)
+                    changed = True
+        executed = set()
+        print("%d jobs, %d already done" % (len(jobs), len(finished)))
+
+        executors = {}
+        devices = {}
+        for name, stage in self.stages.items():
+            executors[name] = ThreadPoolExecutor(max_workers=stage.workers,
+                thread_name_prefix=name)
+            devices[name] = Queue()
+            for device in stage.devices:
+                devices[name].put(device)
+
+        results = Queue()
+        running = 0
+        last_command = None
+        try:
+            while pending or running:
+                ready = {}
+                resolved = True
+                while resolved:
+                    resolved = False
+                    for ident, job in list(pending.items()):
+                        # dependencies outside of this run count as satisfied
+                        deps = [d for d in job.deps if d in ids]
+                        if any(d in failed for d in deps):
+                            del pending[ident]
+                            failed.add(ident)
+                            self.ledger.mark(job.stage, job.key, SKIPPED,
+                                message="dependency failed")
+                            continue
+                        if not all(d in finished for d in deps):
+                            continue
+                        del pending[ident]
+                        if ident in conditional and not any(d in executed for d in deps):
+                            print("[%s] %s: up to date" % (job.stage, job.key))
+                            finished.add(ident)
+                            if not self.dry_run:
+                                self.ledger.mark(job.stage, job.key, DONE)
+                            resolved = True
+                            continue
+                        ready.setdefault(job.stage, []).append(job)
+                        running += 1
+                self._submit(executors, devices, ready, results)
+                if not running:
+                    break
+                # take everything that finished meanwhile, so that jobs which
+                # become ready together are also batched together
+                messages = [results.get()]
+                while not results.empty():
+                    messages.append(results.get())
+                for job, status, info, device in messages:
+                    if status == RUNNING:
+                        if info == last_command:
+                            print("[%s] %s" % (job.stage, job.key))
+                        else:
+                            print("[%s] %s: %s" % (job.stage, job.key, info))
+                        last_command = info
+                        if not self.dry_run:
+                            self.ledger.mark(job.stage, job.key, RUNNING, command=info,
+                                device=device)
+                        continue
+                    running -= 1
+                    if status == CACHED:
+                        print("[%s] %s: cached" % (job.stage, job.key))
+                    elif status == DONE:
+                        executed.add(job.id)
+                    if status in (DONE, CACHED):
+                        finished.add(job.id)
+                        if not self.dry_run:
+                            self.ledger.mark(job.stage, job.key, DONE)
+                    else:
+                        failed.add(job.id)
+                        print("[%s] %s failed: %s" % (job.stage, job.key, info))
+                        self.ledger.mark(job.stage, job.key, FAILED, message=info)
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+        return finished, failed
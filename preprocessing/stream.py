@@ -0,0 +1,188 @@
+import sys
+import time
+import shutil
+import argparse
+import threading
+import subprocess
+from pathlib import Path
+from queue import Queue, Empty
+
+from instrument import run_command
+from commands import (BLENDER_IMAGE, OPENPOSE_IMAGE, blenderCommandTemplate,
+    rasterCommandTemplate)
+
+# Overlapped rendering and pose estimation for the scans of one person.
+# The scans are rendered in chunks (chunk k of n hands the scans [k::n]
+# to blender_render.py or raster.py on stdin) into a staging folder, by
+# default on tmpfs. Finished chunks go through a bounded queue to one long running
+# openpose container per gpu, which reads chunk folders from stdin and
+# writes the keypoint json files straight to the output. A chunk is
+# deleted as soon as its keypoints are written, so the 1600x1200 images
+# never reach dataset/flat_images. When the queue is full the renderers
+# wait, which keeps the staging folder at no more than queue + renderers
+# + gpus chunks.
+#
+#   python preprocessing/stream.py dataset/poisson/50002 dataset/pose2d/50002 \
+#       --cameras cameras.json --gpus 0,1
+
+# reads one chunk folder per line and answers "done <chunk> <exit code>",
+# openpose itself prints to stderr so that stdout only has the answers
+openposeLoopTemplate = '''docker run --rm -i \
+-v %s:/staging \
+-v %s:/output --net=host --gpus '"device=%s"' %s \
+bash -c 'while read chunk; do \
+./build/examples/openpose/openpose.bin --display 0 --image_dir=/staging/$chunk/ \
+--face --hand --write_json=/output/ 1>&2; echo "done $chunk $?"; done' '''
+
+
+class PoseWorker:
+    def __init__(self, device, staging, output, image=OPENPOSE_IMAGE):
+        self.device = device
+        command = openposeLoopTemplate % (staging, output, device, image)
+        self.process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, text=True, bufsize=1)
+
+    def process_chunk(self, chunk):
+        # True if openpose went through the chunk folder
+        self.process.stdin.write(chunk + "\n")
+        self.process.stdin.flush()
+        for line in self.process.stdout:
+            parts = line.split()
+            if len(parts) == 3 and parts[0] == "done" and parts[1] == chunk:
+                return parts[2] == "0"
+        raise RuntimeError("openpose worker on gpu %s exited" % self.device)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        return self.process.wait()
+
+
+def stream(source, output, camera, gpus, chunks, queue_size=2, staging="/dev/shm/joms",
+        cpu_render=False, render_workers=None, batched=False,
+        blender_image=BLENDER_IMAGE, openpose_image=OPENPOSE_IMAGE, scans=None):
+    # renders the scans (names of source/*.ply, all by default) in chunks
+    # and estimates the poses into output, returns the chunks that failed
+    source = Path(source).absolute()
+    if scans is None:
+        scans = sorted(x.stem for x in source.glob("*.ply"))
+    output = Path(output).absolute()
+    person = source.name
+    staging = Path(staging).absolute()
+    output.mkdir(parents=True, exist_ok=True)
+    work = Queue()
+    for k in range(chunks):
+        work.put(k)
+    rendered = Queue(maxsize=queue_size)
+    failed = []
+    lock = threading.Lock()
+    render_workers = render_workers or len(gpus)
+
+    def fail(k, message):
+        with lock:
+            failed.append(k)
+        print("[stream] %s chunk %d failed: %s" % (person, k, message))
+
+    def render(device):
+        while True:
+            try:
+                k = work.get_nowait()
+            except Empty:
+                return
+            folder = staging / person / str(k)
+            names = "\n".join(scans[k::chunks])
+            try:
+                folder.mkdir(parents=True, exist_ok=True)
+                if cpu_render:
+                    command = rasterCommandTemplate % (source, folder, camera, names)
+                else:
+                    command = blenderCommandTemplate % (source, folder, camera, batched,
+                        device, blender_image, names)
+                code, usage = run_command(command)
+                if code != 0:
+                    raise RuntimeError("render exit code %d" % code)
+            except Exception as e:
+                # a renderer that died would leave its chunks unaccounted for
+                shutil.rmtree(folder, ignore_errors=True)
+                fail(k, str(e))
+                continue
+            print("[stream] %s chunk %d rendered in %.1fs" % (person, k, usage["wall"]))
+            # blocks while queue_size chunks wait for openpose
+            rendered.put(k)
+
+    def estimate(device):
+        # keeps taking chunks after the worker died, so that no renderer
+        # waits forever on a full queue
+        worker = PoseWorker(device, staging, output, openpose_image)
+        while True:
+            k = rendered.get()
+            if k is None:
+                break
+            start = time.time()
+            chunk = "%s/%d" % (person, k)
+            try:
+                if worker is None:
+                    raise RuntimeError("openpose worker on gpu %s exited" % device)
+                if worker.process_chunk(chunk):
+                    print("[stream] %s chunk %d estimated in %.1fs" % (person, k,
+                        time.time() - start))
+                else:
+                    fail(k, "openpose failed")
+            except (RuntimeError, OSError) as e:
+                fail(k, str(e))
+                worker = None
+            shutil.rmtree(staging / chunk, ignore_errors=True)
+        if worker is not None:
+            worker.close()
+
+    renderers = [threading.Thread(target=render, args=(gpus[i % len(gpus)],))
+        for i in range(render_workers)]
+    estimators = [threading.Thread(target=estimate, args=(device,)) for device in gpus]
+    for thread in renderers + estimators:
+        thread.start()
+    for thread in renderers:
+        thread.join()
+    for _ in estimators:
+        rendered.put(None)
+    for thread in estimators:
+        thread.join()
+    shutil.rmtree(staging / person, ignore_errors=True)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="folder with the poisson .ply files of a person")
+    parser.add_argument("output", help="folder for the openpose json files")
+    parser.add_argument("--cameras", default="cameras.json",
+        help="camera file in JOMS/template_human")
+    parser.add_argument("--gpus", default="0", help="comma separated gpu devices")
+    parser.add_argument("--chunk", type=int, default=4, help="scans per chunk")
+    parser.add_argument("--queue", type=int, default=2,
+        help="rendered chunks that may wait for openpose")
+    parser.add_argument("--staging", default="/dev/shm/joms",
+        help="folder for the images in flight")
+    parser.add_argument("--cpu-render", action="store_true",
+        help="rasterize with raster.py instead of blender")
+    parser.add_argument("--render-workers", type=int, default=None,
+        help="concurrent render chunks, one per gpu by default")
+    parser.add_argument("--batched", action="store_true", help="multiview blender pass")
+    parser.add_argument("--blender-image", default=BLENDER_IMAGE)
+    parser.add_argument("--openpose-image", default=OPENPOSE_IMAGE)
+    parser.add_argument("--scans", default=None,
+        help="file with the scan names to render, - for stdin, all .ply files by default")
+    args = parser.parse_args()
+    gpus = [x.strip() for x in args.gpus.split(',') if x.strip()]
+    if args.scans is not None:
+        with (sys.stdin if args.scans == "-" else open(args.scans, 'r')) as f:
+            scans = [x.strip() for x in f if x.strip()]
+    else:
+        scans = sorted(x.stem for x in Path(args.source).glob("*.ply"))
+    chunks = max(1, -(-len(scans) // args.chunk))
+    failed = stream(args.source, args.output, args.cameras, gpus, chunks, args.queue,
+        args.staging, args.cpu_render, args.render_workers, args.batched,
+        args.blender_image, args.openpose_image, scans)
+    if failed:
+        sys.exit("%d chunks failed" % len(failed))
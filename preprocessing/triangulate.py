@@ -0,0 +1,156 @@
+import argparse
+from pathlib import Path
+import numpy as np
+
+import cameras
+from keypoints import KeypointStore, PARTS
+
+# Triangulates the OpenPose joints of every scan from its 8 views. Each
+# joint is solved with a confidence weighted DLT, then the view with the
+# largest reprojection error is dropped while it is above the threshold and
+# enough views are left. Views with several detections keep the one that
+# agrees best with a first triangulation from the most confident ones.
+#
+# The result per scan is dataset/joints3d/<person>/<scan>.npy of shape
+# (joints, 5): x, y, z, mean reprojection error in pixels and the number of
+# inlier views. Rejected joints are nan with 0 views.
+#
+#   python triangulate.py dataset/keypoints.h5 JOMS/template_human/cameras.json \
+#       dataset/joints3d --persons 50002
+
+THRESHOLD = 15.0
+MIN_VIEWS = 2
+MIN_CONFIDENCE = 0.05
+
+
+def dlt(P, uv, weight):
+    # P (C, 3, 4), uv (..., C, 2) and weight (..., C) to points (..., 3).
+    # The solution is the eigenvector of A^T A with the smallest eigenvalue.
+    A = np.stack([uv[..., 0, None] * P[:, 2] - P[:, 0],
+                  uv[..., 1, None] * P[:, 2] - P[:, 1]], axis=-2)
+    A = A * weight[..., None, None]
+    A = A.reshape(A.shape[:-3] + (-1, 4))
+    _, vectors = np.linalg.eigh(np.einsum('...ki,...kj->...ij', A, A))
+    X = vectors[..., 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return X[..., :3] / X[..., 3:]
+
+
+def reprojection(X, uv, K, R, t):
+    # pixel errors (..., C) of points (..., 3) against uv (..., C, 2)
+    shape = X.shape[:-1]
+    projected, z = cameras.project(X.reshape(-1, 3), K, R, t)
+    projected = np.moveaxis(projected, 0, 1).reshape(shape + (-1, 2))
+    z = np.moveaxis(z, 0, 1).reshape(shape + (-1,))
+    error = np.linalg.norm(projected - uv, axis=-1)
+    return np.where(z > 0, error, np.inf)
+
+
+def triangulate(uv, confidence, K, R, t, threshold=THRESHOLD, min_views=MIN_VIEWS):
+    # uv (..., C, 2) with confidence (..., C), 0 for missing views.
+    # Returns the points (..., 3), mean inlier errors (...) and the inlier
+    # mask (..., C).
+    P = cameras.projection_matrices(K, R, t)
+    weight = np.asarray(confidence, dtype=np.float64).copy()
+    for _ in range(uv.shape[-2] - min_views + 1):
+        X = dlt(P, uv, weight)
+        error = np.where(weight > 0, reprojection(X, uv, K, R, t), 0)
+        worst = np.argmax(error, axis=-1)
+        worst_error = np.take_along_axis(error, worst[..., None], axis=-1)[..., 0]
+        drop = (worst_error > threshold) & ((weight > 0).sum(axis=-1) > min_views)
+        if not drop.any():
+            break
+        np.put_along_axis(weight, worst[..., None],
+            np.where(drop, 0, np.take_along_axis(weight, worst[..., None], axis=-1)[..., 0])[..., None],
+            axis=-1)
+    inliers = weight > 0
+    error = np.where(inliers, reprojection(X, uv, K, R, t), 0)
+    views = inliers.sum(axis=-1)
+    with np.errstate(invalid='ignore'):
+        mean = error.sum(axis=-1) / views
+    # points at infinity (X[3] == 0) come out as inf or nan
+    bad = (views < min_views) | (mean > threshold) | ~np.isfinite(X).all(axis=-1)
+    X[bad] = np.nan
+    mean[bad] = np.nan
+    inliers[bad] = False
+    return X, mean, inliers
+
+
+def select_detections(store, person, scan, K, R, t, part="pose",
+        min_confidence=MIN_CONFIDENCE):
+    # (C, joints, 3) with one detection per view. The most confident
+    # detection of every view gives a first estimate, then each view keeps
+    # the detection with the smallest median reprojection error to it.
+    C = len(K)
+    size = PARTS[part]
+    views = []
+    for c in range(C):
+        if (person, scan, c) in store:
+            values, mask = store.view(person, scan, c, part)
+            views.append(np.where(mask[:, :, None], values, 0))
+        else:
+            views.append(np.zeros([0, size, 3], dtype=np.float32))
+    best = np.zeros([C, size, 3], dtype=np.float32)
+    for c, values in enumerate(views):
+        if len(values):
+            best[c] = values[np.argmax(values[:, :, 2].sum(axis=1))]
+    if all(len(values) <= 1 for values in views):
+        return best
+    confidence = np.where(best[:, :, 2] >= min_confidence, best[:, :, 2], 0).T
+    X, _, _ = triangulate(best[:, :, :2].transpose(1, 0, 2), confidence, K, R, t)
+    for c, values in enumerate(views):
+        if len(values) > 1:
+            uv, z = cameras.project(np.nan_to_num(X), K[c:c + 1], R[c:c + 1], t[c:c + 1])
+            error = np.linalg.norm(values[:, :, :2] - uv[0][None], axis=2)
+            found = (values[:, :, 2] >= min_confidence) & ~np.isnan(X[:, 0])[None]
+            error = np.where(found, error, np.nan)
+            with np.errstate(all='ignore'):
+                median = np.nanmedian(np.where(found.any(axis=1)[:, None], error, np.inf), axis=1)
+            best[c] = values[np.argmin(median)]
+    return best
+
+
+def triangulate_person(store, person, K, R, t, part="pose", threshold=THRESHOLD,
+        min_views=MIN_VIEWS, min_confidence=MIN_CONFIDENCE):
+    # all scans of a person in one batch, returns the names and (S, joints, 5)
+    scans = store.scans(person)
+    if not scans:
+        return scans, np.zeros([0, PARTS[part], 5], dtype=np.float32)
+    values = np.stack([select_detections(store, person, scan, K, R, t, part,
+        min_confidence) for scan in scans])
+    # (S, joints, C, ...) so that the views are the last batch axis
+    uv = values[:, :, :, :2].transpose(0, 2, 1, 3)
+    confidence = values[:, :, :, 2].transpose(0, 2, 1)
+    confidence = np.where(confidence >= min_confidence, confidence, 0)
+    X, error, inliers = triangulate(uv, confidence, K, R, t, threshold, min_views)
+    joints = np.concatenate([X, error[..., None], inliers.sum(axis=-1)[..., None]], axis=-1)
+    return scans, joints.astype(np.float32)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store", help="hdf5 file written by keypoints.py")
+    parser.add_argument("cameras", help="cameras.json or caesar_cameras.json of the persons")
+    parser.add_argument("output", help="folder for <person>/<scan>.npy")
+    parser.add_argument("--persons", default="",
+        help="comma separated persons, all persons in the store by default")
+    parser.add_argument("--part", default="pose", choices=list(PARTS))
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+        help="largest accepted reprojection error in pixels")
+    parser.add_argument("--min-views", type=int, default=MIN_VIEWS)
+    parser.add_argument("--min-confidence", type=float, default=MIN_CONFIDENCE)
+    args = parser.parse_args()
+    K, R, t = cameras.load_rig(args.cameras)
+    with KeypointStore(args.store) as store:
+        persons = [x.strip() for x in args.persons.split(',') if x.strip()] or store.persons()
+        for person in persons:
+            scans, joints = triangulate_person(store, person, K, R, t, args.part,
+                args.threshold, args.min_views, args.min_confidence)
+            folder = Path(args.output) / person
+            folder.mkdir(parents=True, exist_ok=True)
+            for scan, values in zip(scans, joints):
+                np.save(folder / (scan + ".npy"), values)
+            found = np.isfinite(joints[:, :, 0])
+            print("%s: %d scans, %.1f%% joints triangulated, mean error %.2fpx" % (person,
+                len(scans), 100 * found.mean() if found.size else 0,
+                np.nanmean(joints[:, :, 3]) if found.any() else np.nan))
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import argparse
+import itertools
+import traceback
+from pathlib import Path
+from multiprocessing import Pool
+import numpy as np
+from tqdm import tqdm
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "preprocessing"))
+import scanio
+import sampling
+from topology import caesar_topology, face_topology
+
+# Command line version of convert and convert_dfaust from convert_caesar.ipynb.
+# Tasks only carry names and frame indices. Every worker opens the input
+# files itself, so nothing large is pickled and the number of tasks in
+# flight is bounded, which keeps memory flat for any number of sequences.
+#
+#   python convert.py caesar caesar-fitted-meshes ../dataset/scans
+#   python convert.py dfaust dfaust ../dataset/scans
+
+SAMPLES = 20000
+
+
+def sample_cloud(v, f, normals, samples=SAMPLES):
+    # the notebook version, only used with --sampler open3d
+    # f are the triangles to sample from and normals the vertex normals,
+    # both come from the cached topology instead of being rebuilt per scan
+    import open3d as o3d #install with conda
+    vmesh = o3d.utility.Vector3dVector(v)
+    fmesh = o3d.utility.Vector3iVector(f)
+    mesh = o3d.geometry.TriangleMesh(vmesh,fmesh)
+    mesh.vertex_normals = o3d.utility.Vector3dVector(normals)
+
+    o3dCloud = mesh.sample_points_poisson_disk(samples)
+    cloudv = np.asarray(o3dCloud.points)
+    cloudn = np.asarray(o3dCloud.normals)
+    return np.hstack([cloudv,cloudn]).astype(np.float32)
+
+
+def convert_mesh(v, topology, sampler='native'):
+    faces = topology['faces']
+    normals = sampling.vertex_normals(v, faces)
+    if sampler == 'open3d':
+        return sample_cloud(v, faces[topology['largest']], normals)
+    return sampling.sample(v, faces[topology['largest']], SAMPLES, normals, poisson=True)
+
+
+def write_cloud(dest, cloud):
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if dest.suffix == scanio.SUFFIX:
+        scanio.write_scan(dest, cloud)
+    else:
+        scanio.write_xyz(dest, cloud)
+
+
+class Guarded:
+    # runs worker on a task and returns (task, None) or (task, error), so
+    # that one corrupt input does not end the conversion
+    def __init__(self, worker):
+        self.worker = worker
+
+    def __call__(self, task):
+        try:
+            self.worker(task)
+            return task, None
+        except Exception:
+            return task, traceback.format_exc(limit=3)
+
+
+def run(worker, tasks, processes, initializer=None, initargs=(), total=None):
+    # returns the tasks that failed. Pool.imap would drain the generator at
+    # once, so the tasks are handed out in slices of 4 per process.
+    processes = processes or os.cpu_count()
+    tasks = iter(tasks)
+    failed = []
+    with Pool(processes=processes, initializer=initializer, initargs=initargs) as p:
+        with tqdm(total=total) as pbar:
+            while True:
+                chunk = list(itertools.islice(tasks, 4 * processes))
+                if not chunk:
+                    break
+                for task, error in p.imap_unordered(Guarded(worker), chunk):
+                    if error is not None:
+                        failed.append(task)
+                        tqdm.write("failed %s:\n%s" % (task, error))
+                    pbar.update()
+    return failed
+
+
+# CAESAR ---------------------------------------------------------------------
+
+_caesar = {}
+
+
+def _init_caesar(topology, target_folder, suffix, sampler):
+    _caesar.update(topology=topology, target_folder=target_folder, suffix=suffix,
+        sampler=sampler)
+
+
+def convert_caesar(source_path):
+    from scipy.io import loadmat
+    name = source_path.stem
+    dest = _caesar['target_folder'] / name / (name + _caesar['suffix'])
+    if not dest.is_file():
+        v = loadmat(source_path)['points'] / 1000
+        write_cloud(dest, convert_mesh(v, _caesar['topology'], _caesar['sampler']))
+
+
+def caesar(args):
+    source_folder = Path(args.source)
+    target_folder = Path(args.target).absolute()
+    tasks = (x for x in sorted(source_folder.iterdir()) if x.suffix == '.mat')
+    total = sum(1 for x in source_folder.iterdir() if x.suffix == '.mat')
+    return run(convert_caesar, tasks, args.processes, _init_caesar,
+        (caesar_topology(cache_dir=args.cache), target_folder, args.suffix, args.sampler),
+        total)
+
+
+# DFAUST ---------------------------------------------------------------------
+
+_dfaust = {}
+
+
+def _init_dfaust(target_folder, suffix, sampler):
+    _dfaust.update(target_folder=target_folder, suffix=suffix, sampler=sampler,
+        files={}, topology={})
+
+
+def _registrations(path):
+    import h5py
+    files = _dfaust['files']
+    if path not in files:
+        files[path] = h5py.File(path, 'r')
+        _dfaust['topology'][path] = face_topology(files[path]['faces'][()])
+    return files[path], _dfaust['topology'][path]
+
+
+def convert_dfaust(params):
+    path, key, frame, person_name, scan_name = params
+    dest = _dfaust['target_folder'] / person_name / (scan_name + _dfaust['suffix'])
+    if not dest.is_file():
+        g, topology = _registrations(path)
+        # read a single frame of the (V, 3, T) sequence
+        v = g[key][:, :, frame]
+        write_cloud(dest, convert_mesh(v, topology, _dfaust['sampler']))
+
+
+def dfaust_tasks(source_folder, mapper):
+    import h5py
+    for sex in ['m','f']:
+        path = str(source_folder / ('registrations_%s.hdf5' % sex))
+        with h5py.File(path, 'r') as g:
+            sequences = [(k, g[k].shape[2]) for k in g.keys() if k != 'faces']
+        for k, frames in sequences:
+            pid,sid = k.split('_')[0],"_".join(k.split('_')[1:])
+            for i in range(frames):
+                j = mapper[k][i]
+                yield path, k, i, pid, "%s.%06d" % (sid,j)
+
+
+def dfaust(args):
+    with open(args.mapper,'r') as g:
+        mapper = json.load(g)
+    total = sum(len(x) for x in mapper.values())
+    return run(convert_dfaust, dfaust_tasks(Path(args.source), mapper), args.processes,
+        _init_dfaust, (Path(args.target).absolute(), args.suffix, args.sampler), total)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="dataset", required=True)
+    p = sub.add_parser("caesar", help="fitted CAESAR meshes (.mat)")
+    p.add_argument("source", nargs="?", default="caesar-fitted-meshes")
+    p.add_argument("target", nargs="?", default="../dataset/scans")
+    p.add_argument("--cache", default=".cache",
+        help="folder for the precomputed template topology")
+    p.set_defaults(func=caesar)
+    p = sub.add_parser("dfaust", help="DFAUST registrations_{m,f}.hdf5")
+    p.add_argument("source", nargs="?", default="dfaust")
+    p.add_argument("target", nargs="?", default="../dataset/scans")
+    p.add_argument("--mapper", default="dfaust_registration_to_scan_ids.json")
+    p.set_defaults(func=dfaust)
+    for p in sub.choices.values():
+        p.add_argument("--processes", type=int, default=None,
+            help="worker processes, one per core by default")
+        p.add_argument("--suffix", default=".xyz", choices=[".xyz", scanio.SUFFIX],
+            help="output format, the poisson stage reads .xyz")
+        p.add_argument("--sampler", default="native", choices=["native", "open3d"],
+            help="numpy poisson disk sampling or the open3d one of the notebook")
+    args = parser.parse_args()
+    failed = args.func(args)
+    if failed:
+        sys.exit("%d inputs failed" % len(failed))
@@ -0,0 +1,76 @@
+import hashlib
+from pathlib import Path
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+# Everything the scan conversion derives from the fixed template
+# connectivity: the faces without hand vertices, their edge adjacency and
+# the triangles of the largest connected component. It is computed once
+# and stored in cache_dir under a hash of the input files, so per scan
+# conversion only has to deal with the vertex positions.
+
+CACHE_VERSION = 1
+
+
+def file_hash(*paths):
+    h = hashlib.sha1()
+    h.update(b"%d" % CACHE_VERSION)
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+def face_adjacency(f):
+    # faces are adjacent if they share an edge, like
+    # cluster_connected_triangles in open3d
+    F = f.shape[0]
+    edges = np.sort(np.stack([f, np.roll(f, -1, axis=1)], axis=2).reshape(-1, 2), axis=1)
+    _, edge_ids = np.unique(edges, axis=0, return_inverse=True)
+    edge_ids = edge_ids.reshape(-1)
+    faces = np.repeat(np.arange(F), f.shape[1])
+    incidence = sparse.csr_matrix((np.ones(len(faces)), (faces, edge_ids)))
+    adjacency = (incidence @ incidence.T).tocsr()
+    adjacency.setdiag(0)
+    adjacency.eliminate_zeros()
+    adjacency.data[:] = 1
+    return adjacency
+
+
+def face_topology(f, exclude=()):
+    # f of shape (F, 3); faces touching a vertex in exclude are dropped
+    f = np.asarray(f, dtype=np.int64)
+    keep = np.ones(f.max() + 1, dtype=bool)
+    keep[np.asarray(exclude, dtype=np.int64).reshape(-1)] = False
+    face_mask = keep[f].all(axis=1)
+    faces = f[face_mask]
+    adjacency = face_adjacency(faces)
+    _, labels = connected_components(adjacency, directed=False)
+    largest = labels == np.argmax(np.bincount(labels))
+    return {
+        'face_mask': face_mask,
+        'faces': faces,
+        'largest': largest,
+        'adjacency_indptr': adjacency.indptr,
+        'adjacency_indices': adjacency.indices,
+    }
+
+
+def caesar_topology(shape_model='faceShapeModel.mat',
+        part_ids='VertexIdxSpecParts.mat', cache_dir='.cache'):
+    cache = Path(cache_dir) / ('caesar_topology_%s.npz' % file_hash(shape_model, part_ids))
+    if cache.is_file():
+        with np.load(cache) as data:
+            return dict(data)
+    from scipy.io import loadmat
+    hands = loadmat(part_ids)['idxHand'] - 1
+    f = loadmat(shape_model)['faces'] - 1
+    topology = face_topology(f, hands)
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache.with_name(cache.stem + '.tmp.npz')
+    np.savez(tmp, **topology)
+    tmp.replace(cache)
+    return topology
+